@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+"""
+Measure the startup latency of cloe-launch and compare it against a budget.
+
+cloe-launch is called by scripts very often, so the time it takes until a
+command starts doing its work matters. This script measures, in fresh
+interpreters and relative to starting an empty interpreter:
+
+  import    the time to import cloe_launch.__main__
+  help      the time to run `cloe-launch --help`
+
+and exits with a non-zero code if the median of either exceeds its budget.
+It also checks that --help does not import cloe_launch.exec.
+
+Usage:
+
+    python3 bench_startup.py [--runs N] [--import-budget MS] [--help-budget MS]
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from typing import Dict
+from typing import List
+
+
+CLI_DIR = os.path.dirname(os.path.abspath(__file__))
+
+CHECK_LAZY = """
+import sys
+sys.argv = ["cloe-launch", "--help"]
+from cloe_launch.__main__ import main
+try:
+    main()
+except SystemExit:
+    pass
+sys.exit(1 if "cloe_launch.exec" in sys.modules else 0)
+"""
+
+
+def measure(cmd: List[str], env: Dict[str, str], runs: int) -> float:
+    """Return the median wall-clock time of running cmd in milliseconds."""
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(
+            cmd,
+            env=env,
+            check=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--runs", type=int, default=20, help="runs per measurement")
+    parser.add_argument(
+        "--import-budget", type=float, default=80.0, help="budget for import in ms"
+    )
+    parser.add_argument(
+        "--help-budget", type=float, default=100.0, help="budget for --help in ms"
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as home:
+        # Use an empty home directory so that the user configuration
+        # does not influence the measurement.
+        env = dict(os.environ)
+        env["HOME"] = home
+        env["PYTHONPATH"] = CLI_DIR
+        env.pop("CLOE_VERBOSE", None)
+
+        python = [sys.executable]
+        measure(python + ["-m", "cloe_launch", "--help"], env, 1)  # warm up
+        baseline = measure(python + ["-c", "pass"], env, args.runs)
+        results = {
+            "import": measure(
+                python + ["-c", "import cloe_launch.__main__"], env, args.runs
+            )
+            - baseline,
+            "help": measure(python + ["-m", "cloe_launch", "--help"], env, args.runs)
+            - baseline,
+        }
+        lazy = subprocess.run(
+            python + ["-c", CHECK_LAZY], env=env, check=False, stdout=subprocess.DEVNULL
+        )
+
+    budgets = {"import": args.import_budget, "help": args.help_budget}
+    failed = False
+    print(f"interpreter: {baseline:7.1f} ms")
+    for key, value in results.items():
+        status = "ok" if value <= budgets[key] else "OVER BUDGET"
+        failed = failed or value > budgets[key]
+        print(
+            f"{key + ':':<12} {value:7.1f} ms  (budget {budgets[key]:.0f} ms)  {status}"
+        )
+    if lazy.returncode != 0:
+        print("error: cloe-launch --help imports cloe_launch.exec")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,37 @@
+"""
+This package reads the output files of the gndtruth_extractor plugin.
+
+Files of all output types are decoded incrementally, so that they can be
+much larger than the available memory:
+
+    from cloe_gndtruth import read_frames, read_arrays
+
+    for frame in read_frames("/tmp/cloe_gndtruth.json.gz", start=10.0, stop=20.0):
+        print(frame["sim_time"], frame["components"].keys())
+
+    gt = read_arrays("/tmp/cloe_gndtruth.msgpack")
+    print(gt.ego["speed"].max(), list(gt.tracks))
+
+Arrays require NumPy. MessagePack files are decoded faster if the msgpack
+package is installed.
+"""
+
+from cloe_gndtruth.arrays import GndTruthArrays
+from cloe_gndtruth.arrays import frame_dtype
+from cloe_gndtruth.arrays import frames_to_arrays
+from cloe_gndtruth.arrays import object_dtype
+from cloe_gndtruth.arrays import read_arrays
+from cloe_gndtruth.reader import GndTruthError
+from cloe_gndtruth.reader import open_stream
+from cloe_gndtruth.reader import read_frames
+
+__all__ = [
+    "GndTruthArrays",
+    "GndTruthError",
+    "frame_dtype",
+    "frames_to_arrays",
+    "object_dtype",
+    "open_stream",
+    "read_arrays",
+    "read_frames",
+]
@@ -0,0 +1,209 @@
+"""
+This module contains the conversion of gndtruth_extractor frames into NumPy
+structured arrays.
+
+Objects, such as the sensed state of the ego sensor and the sensed objects
+of object sensors, are converted into rows with the fields of object_dtype.
+Only these values are kept while the frames are decoded, in chunks of
+compact arrays, so that the memory needed is close to that of the result.
+NumPy is required.
+"""
+
+from pathlib import Path
+from typing import Any
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Tuple
+from typing import Union
+
+from cloe_gndtruth.reader import GndTruthError
+from cloe_gndtruth.reader import read_frames
+
+default_ego_component = "cloe::default_ego_sensor"
+default_object_component = "cloe::default_world_sensor"
+
+# Number of rows that are collected before they are converted into an array.
+_chunk_rows = 4096
+
+
+def require_numpy():
+    """Return the numpy module, which is an optional dependency."""
+    try:
+        import numpy  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        raise GndTruthError(
+            "NumPy is required for arrays, install it with: pip install numpy"
+        )
+    return numpy
+
+
+def frame_dtype():
+    """Return the dtype of the simulation time and step of each frame."""
+    np = require_numpy()
+    return np.dtype([("time", "f8"), ("step", "u8")])
+
+
+def object_dtype():
+    """Return the dtype of an object at one simulation step.
+
+    The position (x, y, z) and orientation quaternion (qw, qx, qy, qz) are
+    those of the pose, and the dimensions are the length, width, and height.
+    """
+    np = require_numpy()
+    return np.dtype(
+        [("time", "f8"), ("step", "u8"), ("id", "i8"), ("exist_prob", "f8")]
+        + [("type", "U8"), ("class", "U10")]
+        + [(x, "f8") for x in ("x", "y", "z", "qw", "qx", "qy", "qz")]
+        + [(x, "f8") for x in ("length", "width", "height")]
+        + [
+            (x, "f8")
+            for x in ("vx", "vy", "vz", "speed", "ax", "ay", "az", "wx", "wy", "wz")
+        ]
+    )
+
+
+def _object_row(time: float, step: int, obj: Dict[str, Any]) -> Tuple:
+    pose = obj["pose"]
+    pos = pose["translation"]
+    rot = pose["rotation"]
+    dim = obj["dimensions"]
+    vel = obj["velocity"]
+    acc = obj["acceleration"]
+    ang = obj["angular_velocity"]
+    return (
+        time,
+        step,
+        obj["id"],
+        obj["exist_prob"],
+        obj["type"],
+        obj["class"],
+        pos["x"],
+        pos["y"],
+        pos["z"],
+        rot["w"],
+        rot["x"],
+        rot["y"],
+        rot["z"],
+        dim["x"],
+        dim["y"],
+        dim["z"],
+        vel["x"],
+        vel["y"],
+        vel["z"],
+        obj["velocity_norm"],
+        acc["x"],
+        acc["y"],
+        acc["z"],
+        ang["x"],
+        ang["y"],
+        ang["z"],
+    )
+
+
+class _Rows:
+    """Rows collects tuples and converts them into an array in chunks."""
+
+    def __init__(self, dtype):
+        self.dtype = dtype
+        self._rows: List[Tuple] = []
+        self._chunks: List[Any] = []
+
+    def append(self, row: Tuple) -> None:
+        self._rows.append(row)
+        if len(self._rows) == _chunk_rows:
+            self._flush()
+
+    def _flush(self) -> None:
+        np = require_numpy()
+        self._chunks.append(np.array(self._rows, dtype=self.dtype))
+        self._rows = []
+
+    def array(self):
+        np = require_numpy()
+        if self._rows or not self._chunks:
+            self._flush()
+        return (
+            np.concatenate(self._chunks) if len(self._chunks) > 1 else self._chunks[0]
+        )
+
+
+class GndTruthArrays:
+    """GndTruthArrays contains the ground truth of a simulation as arrays.
+
+    Attributes:
+        frames: time and step of each frame, with frame_dtype.
+        ego: sensed state of the ego sensor in each frame, with object_dtype,
+            or None if the ego component was not extracted.
+        tracks: rows of each object by object ID, with object_dtype.
+    """
+
+    def __init__(self, frames, ego, tracks: Dict[int, Any]):
+        self.frames = frames
+        self.ego = ego
+        self.tracks = tracks
+
+    def __repr__(self) -> str:
+        return (
+            f"GndTruthArrays(frames={len(self.frames)}, "
+            f"ego={None if self.ego is None else len(self.ego)}, "
+            f"tracks={len(self.tracks)})"
+        )
+
+
+def frames_to_arrays(
+    frames: Iterable[Dict[str, Any]],
+    ego_component: Optional[str] = default_ego_component,
+    object_component: Optional[str] = default_object_component,
+) -> GndTruthArrays:
+    """Convert frames into arrays of the time, ego state, and object tracks.
+
+    The ego state is the sensed_state of ego_component, and the tracks are
+    the sensed_objects of object_component, grouped by object ID. Frames
+    without these components are skipped for them.
+    """
+    frame_rows = _Rows(frame_dtype())
+    ego_rows = _Rows(object_dtype())
+    track_rows: Dict[int, _Rows] = {}
+    has_ego = False
+    try:
+        for frame in frames:
+            time, step = frame["sim_time"], frame["sim_step"]
+            frame_rows.append((time, step))
+            components = frame["components"]
+            ego = components.get(ego_component) if ego_component else None
+            if ego is not None:
+                has_ego = True
+                ego_rows.append(_object_row(time, step, ego["sensed_state"]))
+            sensor = components.get(object_component) if object_component else None
+            if sensor is not None:
+                for obj in sensor["sensed_objects"]:
+                    rows = track_rows.get(obj["id"])
+                    if rows is None:
+                        rows = track_rows[obj["id"]] = _Rows(ego_rows.dtype)
+                    rows.append(_object_row(time, step, obj))
+    except (KeyError, TypeError) as err:
+        raise GndTruthError(f"unexpected frame contents, missing: {err}")
+    return GndTruthArrays(
+        frame_rows.array(),
+        ego_rows.array() if has_ego else None,
+        {k: v.array() for k, v in sorted(track_rows.items())},
+    )
+
+
+def read_arrays(
+    path: Union[Path, str],
+    start: Optional[float] = None,
+    stop: Optional[float] = None,
+    ego_component: Optional[str] = default_ego_component,
+    object_component: Optional[str] = default_object_component,
+) -> GndTruthArrays:
+    """Read a gndtruth_extractor output file into arrays.
+
+    See read_frames for start and stop, and frames_to_arrays for the
+    components.
+    """
+    return frames_to_arrays(
+        read_frames(path, start, stop), ego_component, object_component
+    )
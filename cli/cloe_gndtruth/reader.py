@@ -0,0 +1,288 @@
+"""
+This module contains the incremental decoding of gndtruth_extractor output.
+
+The gndtruth_extractor plugin writes one frame per simulation step, with the
+simulation time, step, and the state of the configured components:
+
+    {"sim_time": 0.02, "sim_step": 1, "components": {"cloe::...": {...}}}
+
+JSON files contain an array of frames, which is written frame by frame.
+MessagePack files contain the same array as a single MessagePack array.
+Both can be compressed with gzip or bzip2; the json.zip and msgpack.zip
+output types are also gzip-compressed. The format and compression of a file
+are determined from its contents and not its name, since the plugin writes
+to the given file name literally.
+
+Frames are decoded one at a time from a fixed-size buffer, so that files
+of many gigabytes can be read with little memory.
+"""
+
+import bz2
+import gzip
+import io
+import json
+import re
+import struct
+import zipfile
+import zlib
+
+from pathlib import Path
+from typing import Any
+from typing import BinaryIO
+from typing import Dict
+from typing import Iterator
+from typing import Optional
+from typing import Union
+
+# Size of the chunks that are read and decompressed at a time.
+chunk_size = 1 << 20
+
+_separator_regex = re.compile(r"[\s,]*")
+
+
+class GndTruthError(Exception):
+    """GndTruthError signifies that a gndtruth_extractor file cannot be read."""
+
+
+class _ZlibReader(io.RawIOBase):
+    """Decompress a raw zlib stream, which a ZIP output might contain."""
+
+    def __init__(self, file: BinaryIO):
+        super().__init__()
+        self._file = file
+        self._zlib = zlib.decompressobj()
+        self._input = b""
+        self._output = b""
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while not self._output:
+            if self._zlib.eof:
+                return 0
+            if not self._input:
+                self._input = self._file.read(chunk_size)
+                if not self._input:
+                    raise EOFError(
+                        "compressed stream ended before the end-of-stream marker"
+                    )
+            self._output = self._zlib.decompress(self._input, chunk_size)
+            self._input = self._zlib.unconsumed_tail
+        size = min(len(b), len(self._output))
+        b[:size] = self._output[:size]
+        self._output = self._output[size:]
+        return size
+
+    def close(self) -> None:
+        self._file.close()
+        super().close()
+
+
+def open_stream(path: Union[Path, str]) -> BinaryIO:
+    """Open the file and return a stream of its decompressed contents."""
+    with open(str(path), "rb") as file:
+        magic = file.read(4)
+    if magic[:2] == b"\x1f\x8b":
+        return gzip.open(str(path), "rb")
+    if magic[:3] == b"BZh":
+        return bz2.open(str(path), "rb")
+    if magic[:4] == b"PK\x03\x04":
+        with zipfile.ZipFile(str(path)) as archive:
+            names = [x for x in archive.namelist() if not x.endswith("/")]
+            if len(names) != 1:
+                raise GndTruthError(f"expected one file in ZIP archive: {path}")
+            return archive.open(names[0])
+    if len(magic) >= 2 and magic[0] == 0x78 and (magic[0] << 8 | magic[1]) % 31 == 0:
+        return io.BufferedReader(_ZlibReader(open(str(path), "rb")), chunk_size)
+    return open(str(path), "rb")
+
+
+def _json_frames(stream: BinaryIO) -> Iterator[Dict[str, Any]]:
+    text = io.TextIOWrapper(stream, encoding="utf-8")
+    decoder = json.JSONDecoder()
+    buf = text.read(chunk_size)
+    pos = _separator_regex.match(buf).end()
+    if buf[pos : pos + 1] != "[":
+        raise GndTruthError("expected JSON array of frames")
+    pos += 1
+    eof = False
+    while True:
+        pos = _separator_regex.match(buf, pos).end()
+        if pos == len(buf):
+            if eof:
+                # The array is not closed if the simulation was aborted.
+                return
+            buf, pos = text.read(chunk_size), 0
+            eof = not buf
+            continue
+        if buf[pos] == "]":
+            return
+        try:
+            frame, pos = decoder.raw_decode(buf, pos)
+        except ValueError as err:
+            if eof:
+                raise GndTruthError(f"invalid or truncated frame: {err}")
+            # The frame continues in the next chunk. Read at least as much
+            # as is buffered, so that large frames are decoded in linear time.
+            buf, pos = buf[pos:], 0
+            more = text.read(max(chunk_size, len(buf)))
+            eof = not more
+            buf += more
+            continue
+        yield frame
+
+
+class _MsgPackDecoder:
+    """Decode MessagePack values from a stream, as nlohmann::json writes them.
+
+    This is used if the msgpack package is not installed.
+    """
+
+    _structs = {
+        0xCA: struct.Struct(">f"),
+        0xCB: struct.Struct(">d"),
+        0xCC: struct.Struct(">B"),
+        0xCD: struct.Struct(">H"),
+        0xCE: struct.Struct(">I"),
+        0xCF: struct.Struct(">Q"),
+        0xD0: struct.Struct(">b"),
+        0xD1: struct.Struct(">h"),
+        0xD2: struct.Struct(">i"),
+        0xD3: struct.Struct(">q"),
+    }
+    _lengths = {
+        0xC4: struct.Struct(">B"),
+        0xC5: struct.Struct(">H"),
+        0xC6: struct.Struct(">I"),
+        0xD9: struct.Struct(">B"),
+        0xDA: struct.Struct(">H"),
+        0xDB: struct.Struct(">I"),
+        0xDC: struct.Struct(">H"),
+        0xDD: struct.Struct(">I"),
+        0xDE: struct.Struct(">H"),
+        0xDF: struct.Struct(">I"),
+    }
+
+    def __init__(self, stream: BinaryIO):
+        self._stream = stream
+        self._buf = b""
+        self._pos = 0
+
+    def _read(self, size: int) -> bytes:
+        end = self._pos + size
+        if end > len(self._buf):
+            self._buf = self._buf[self._pos :] + self._stream.read(
+                max(size, chunk_size)
+            )
+            self._pos, end = 0, size
+            if end > len(self._buf):
+                raise GndTruthError("truncated MessagePack data")
+        data = self._buf[self._pos : end]
+        self._pos = end
+        return data
+
+    def read_array_header(self) -> int:
+        code = self._read(1)[0]
+        if 0x90 <= code <= 0x9F:
+            return code & 0x0F
+        if code in (0xDC, 0xDD):
+            return self._lengths[code].unpack(self._read(self._lengths[code].size))[0]
+        raise GndTruthError("expected MessagePack array of frames")
+
+    def decode(self) -> Any:
+        code = self._read(1)[0]
+        if code <= 0x7F:
+            return code
+        if code >= 0xE0:
+            return code - 0x100
+        if 0xA0 <= code <= 0xBF:
+            return self._read(code & 0x1F).decode()
+        if 0x80 <= code <= 0x8F:
+            return self._decode_map(code & 0x0F)
+        if 0x90 <= code <= 0x9F:
+            return [self.decode() for _ in range(code & 0x0F)]
+        if code in self._structs:
+            fmt = self._structs[code]
+            return fmt.unpack(self._read(fmt.size))[0]
+        if code in self._lengths:
+            fmt = self._lengths[code]
+            size = fmt.unpack(self._read(fmt.size))[0]
+            if code <= 0xC6:
+                return self._read(size)
+            if code <= 0xDB:
+                return self._read(size).decode()
+            if code <= 0xDD:
+                return [self.decode() for _ in range(size)]
+            return self._decode_map(size)
+        if code == 0xC0:
+            return None
+        if code == 0xC2:
+            return False
+        if code == 0xC3:
+            return True
+        raise GndTruthError(f"unsupported MessagePack type: 0x{code:02x}")
+
+    def _decode_map(self, size: int) -> Dict[Any, Any]:
+        result = {}
+        for _ in range(size):
+            key = self.decode()
+            result[key] = self.decode()
+        return result
+
+
+def _msgpack_frames(stream: BinaryIO) -> Iterator[Dict[str, Any]]:
+    try:
+        import msgpack  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        decoder = _MsgPackDecoder(stream)
+        for _ in range(decoder.read_array_header()):
+            yield decoder.decode()
+        return
+
+    unpacker = msgpack.Unpacker(stream, raw=False, read_size=chunk_size)
+    try:
+        count = unpacker.read_array_header()
+    except ValueError:
+        raise GndTruthError("expected MessagePack array of frames")
+    for _ in range(count):
+        try:
+            frame = unpacker.unpack()
+        except msgpack.OutOfData:
+            raise GndTruthError("truncated MessagePack data")
+        yield frame
+
+
+def read_frames(
+    path: Union[Path, str],
+    start: Optional[float] = None,
+    stop: Optional[float] = None,
+) -> Iterator[Dict[str, Any]]:
+    """Yield the frames of a gndtruth_extractor output file.
+
+    Only frames whose simulation time in seconds is within start and stop,
+    inclusive, are yielded. Since frames are ordered by time, decoding stops
+    at the first frame after stop.
+    """
+    with open_stream(path) as stream:
+        head = stream.peek(64)[:64].lstrip()
+        if head[:1] == b"[":
+            frames = _json_frames(stream)
+        elif head[:1] and (0x90 <= head[0] <= 0x9F or head[0] in (0xDC, 0xDD)):
+            frames = _msgpack_frames(stream)
+        else:
+            raise GndTruthError(f"not a gndtruth_extractor output file: {path}")
+        try:
+            for frame in frames:
+                time = frame["sim_time"]
+                if start is not None and time < start:
+                    continue
+                if stop is not None and time > stop:
+                    break
+                yield frame
+        except (EOFError, zlib.error, OSError) as err:
+            raise GndTruthError(f"cannot read {path}: {err}")
+        except (KeyError, TypeError):
+            raise GndTruthError(f"frame without simulation time in {path}")
+        finally:
+            frames.close()
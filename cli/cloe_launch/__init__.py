@@ -1,16 +1,19 @@
+# pylint: disable=logging-fstring-interpolation,import-outside-toplevel
+
 """
 This module contains the launcher configuration data types.
 """
 
 import logging
 import os
-import shutil
-import subprocess
 
+from pathlib import Path
 from typing import List
 from typing import Optional
 
-import toml
+# NOTE: Modules that are only needed by some commands, such as toml,
+# are imported where they are used, since cloe-launch is started often
+# and should start fast.
 
 
 class ConfigurationError(Exception):
@@ -25,6 +28,10 @@ class Configuration:
     config_file = os.path.expanduser("~/.config/cloe/launcher/conf.toml")
     profiles_dir = os.path.join(config_dir, "profiles")
     runtime_dir = os.path.expanduser("~/.cache/cloe/launcher")
+    results_dir = os.path.expanduser("~/.cache/cloe/results")
+    runs_index_file = os.path.expanduser("~/.cache/cloe/runs.sqlite")
+    check_cache_file = os.path.expanduser("~/.cache/cloe/check.json")
+    bundles_dir = os.path.expanduser("~/.cache/cloe/bundles")
 
     conf_version = "1"
     _conf = {
@@ -32,10 +39,28 @@ class Configuration:
         "shell_path": "/bin/bash",
         "conan_path": "conan",
         "relay_anonymous_files": True,
+        "relay_pass_fds": True,
+        "concurrent_plugin_setup": False,
+        "compact_library_path": False,
         "engine": {
             "pre_arguments": [],
             "post_arguments": [],
         },
+        "result_cache": {
+            "max_size_mb": 10240,
+            "env": [],
+        },
+        "runtime_cache": {
+            "max_size_mb": 4096,
+            "max_age_days": 30,
+            "relay_max_age_hours": 24,
+            "gc_interval_hours": 1,
+            "resolve_interval_hours": 1,
+        },
+        "runs_index": {
+            "enabled": True,
+            "paths": [],
+        },
     }
 
     all_profiles: List[str] = []
@@ -45,17 +70,19 @@ class Configuration:
     def __init__(self, profile: str = None):
         # Make configuration and runtime directories if needed:
         if not os.path.exists(self.config_dir):
-            logging.info("Create configuration directory:", self.config_dir)
+            logging.info(f"Create configuration directory: {self.config_dir}")
             os.makedirs(self.config_dir)
         if not os.path.exists(self.profiles_dir):
-            logging.info("Create profile directory:", self.profiles_dir)
+            logging.info(f"Create profile directory: {self.profiles_dir}")
             os.makedirs(self.profiles_dir)
         if not os.path.exists(self.runtime_dir):
-            logging.info("Create runtime directory:", self.runtime_dir)
+            logging.info(f"Create runtime directory: {self.runtime_dir}")
             os.makedirs(self.runtime_dir)
 
         # Load configuration file:
         if os.path.exists(self.config_file):
+            import toml
+
             conf = toml.load(self.config_file)
             if "version" not in conf:
                 raise ConfigurationError(
@@ -86,6 +113,61 @@ class Configuration:
         """Return the path to the runtime directory of the profile."""
         return os.path.join(self.runtime_dir, profile)
 
+    def result_cache(self):
+        """Return the cache of simulation results.
+
+        The variables in env are taken into account in addition to the
+        environment variables that always influence cloe-engine.
+        """
+        from cloe_launch.results import ResultCache
+        from cloe_launch.results import default_env_vars
+
+        conf = self._conf.get("result_cache", {})
+        return ResultCache(
+            Path(self.results_dir),
+            max_size=int(conf.get("max_size_mb", 10240)) << 20,
+            env_vars=default_env_vars + list(conf.get("env", [])),
+        )
+
+    def runtime_cache(self):
+        """Return the eviction policy of the runtime directories of all profiles.
+
+        A maximum size or age of 0 is no limit, and a garbage collection
+        interval of 0 disables automatic garbage collection.
+        """
+        from cloe_launch.runtime_cache import RuntimeCache
+
+        conf = self._conf.get("runtime_cache", {})
+        return RuntimeCache(
+            Path(self.runtime_dir),
+            max_size=int(conf.get("max_size_mb", 4096)) << 20,
+            max_age=float(conf.get("max_age_days", 30)) * 86400,
+            relay_max_age=float(conf.get("relay_max_age_hours", 24)) * 3600,
+            gc_interval=float(conf.get("gc_interval_hours", 1)) * 3600,
+        )
+
+    def runs_index(self):
+        """Return the index of simulation runs, or None if it is disabled."""
+        from cloe_launch.registry import RunIndex
+
+        conf = self._conf.get("runs_index", {})
+        if not conf.get("enabled", True):
+            return None
+        return RunIndex(Path(self.runs_index_file))
+
+    def runs_index_paths(self) -> List[Path]:
+        """Return the directories that contain runs to be indexed.
+
+        This is the default registry of cloe-engine, unless other paths are
+        configured.
+        """
+        conf = self._conf.get("runs_index", {})
+        paths = conf.get("paths", [])
+        if paths:
+            return [Path(os.path.expanduser(x)) for x in paths]
+        data_home = os.getenv("XDG_DATA_HOME", os.path.expanduser("~/.local/share"))
+        return [Path(data_home) / "cloe" / "registry"]
+
     def set_current(self, profile: str) -> None:
         """Set the current profile and make sure it exists."""
         self.current_profile = profile
@@ -97,12 +179,14 @@ class Configuration:
         self.default_profile = profile
         self._conf["default_profile"] = profile
         logging.info(f"Write configuration to {self.config_file}:\n  {self._conf}")
+        import toml
+
         with open(self.config_file, "w") as file:
             toml.dump(self._conf, file)
 
     def read(self, profile: str) -> str:
         """Read the specified profile."""
-        logging.info("Open:", self.profile_path(profile))
+        logging.info(f"Open: {self.profile_path(profile)}")
         with open(self.profile_path(profile)) as file:
             return file.read()
 
@@ -113,8 +197,10 @@ class Configuration:
             raise ConfigurationError("environment variable EDITOR is unset")
         if not create and not os.path.exists(self.profile_path(profile)):
             raise ConfigurationError(f"profile {profile} does not exist")
+        import subprocess
+
         cmd = [editor, self.profile_path(profile)]
-        logging.info("Exec:", " ".join(cmd))
+        logging.info(f"Exec: {' '.join(cmd)}")
         subprocess.call(cmd)
 
     def add(self, profile: str, file: str, force: bool = False) -> None:
@@ -123,6 +209,8 @@ class Configuration:
             raise ConfigurationError(
                 f"cannot overwrite profile {profile} unless forced"
             )
+        import shutil
+
         logging.debug("Copy: {} -> {}".format(file, self.profile_path(profile)))
         shutil.copyfile(file, self.profile_path(profile))
         if profile not in self.all_profiles:
@@ -132,7 +220,7 @@ class Configuration:
         """Remove the profile, if it exists."""
         file = os.path.join(self.profiles_dir, profile)
         if os.path.exists(file):
-            logging.info("Remove:", file)
+            logging.info(f"Remove: {file}")
             os.remove(file)
         if self.default_profile == profile:
             self.set_default(None)
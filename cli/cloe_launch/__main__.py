@@ -1,3 +1,5 @@
+# pylint: disable=import-outside-toplevel,logging-fstring-interpolation
+
 """
 Run a specific Cloe configuration profile.
 
@@ -8,6 +10,16 @@ remove this script.
 
 Commands:
   exec      Run cloe-engine with the given arguments.
+  batch     Run cloe-engine for many stackfiles concurrently.
+  sweep     Run cloe-engine for a parameter sweep.
+  submit    Submit stackfiles to a spool directory.
+  worker    Run stackfiles from a spool directory.
+  runs      Find simulation runs in the run index.
+  report    Aggregate simulation results and compare with a baseline.
+  check     Validate many stackfiles in parallel.
+  lock      Pin the dependencies of a profile in a lockfile.
+  bundle    Export profiles into relocatable bundles and run them.
+  cache     Show and limit the size of the runtime cache.
   show      Show default/specified profile.
   list      List the currently available profiles.
   add       Add a profile with the given name.
@@ -17,18 +29,26 @@ Commands:
 
 """
 
+import json
 import logging
 import os
 import sys
+import time
 
+from pathlib import Path
 from typing import Dict
 from typing import List
+from typing import Optional
 
 import click
 
 from cloe_launch import Configuration
 from cloe_launch import ConfigurationError
-from cloe_launch.exec import Engine
+from cloe_launch.stackfile import StackfileError
+
+# NOTE: The cloe_launch.exec module and the modules that depend on it are
+# imported in the commands that need them, so that cloe-launch starts fast
+# for commands that do not, such as --help.
 
 
 @click.group()
@@ -68,9 +88,9 @@ class options:
         required: bool = False,
         help: str = "Profile to select, default if absent.",
     ):
-        conf = Configuration()
-
         def complete(ctx, args, incomplete):
+            # The configuration is only read when completion is requested.
+            conf = Configuration()
             profiles = []
             for k in conf.all_profiles:
                 if k not in args:
@@ -83,6 +103,7 @@ class options:
             envvar="CLOE_PROFILE",
             required=required,
             type=click.STRING,
+            autocompletion=complete,
             help=help,
         )
 
@@ -141,7 +162,29 @@ class options:
             "-c",
             "--cache/--no-cache",
             is_flag=True,
-            help="Re-use the cache if available.",
+            default=True,
+            show_default=True,
+            help="Re-use the runtime cache if it is up-to-date.",
+        )
+
+    @classmethod
+    def result_cache(cls):
+        return click.option(
+            "--result-cache/--no-result-cache",
+            is_flag=True,
+            default=True,
+            show_default=True,
+            help="Re-use results of simulations with the same inputs.",
+        )
+
+    @classmethod
+    def telemetry_interval(cls):
+        return click.option(
+            "--telemetry-interval",
+            type=click.FloatRange(min=0.01),
+            default=1.0,
+            show_default=True,
+            help="Seconds between samples of the resource usage.",
         )
 
     @classmethod
@@ -154,7 +197,9 @@ class options:
 
 
 # _________________________________________________________________________
-# Command: exec [--cache] [--debug] [--profile=PROFILE | --profile-path=CONANFILE]
+# Command: exec [--cache] [--debug | --profile-with=PROFILER]
+#               [--concurrent-setup] [--compact-library-path] [--telemetry=DIR]
+#               [--profile=PROFILE | --profile-path=CONANFILE]
 #               [--] ENGINE_ARGS
 @main.command("exec")
 @options.profile()
@@ -178,6 +223,35 @@ class options:
     type=click.STRING,
     help="Use environment variable as set or preserve.",
 )
+@click.option(
+    "--concurrent-setup/--sequential-setup",
+    default=None,
+    help="Set up and tear down plugins concurrently. [default: from configuration]",
+)
+@click.option(
+    "--compact-library-path/--full-library-path",
+    default=None,
+    help="Link all libraries into one directory for cloe-engine. [default: from configuration]",
+)
+@click.option(
+    "--telemetry",
+    type=click.Path(file_okay=False, dir_okay=True),
+    default=None,
+    help="Sample resource usage of cloe-engine into directory.",
+)
+@options.telemetry_interval()
+@click.option(
+    "--profile-with",
+    type=click.Choice(["perf", "callgrind", "massif", "heaptrack"]),
+    default=None,
+    help="Launch cloe-engine with a profiler.",
+)
+@click.option(
+    "--profiler-arg",
+    multiple=True,
+    type=click.STRING,
+    help="Pass argument to the profiler.",
+)
 @click.pass_obj
 def cli_exec(
     opt,
@@ -191,12 +265,32 @@ def cli_exec(
     override_env: List[str],
     cache: bool,
     debug: bool,
+    concurrent_setup: Optional[bool],
+    compact_library_path: Optional[bool],
+    telemetry: Optional[str],
+    telemetry_interval: float,
+    profile_with: Optional[str],
+    profiler_arg: List[str],
 ) -> None:
     """Launch cloe-engine with a profile.
 
     ENGINE_ARGS are passed on to cloe-engine.
+
+    With --telemetry, the memory, CPU time, context switches, threads, and
+    I/O of cloe-engine and its children are sampled from /proc. The time
+    series is written to telemetry.csv and its peak and mean values to
+    telemetry.json in the given directory.
+
+    With --profile-with, cloe-engine is run with the given profiler, which
+    writes its output to the output directory of the simulation. A summary
+    of the functions that take the most time or memory is printed at the end.
     """
     options.deny_profile_and_path(profile, profile_path)
+    if debug and profile_with is not None:
+        raise click.UsageError("--debug and --profile-with are mutually exclusive")
+    from cloe_launch.exec import Engine
+    from cloe_launch.profiling import ProfilerError
+
     conf = Configuration(profile)
     engine = Engine(conf, conanfile=profile_path)
     engine.conan_args = list(conan_arg)
@@ -204,6 +298,15 @@ def cli_exec(
     engine.conan_settings = list(conan_setting)
 
     engine.preserve_env = preserve_env
+    if concurrent_setup is not None:
+        engine.concurrent_plugin_setup = concurrent_setup
+    if compact_library_path is not None:
+        engine.compact_library_path = compact_library_path
+    if telemetry is not None:
+        engine.telemetry_dir = Path(telemetry)
+        engine.telemetry_interval = telemetry_interval
+    engine.profiler = profile_with
+    engine.profiler_args = list(profiler_arg)
 
     # Prepare environment overrides:
     overrides = {}
@@ -215,12 +318,1022 @@ def cli_exec(
 
     # Run cloe-engine and pass on returncode:
     # If cloe-engine is killed/aborted, subprocess will return 250.
-    result = engine.exec(
-        engine_args, use_cache=cache, debug=debug, override_env=overrides
-    )
+    launched = time.time()
+    try:
+        result = engine.exec(
+            engine_args, use_cache=cache, debug=debug, override_env=overrides
+        )
+    except ProfilerError as err:
+        raise click.ClickException(str(err))
+    if engine.run_uuid is not None:
+        _record_launch(conf, engine, result.returncode, launched)
     sys.exit(result.returncode)
 
 
+def _record_launch(conf: Configuration, engine, returncode: int, launched: float) -> None:
+    """Record the profile of the run in the run index.
+
+    The output of the run is added to the index the next time it is updated.
+    """
+    import sqlite3
+
+    try:
+        index = conf.runs_index()
+        if index is None:
+            return
+        index.record_launch(
+            engine.run_uuid, engine.profile, engine.runtime_key(), returncode, launched
+        )
+        index.close()
+    except sqlite3.Error as err:
+        logging.warning(f"Warning: cannot add run to index: {err}")
+
+
+# _________________________________________________________________________
+# Command: batch [--cache] [--result-cache] [--jobs=N] [--output-dir=DIR] [--base=STACKFILE]
+#                [--file-list=FILE] [--require-success] [--telemetry]
+#                [--profile=PROFILE | --profile-path=CONANFILE]
+#                [--] STACKFILES...
+@main.command("batch")
+@options.profile()
+@options.profile_path()
+@options.conan_arg()
+@options.conan_option()
+@options.conan_setting()
+@options.preserve_env()
+@options.cache()
+@options.result_cache()
+@click.option(
+    "-j",
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=os.cpu_count() or 1,
+    show_default=True,
+    help="Number of simulations to run concurrently.",
+)
+@click.option(
+    "-O",
+    "--output-dir",
+    type=click.Path(file_okay=False, dir_okay=True),
+    default=None,
+    help="Directory to write results to. [default: batch-<timestamp>]",
+)
+@click.option(
+    "-b",
+    "--base",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False),
+    multiple=True,
+    help="Stackfile to merge before each stackfile.",
+)
+@click.option(
+    "-f",
+    "--file-list",
+    type=click.File("r"),
+    default=None,
+    help="File with one stackfile per line to run, - for stdin.",
+)
+@click.option(
+    "--require-success",
+    is_flag=True,
+    help="Treat simulations that are stopped without success as failures.",
+)
+@click.option(
+    "--telemetry",
+    is_flag=True,
+    help="Sample resource usage of each run into its directory.",
+)
+@options.telemetry_interval()
+@click.argument("stackfiles", nargs=-1)
+@click.pass_obj
+def cli_batch(
+    opt,
+    profile: str,
+    profile_path: str,
+    conan_arg: List[str],
+    conan_option: List[str],
+    conan_setting: List[str],
+    preserve_env: bool,
+    cache: bool,
+    result_cache: bool,
+    jobs: int,
+    output_dir: Optional[str],
+    base: List[str],
+    file_list,
+    require_success: bool,
+    telemetry: bool,
+    telemetry_interval: float,
+    stackfiles: List[str],
+) -> None:
+    """Run many simulations concurrently with a profile.
+
+    Each of the STACKFILES, and each stackfile listed in --file-list, is run
+    by its own cloe-engine process, with up to --jobs processes at a time.
+    The profile is prepared only once for all of them.
+
+    Each run gets its own simulation UUID and its own directory in the output
+    directory, containing the registry and output of cloe-engine and the
+    captured stdout and stderr. A summary of the outcome and duration of all
+    runs is written to summary.json in the output directory. With
+    --telemetry, it also contains the peak and mean resource usage of each
+    run, whose time series is written to telemetry.csv in its directory.
+
+    The exit code combines the exit codes of all runs, which correspond to
+    the outcomes of the simulations.
+
+    Results are cached by the merged stack, the cloe-engine and plugin
+    binaries, and the environment. A run with the same inputs as a cached
+    run is not simulated again, unless --no-result-cache is given.
+    """
+    options.deny_profile_and_path(profile, profile_path)
+    from cloe_launch.batch import Batch
+    from cloe_launch.batch import BatchRun
+    from cloe_launch.batch import exit_code_from_runs
+    from cloe_launch.exec import Engine
+
+    files = list(stackfiles)
+    if file_list is not None:
+        files.extend(x.strip() for x in file_list if x.strip() != "")
+    if not files:
+        raise click.UsageError("no stackfiles to run")
+
+    conf = Configuration(profile)
+    engine = Engine(conf, conanfile=profile_path)
+    engine.conan_args = list(conan_arg)
+    engine.conan_options = list(conan_option)
+    engine.conan_settings = list(conan_setting)
+    engine.preserve_env = preserve_env
+
+    if output_dir is None:
+        output_dir = time.strftime("batch-%Y%m%d-%H%M%S")
+    batch = Batch(
+        engine,
+        Path(output_dir),
+        workers=jobs,
+        require_success=require_success,
+        result_cache=conf.result_cache() if result_cache else None,
+        telemetry_interval=telemetry_interval if telemetry else None,
+        runs_index=conf.runs_index(),
+    )
+    batch.prepare(use_cache=cache)
+
+    # YAML stackfiles are converted before any run starts, and the plugin
+    # setups are loaded for all stackfiles together.
+    base_args = engine.compile_stackfiles(list(base))
+    runs = [
+        BatchRun(i, f, base_args + engine.compile_stackfiles([f]))
+        for i, f in enumerate(files)
+    ]
+    references = engine.stackfile_references([x for r in runs for x in r.args])
+    batch.run(runs, references=references)
+
+    outcomes = ", ".join(f"{v} {k}" for k, v in sorted(batch.outcomes().items()))
+    print(f"Ran {len(runs)} simulations in {batch.duration:.1f}s: {outcomes}")
+    print(f"Summary: {batch.summary_path()}")
+    sys.exit(exit_code_from_runs(runs))
+
+
+# _________________________________________________________________________
+# Command: sweep [--cache] [--result-cache] [--jobs=N] [--output-dir=DIR] [--require-success]
+#                [--telemetry] [--list]
+#                [--profile=PROFILE | --profile-path=CONANFILE]
+#                SWEEPFILE
+@main.command("sweep")
+@options.profile()
+@options.profile_path()
+@options.conan_arg()
+@options.conan_option()
+@options.conan_setting()
+@options.preserve_env()
+@options.cache()
+@options.result_cache()
+@click.option(
+    "-j",
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=os.cpu_count() or 1,
+    show_default=True,
+    help="Number of simulations to run concurrently.",
+)
+@click.option(
+    "-O",
+    "--output-dir",
+    type=click.Path(file_okay=False, dir_okay=True),
+    default=None,
+    help="Directory to write results to. [default: sweep-<timestamp>]",
+)
+@click.option(
+    "--require-success",
+    is_flag=True,
+    help="Treat simulations that are stopped without success as failures.",
+)
+@click.option(
+    "--telemetry",
+    is_flag=True,
+    help="Sample resource usage of each run into its directory.",
+)
+@options.telemetry_interval()
+@click.option(
+    "-l",
+    "--list",
+    "list_only",
+    is_flag=True,
+    help="Only print the parameters of each unique configuration.",
+)
+@click.argument(
+    "sweepfile", type=click.Path(exists=True, file_okay=True, dir_okay=False)
+)
+@click.pass_obj
+def cli_sweep(
+    opt,
+    profile: str,
+    profile_path: str,
+    conan_arg: List[str],
+    conan_option: List[str],
+    conan_setting: List[str],
+    preserve_env: bool,
+    cache: bool,
+    result_cache: bool,
+    jobs: int,
+    output_dir: Optional[str],
+    require_success: bool,
+    telemetry: bool,
+    telemetry_interval: float,
+    list_only: bool,
+    sweepfile: str,
+) -> None:
+    """Run a parameter sweep defined in SWEEPFILE with a profile.
+
+    A sweep consists of a base stackfile and axes, which override values in
+    the base stackfile by JSON pointer, and are combined either as a grid or
+    by random sampling. Each unique configuration is passed to cloe-engine
+    via stdin and run as in the batch command, without writing the
+    configurations to disk.
+    """
+    options.deny_profile_and_path(profile, profile_path)
+    from cloe_launch.batch import Batch
+    from cloe_launch.batch import BatchRun
+    from cloe_launch.batch import exit_code_from_runs
+    from cloe_launch.exec import Engine
+    from cloe_launch.stackfile import StackfileCompiler
+    from cloe_launch.sweep import Sweep
+    from cloe_launch.sweep import SweepError
+
+    conf = Configuration(profile)
+    engine = Engine(conf, conanfile=profile_path)
+    engine.conan_args = list(conan_arg)
+    engine.conan_options = list(conan_option)
+    engine.conan_settings = list(conan_setting)
+    engine.preserve_env = preserve_env
+
+    if output_dir is None:
+        output_dir = time.strftime("sweep-%Y%m%d-%H%M%S")
+    batch = Batch(
+        engine,
+        Path(output_dir),
+        workers=jobs,
+        require_success=require_success,
+        result_cache=conf.result_cache() if result_cache else None,
+        telemetry_interval=telemetry_interval if telemetry else None,
+        runs_index=conf.runs_index(),
+    )
+    if not list_only:
+        batch.prepare(use_cache=cache)
+
+    try:
+        sweep = Sweep(Path(sweepfile), StackfileCompiler(engine.stackfile_cache_dir()))
+    except SweepError as err:
+        raise click.ClickException(str(err))
+
+    if list_only:
+        for params, _, digest in sweep.configs():
+            print(json.dumps({"digest": digest, "params": params}))
+        return
+
+    def runs():
+        for i, (params, config, digest) in enumerate(sweep.configs()):
+            run = BatchRun(i, json.dumps(params), ["-"], stdin=json.dumps(config).encode())
+            run.params = params
+            run.digest = digest
+            yield run
+
+    references = engine.stackfile_references(sweep.includes())
+    if references is not None:
+        references |= sweep.references()
+    try:
+        batch.run(runs(), references=references)
+    except SweepError as err:
+        raise click.ClickException(str(err))
+
+    outcomes = ", ".join(f"{v} {k}" for k, v in sorted(batch.outcomes().items()))
+    print(
+        f"Ran {len(batch.runs)} of {sweep.size()} simulations "
+        f"in {batch.duration:.1f}s: {outcomes}"
+    )
+    print(f"Summary: {batch.summary_path()}")
+    sys.exit(exit_code_from_runs(batch.runs))
+
+
+# _________________________________________________________________________
+# Command: submit [--base=STACKFILE] [--file-list=FILE] [--require-success]
+#                 [--wait] [--profile=PROFILE | --profile-path=CONANFILE]
+#                 SPOOL [--] STACKFILES...
+@main.command("submit")
+@options.profile()
+@options.profile_path()
+@click.option(
+    "-b",
+    "--base",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False),
+    multiple=True,
+    help="Stackfile to merge before each stackfile.",
+)
+@click.option(
+    "-f",
+    "--file-list",
+    type=click.File("r"),
+    default=None,
+    help="File with one stackfile per line to submit, - for stdin.",
+)
+@click.option(
+    "--require-success",
+    is_flag=True,
+    help="Treat simulations that are stopped without success as failures.",
+)
+@click.option(
+    "-w",
+    "--wait",
+    is_flag=True,
+    help="Wait until all submitted jobs are done.",
+)
+@click.argument("spool", type=click.Path(file_okay=False, dir_okay=True))
+@click.argument("stackfiles", nargs=-1)
+@click.pass_obj
+def cli_submit(
+    opt,
+    profile: str,
+    profile_path: str,
+    base: List[str],
+    file_list,
+    require_success: bool,
+    wait: bool,
+    spool: str,
+    stackfiles: List[str],
+) -> None:
+    """Submit stackfiles as jobs to the SPOOL directory.
+
+    Each of the STACKFILES, and each stackfile listed in --file-list, is a
+    job that is run by a worker (see the worker command) with the profile.
+    Paths are made absolute, so SPOOL, the stackfiles, and the profile path
+    need to be accessible under the same paths to all workers.
+
+    With --wait, the outcome of each job is printed as it is done, and the
+    exit code combines the exit codes of all jobs, as in the batch command.
+    """
+    options.deny_profile_and_path(profile, profile_path)
+    from cloe_launch.batch import exit_code_from_codes
+    from cloe_launch.spool import Spool
+    from cloe_launch.spool import make_job
+
+    files = list(stackfiles)
+    if file_list is not None:
+        files.extend(x.strip() for x in file_list if x.strip() != "")
+    if not files:
+        raise click.UsageError("no stackfiles to submit")
+    for file in list(base) + files:
+        if not os.path.isfile(file):
+            raise click.UsageError(f"not a stackfile: {file}")
+
+    # The profile name is resolved here, since the default profile of the
+    # workers may differ.
+    if profile_path is None:
+        profile = Configuration(profile).current_profile
+        if profile is None:
+            raise ConfigurationError("no default profile is configured")
+
+    queue = Spool(Path(spool))
+    queue.init()
+    job_ids = []
+    for file in files:
+        job = make_job(list(base) + [file], file, profile, profile_path, require_success)
+        job_ids.append(queue.submit(job))
+        print(f"{job_ids[-1]}  {file}", flush=True)
+    if not wait:
+        return
+
+    start = time.time()
+    pending = set(job_ids)
+    records = []
+    while pending:
+        for job_id in sorted(pending):
+            record = queue.record(job_id)
+            if record is None:
+                continue
+            pending.remove(job_id)
+            records.append(record)
+            name = record.get("job", record).get("name", "")
+            outcome = record.get("outcome", "failed")
+            seconds = record.get("duration", 0.0)
+            print(f"{outcome:<9} {seconds:8.2f}s  {job_id}  {name}", flush=True)
+        if pending:
+            time.sleep(1.0)
+
+    duration = max(time.time() - start, 1e-3)
+    outcomes: Dict[str, int] = {}
+    for record in records:
+        outcome = record.get("outcome", "failed")
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    workers = {x["worker"] for x in records if "worker" in x}
+    print(
+        f"Ran {len(records)} jobs in {duration:.1f}s "
+        f"({len(records) / duration * 60:.1f} jobs/min) on {len(workers)} workers: "
+        + ", ".join(f"{v} {k}" for k, v in sorted(outcomes.items()))
+    )
+    sys.exit(exit_code_from_codes(x.get("exit_code") for x in records))
+
+
+# _________________________________________________________________________
+# Command: worker [--cache] [--result-cache] [--jobs=N] [--lease=SECONDS]
+#                 [--poll-interval=SECONDS] [--max-jobs=N] [--drain]
+#                 SPOOL
+@main.command("worker")
+@options.cache()
+@options.result_cache()
+@click.option(
+    "-j",
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Number of jobs to run concurrently.",
+)
+@click.option(
+    "--lease",
+    type=click.FloatRange(min=1.0),
+    default=300.0,
+    show_default=True,
+    help="Seconds after which jobs of a worker that stopped responding are run again.",
+)
+@click.option(
+    "--poll-interval",
+    type=click.FloatRange(min=0.1),
+    default=2.0,
+    show_default=True,
+    help="Seconds to wait before looking for new jobs.",
+)
+@click.option(
+    "-n",
+    "--max-jobs",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Stop after running this many jobs.",
+)
+@click.option(
+    "--drain",
+    is_flag=True,
+    help="Stop when there are no more jobs.",
+)
+@click.argument("spool", type=click.Path(file_okay=False, dir_okay=True))
+@click.pass_obj
+def cli_worker(
+    opt,
+    cache: bool,
+    result_cache: bool,
+    jobs: int,
+    lease: float,
+    poll_interval: float,
+    max_jobs: Optional[int],
+    drain: bool,
+    spool: str,
+) -> None:
+    """Run jobs from the SPOOL directory until stopped.
+
+    Jobs are claimed atomically, so any number of workers can share SPOOL,
+    also on different machines with a shared file system. The runtime
+    environment of the profile of each job is prepared locally, or re-used
+    if it is up-to-date.
+
+    Results of each job are written to results/ in SPOOL. If a worker
+    crashes, the jobs it was running are run again by another worker once
+    their lease expires. The lease should be much longer than it takes for
+    file modification times to be visible to all workers.
+
+    At the end, the number of jobs run per minute is printed.
+    """
+    from cloe_launch.spool import Spool
+    from cloe_launch.spool import Worker
+
+    worker = Worker(
+        Spool(Path(spool)),
+        workers=jobs,
+        lease=lease,
+        poll_interval=poll_interval,
+        use_cache=cache,
+        result_cache=Configuration().result_cache() if result_cache else None,
+    )
+    stats = worker.run(max_jobs=max_jobs, drain=drain)
+    outcomes = ", ".join(f"{v} {k}" for k, v in sorted(stats["outcomes"].items()))
+    print(
+        f"Worker {stats['worker']} ran {stats['jobs']} jobs "
+        f"({stats['jobs_per_minute']:.1f} jobs/min, "
+        f"{stats['utilization'] * 100:.0f}% utilization): {outcomes}"
+    )
+
+
+# _________________________________________________________________________
+# Command: runs (index | list | query)
+@main.group("runs")
+def cli_runs():
+    """Find simulation runs in the run index.
+
+    The run index is an SQLite database of the outcome, statistics, and
+    output files of simulation runs. It is updated incrementally from the
+    registry of cloe-engine, or the paths configured in the runs_index
+    section of the configuration, before it is queried. Runs of the batch
+    and sweep commands are added to it when they are done.
+    """
+
+
+def _open_runs_index(conf: Configuration, update: bool, paths: List[Path] = None):
+    index = conf.runs_index()
+    if index is None:
+        raise click.ClickException("run index is disabled in the configuration")
+    if update:
+        index.update(paths or conf.runs_index_paths())
+    return index
+
+
+def _print_rows(names: List[str], rows: List, as_json: bool) -> None:
+    if as_json:
+        for row in rows:
+            print(json.dumps(dict(zip(names, row))))
+        return
+    table = [names] + [["" if x is None else str(x) for x in row] for row in rows]
+    widths = [max(len(row[i]) for row in table) for i in range(len(names))]
+    for row in table:
+        print("  ".join(x.ljust(w) for x, w in zip(row, widths)).rstrip())
+
+
+# _________________________________________________________________________
+# Command: runs index [--prune] [PATHS...]
+@cli_runs.command("index")
+@click.option(
+    "--prune",
+    is_flag=True,
+    help="Remove runs whose output directory no longer exists.",
+)
+@click.argument("paths", nargs=-1, type=click.Path(file_okay=False, dir_okay=True))
+@click.pass_obj
+def cli_runs_index(opt, prune: bool, paths: List[str]) -> None:
+    """Update the run index from directories of runs.
+
+    Each directory in PATHS contains one directory per run, such as the
+    registry of cloe-engine or the output directory of the batch command.
+    Without PATHS, the configured directories are indexed.
+    """
+    import sqlite3
+
+    start = time.monotonic()
+    conf = Configuration()
+    try:
+        index = _open_runs_index(conf, False)
+        added, removed = index.update([Path(x) for x in paths] or conf.runs_index_paths())
+        if prune:
+            removed += index.prune()
+        total = index.query("SELECT count(*) FROM runs")[1][0][0]
+    except sqlite3.Error as err:
+        raise click.ClickException(f"cannot update run index: {err}")
+    print(
+        f"Indexed {added} and removed {removed} runs in {time.monotonic() - start:.2f}s, "
+        f"{total} runs in {index.path}"
+    )
+
+
+# _________________________________________________________________________
+# Command: runs list [--since=AGE] [--outcome=OUTCOME] [--profile=PROFILE]
+#                    [--where=EXPR] [--limit=N] [--json] [--no-update]
+@cli_runs.command("list")
+@click.option(
+    "-s",
+    "--since",
+    type=click.STRING,
+    help="Only list runs that finished within this age, such as 7d or 12h.",
+)
+@click.option(
+    "-o",
+    "--outcome",
+    type=click.STRING,
+    multiple=True,
+    help="Only list runs with this outcome.",
+)
+@click.option(
+    "-p",
+    "--profile",
+    type=click.STRING,
+    help="Only list runs launched with this profile.",
+)
+@click.option(
+    "-w",
+    "--where",
+    type=click.STRING,
+    help="Only list runs that match this SQL expression.",
+)
+@click.option(
+    "-n",
+    "--limit",
+    type=click.IntRange(min=0),
+    default=50,
+    show_default=True,
+    help="Maximum number of runs to list, 0 for all.",
+)
+@click.option("--json", "as_json", is_flag=True, help="Print one JSON object per run.")
+@click.option(
+    "--update/--no-update",
+    default=True,
+    show_default=True,
+    help="Update the run index before listing.",
+)
+@click.pass_obj
+def cli_runs_list(
+    opt,
+    since: Optional[str],
+    outcome: List[str],
+    profile: Optional[str],
+    where: Optional[str],
+    limit: int,
+    as_json: bool,
+    update: bool,
+) -> None:
+    """List the most recent runs in the run index.
+
+    For example, to list failed runs of the last week whose cycle time
+    exceeded 20 ms:
+
+        cloe-launch runs list -s 7d -o failure -w "cycle_time_ms_max > 20"
+    """
+    import sqlite3
+
+    from cloe_launch.registry import parse_since
+
+    conditions = []
+    params: List = []
+    if since is not None:
+        try:
+            params.append(parse_since(since))
+        except ValueError as err:
+            raise click.BadParameter(str(err), param_hint="--since")
+        conditions.append("coalesce(finished, launched) >= ?")
+    if outcome:
+        conditions.append(f"outcome IN ({', '.join('?' * len(outcome))})")
+        params.extend(outcome)
+    if profile is not None:
+        conditions.append("profile = ?")
+        params.append(profile)
+    if where is not None:
+        conditions.append(f"({where})")
+    columns = "*" if as_json else (
+        "uuid, datetime(coalesce(finished, launched), 'unixepoch', 'localtime') AS time, "
+        "outcome, profile, round(elapsed_s, 3) AS elapsed_s, "
+        "round(cycle_time_ms_max, 3) AS cycle_time_ms_max, output_dir"
+    )
+    sql = f"SELECT {columns} FROM runs"
+    if conditions:
+        sql += f" WHERE {' AND '.join(conditions)}"
+    sql += " ORDER BY coalesce(finished, launched) DESC"
+    if limit > 0:
+        sql += f" LIMIT {limit}"
+
+    try:
+        index = _open_runs_index(Configuration(), update)
+        names, rows = index.query(sql, params)
+    except sqlite3.Error as err:
+        raise click.ClickException(f"cannot query run index: {err}")
+    _print_rows(names, rows, as_json)
+
+
+# _________________________________________________________________________
+# Command: runs query [--json] [--no-update] SQL [PARAMS...]
+@cli_runs.command("query")
+@click.option("--json", "as_json", is_flag=True, help="Print one JSON object per row.")
+@click.option(
+    "--update/--no-update",
+    default=True,
+    show_default=True,
+    help="Update the run index before querying.",
+)
+@click.argument("sql", type=click.STRING)
+@click.argument("params", nargs=-1, type=click.STRING)
+@click.pass_obj
+def cli_runs_query(opt, as_json: bool, update: bool, sql: str, params: List[str]) -> None:
+    """Run an SQL query on the run index.
+
+    The runs table contains one row per run; see the documentation for its
+    columns. PARAMS are bound to the ? placeholders in SQL. For example:
+
+    \b
+        cloe-launch runs query \\
+          "SELECT profile, outcome, count(*), avg(cycle_time_ms_mean)
+           FROM runs GROUP BY profile, outcome"
+    """
+    import sqlite3
+
+    try:
+        index = _open_runs_index(Configuration(), update)
+        names, rows = index.query(sql, params)
+    except sqlite3.Error as err:
+        raise click.ClickException(f"cannot query run index: {err}")
+    _print_rows(names, rows, as_json)
+
+
+# _________________________________________________________________________
+# Command: report [--group-by=FIELD] [--metric=METRIC] [--baseline=FILE]
+#                 [--save-baseline=FILE] [--threshold=RATIO] [--significance=T]
+#                 [--json] PATHS...
+@main.command("report")
+@click.option(
+    "-g",
+    "--group-by",
+    type=click.Choice(["scenario", "plugins", "stack"]),
+    multiple=True,
+    default=["scenario", "plugins"],
+    show_default=True,
+    help="Fields to group runs by.",
+)
+@click.option(
+    "-m",
+    "--metric",
+    type=click.STRING,
+    multiple=True,
+    help="Metric to compare with the baseline. [default: engine, simulator, "
+    "and controller time, and achievable realtime factor]",
+)
+@click.option(
+    "-b",
+    "--baseline",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False),
+    help="Report to compare with.",
+)
+@click.option(
+    "-s",
+    "--save-baseline",
+    type=click.Path(file_okay=True, dir_okay=False),
+    help="Write the report to this file, to be compared with later.",
+)
+@click.option(
+    "-t",
+    "--threshold",
+    type=click.FloatRange(min=0),
+    default=0.05,
+    show_default=True,
+    help="Relative change of a metric that is a regression.",
+)
+@click.option(
+    "--significance",
+    type=click.FloatRange(min=0),
+    default=3.0,
+    show_default=True,
+    help="Standard errors by which a change must be significant.",
+)
+@click.option("--json", "as_json", is_flag=True, help="Print the report as JSON.")
+@click.argument("paths", nargs=-1, required=True, type=click.Path(exists=True))
+@click.pass_obj
+def cli_report(
+    opt,
+    group_by: List[str],
+    metric: List[str],
+    baseline: Optional[str],
+    save_baseline: Optional[str],
+    threshold: float,
+    significance: float,
+    as_json: bool,
+    paths: List[str],
+) -> None:
+    """Aggregate simulation results and compare them with a baseline.
+
+    PATHS are result files, or directories that are searched for result
+    files, such as the output of the batch command or the registry of
+    cloe-engine. The statistics of each run, such as the mean and maximum
+    engine time per cycle, are aggregated into percentiles for each group of
+    runs. The metrics are the {mean,max} of cycle_time_ms, engine_time_ms,
+    simulator_time_ms, controller_time_ms, padding_time_ms, and
+    controller_retries, as well as elapsed_s, realtime_factor, and
+    achievable_realtime_factor.
+
+    With --baseline, each metric is compared with the same group in the
+    baseline. A metric regresses if its mean is worse by more than
+    --threshold and the difference is more than --significance standard
+    errors. The exit code is 1 if any metric regresses.
+
+    This requires NumPy.
+    """
+    from cloe_launch.report import ReportError
+    from cloe_launch.report import ResultTable
+    from cloe_launch.report import compare
+    from cloe_launch.report import default_gates
+    from cloe_launch.report import find_results
+    from cloe_launch.report import format_comparison
+    from cloe_launch.report import format_report
+    from cloe_launch.report import metrics
+
+    gates = list(metric) or default_gates
+    for name in gates:
+        if name not in metrics:
+            raise click.BadParameter(f"unknown metric: {name}", param_hint="--metric")
+
+    try:
+        table = ResultTable(list(group_by))
+        table.extend(find_results(Path(x) for x in paths))
+        if table.runs() == 0:
+            raise click.ClickException("no simulation results found")
+        report = table.aggregate()
+
+        comparisons = None
+        if baseline is not None:
+            with open(baseline) as file:
+                comparisons = compare(report, json.load(file), gates, threshold, significance)
+    except (ReportError, ValueError) as err:
+        raise click.ClickException(str(err))
+
+    if save_baseline is not None:
+        with open(save_baseline, "w") as file:
+            json.dump(report, file, indent=2)
+            file.write("\n")
+
+    if as_json:
+        if comparisons is not None:
+            report = dict(report, comparisons=comparisons)
+        print(json.dumps(report, indent=2))
+    else:
+        print(format_report(report, metrics))
+        if comparisons is not None:
+            print()
+            print(format_comparison(comparisons))
+
+    regressions = [x for x in comparisons or [] if x["status"] == "regression"]
+    if regressions:
+        print(f"Found {len(regressions)} regressions", file=sys.stderr)
+        sys.exit(1)
+
+
+# _________________________________________________________________________
+# Command: check [--cache] [--check-cache] [--jobs=N] [--format=FORMAT] [--output=FILE]
+#                [--profile=PROFILE | --profile-path=CONANFILE]
+#                [--] STACKFILES...
+@main.command("check")
+@options.profile()
+@options.profile_path()
+@options.conan_arg()
+@options.conan_option()
+@options.conan_setting()
+@options.preserve_env()
+@options.cache()
+@click.option(
+    "--check-cache/--no-check-cache",
+    is_flag=True,
+    default=True,
+    show_default=True,
+    help="Re-use verdicts of stackfiles that have not changed.",
+)
+@click.option(
+    "-j",
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=os.cpu_count() or 1,
+    show_default=True,
+    help="Number of cloe-engine processes to run concurrently.",
+)
+@click.option(
+    "-f",
+    "--format",
+    "output_format",
+    type=click.Choice(["text", "json", "junit"]),
+    default="text",
+    show_default=True,
+    help="Format of the report.",
+)
+@click.option(
+    "-o",
+    "--output",
+    type=click.File("w"),
+    default="-",
+    help="File to write the report to.",
+)
+@click.argument("stackfiles", nargs=-1, required=True)
+@click.pass_obj
+def cli_check(
+    opt,
+    profile: str,
+    profile_path: str,
+    conan_arg: List[str],
+    conan_option: List[str],
+    conan_setting: List[str],
+    preserve_env: bool,
+    cache: bool,
+    check_cache: bool,
+    jobs: int,
+    output_format: str,
+    output,
+    stackfiles: List[str],
+) -> None:
+    """Validate many stackfiles with a profile.
+
+    STACKFILES can be files, glob patterns such as 'tests/**/*.json', or
+    directories, which are searched for JSON and YAML stackfiles. Each
+    stackfile is validated on its own, as with `cloe-engine check --distinct`,
+    by up to --jobs cloe-engine processes that validate many stackfiles each.
+
+    The verdict of each stackfile is cached by the content of the stackfile
+    and all stackfiles it includes, the cloe-engine and plugin binaries, and
+    the environment variables the stackfiles refer to, so that only changed
+    stackfiles are validated again.
+
+    The exit code is 1 if any stackfile is invalid.
+    """
+    options.deny_profile_and_path(profile, profile_path)
+    from cloe_launch.check import CheckCache
+    from cloe_launch.check import Checker
+    from cloe_launch.check import Verdict
+    from cloe_launch.check import expand_stackfiles
+    from cloe_launch.check import junit_report
+    from cloe_launch.exec import Engine
+
+    start = time.monotonic()
+    files = expand_stackfiles(list(stackfiles))
+    if not files:
+        raise click.UsageError("no stackfiles to check")
+
+    conf = Configuration(profile)
+    engine = Engine(conf, conanfile=profile_path)
+    engine.conan_args = list(conan_arg)
+    engine.conan_options = list(conan_option)
+    engine.conan_settings = list(conan_setting)
+    engine.preserve_env = preserve_env
+    env = engine.runtime_env(use_cache=cache)
+    engine.engine_path = env["CLOE_ENGINE"]
+
+    # YAML stackfiles are validated in the JSON version that cloe-engine
+    # reads, but reported by their own name.
+    compiled = {}
+    verdicts = []
+    for file in files:
+        try:
+            compiled[file] = engine.compile_stackfiles([file])[0]
+        except StackfileError as err:
+            compiled[file] = None
+            logging.info(f"Cannot convert stackfile: {err}")
+            verdicts.append((file, str(err)))
+
+    # The checker appends the check subcommand and the stackfiles.
+    checker = Checker(
+        [engine.engine_path] + engine.engine_pre_args,
+        dict(env.as_dict()),
+        cache=CheckCache(Path(conf.check_cache_file)) if check_cache else None,
+        workers=jobs,
+    )
+    results = checker.check([x for x in compiled.values() if x is not None])
+    if checker.cache is not None:
+        checker.cache.save()
+
+    by_file = {x.file: x for x in results}
+    errors = dict(verdicts)
+    report = []
+    for file in files:
+        if compiled[file] is None:
+            report.append(Verdict(file, False, errors[file]))
+            continue
+        verdict = by_file[compiled[file]]
+        verdict.file = file
+        report.append(verdict)
+    duration = time.monotonic() - start
+
+    invalid = [x for x in report if not x.ok]
+    if output_format == "json":
+        json.dump(
+            {
+                "duration": round(duration, 3),
+                "checked": len(report),
+                "invalid": len(invalid),
+                "cached": sum(1 for x in report if x.cached),
+                "files": [x.summary() for x in report],
+            },
+            output,
+            indent=2,
+        )
+        output.write("\n")
+    elif output_format == "junit":
+        output.write(junit_report(report, duration) + "\n")
+    else:
+        for verdict in invalid:
+            output.write(f"{verdict.file}: {verdict.message()}\n")
+    cached = sum(1 for x in report if x.cached)
+    print(
+        f"Checked {len(report)} stackfiles in {duration:.2f}s ({cached} cached): "
+        f"{len(invalid)} invalid",
+        file=sys.stderr,
+    )
+    if invalid:
+        sys.exit(1)
+
+
 # _________________________________________________________________________
 # Command: shell [--cache] [--profile=PROFILE | --profile-path=CONANFILE]
 @main.command("shell")
@@ -246,6 +1359,8 @@ def cli_shell(
 ) -> None:
     """Launch shell with the correct environment from a profile."""
     options.deny_profile_and_path(profile, profile_path)
+    from cloe_launch.exec import Engine
+
     conf = Configuration(profile)
     engine = Engine(conf, conanfile=profile_path)
     engine.preserve_env = preserve_env
@@ -304,6 +1419,8 @@ def cli_activate(
       behavior: it can lead to unexpected problems.
     """
     options.deny_profile_and_path(profile, profile_path)
+    from cloe_launch.exec import Engine
+
     conf = Configuration(profile)
     engine = Engine(conf, conanfile=profile_path)
     engine.conan_args = list(conan_arg)
@@ -314,13 +1431,30 @@ def cli_activate(
 
 
 # _________________________________________________________________________
-# Command: prepare [--cache] [--profile=PROFILE | --profile-path=CONANFILE]
+# Command: prepare [--profile=PROFILE | --profile-path=CONANFILE]
+#                  [--all | PROFILES...] [--jobs=N]
 @main.command("prepare")
 @options.profile()
 @options.profile_path()
 @options.conan_arg()
 @options.conan_option()
 @options.conan_setting()
+@click.option(
+    "-a",
+    "--all",
+    "all_profiles",
+    is_flag=True,
+    help="Prepare all profiles.",
+)
+@click.option(
+    "-j",
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Number of profiles to prepare concurrently.",
+)
+@click.argument("profiles", nargs=-1)
 @click.pass_obj
 def cli_prepare(
     opt,
@@ -329,13 +1463,39 @@ def cli_prepare(
     conan_arg: List[str],
     conan_option: List[str],
     conan_setting: List[str],
+    all_profiles: bool,
+    jobs: int,
+    profiles: List[str],
 ) -> None:
     """Prepare environment for selected profile.
 
     This involves downloading missing and available packages and building
     outdated packages.
+
+    If --all or several PROFILES are given, these profiles are prepared
+    concurrently with up to --jobs workers. Packages that need to be built
+    for several profiles are only built once. The Conan output of each
+    profile is written to a log file in its runtime directory, and a summary
+    is printed at the end.
     """
     options.deny_profile_and_path(profile, profile_path)
+    if all_profiles or profiles:
+        if profile is not None or profile_path is not None:
+            raise click.UsageError(
+                "--profile and --profile-path options cannot be combined with --all or PROFILES"
+            )
+        _prepare_many(
+            list(profiles),
+            all_profiles,
+            jobs,
+            conan_arg,
+            conan_option,
+            conan_setting,
+        )
+        return
+
+    from cloe_launch.exec import Engine
+
     conf = Configuration(profile)
     engine = Engine(conf, conanfile=profile_path)
     engine.conan_args = list(conan_arg)
@@ -351,6 +1511,88 @@ def cli_prepare(
         sys.exit(1)
 
 
+def _prepare_many(
+    profiles: List[str],
+    all_profiles: bool,
+    jobs: int,
+    conan_arg: List[str],
+    conan_option: List[str],
+    conan_setting: List[str],
+) -> None:
+    from cloe_launch.exec import Engine
+    from cloe_launch.prepare import PrepareJob
+    from cloe_launch.prepare import prepare_profiles
+    from cloe_launch.prepare import print_summary
+
+    conf = Configuration()
+    if all_profiles:
+        profiles = sorted(set(profiles) | set(conf.all_profiles))
+    prepare_jobs = []
+    for name in profiles:
+        if name not in conf.all_profiles:
+            raise ConfigurationError(f"profile {name} does not exist")
+        conf.set_current(name)
+        engine = Engine(conf)
+        engine.conan_args = list(conan_arg)
+        engine.conan_options = list(conan_option)
+        engine.conan_settings = list(conan_setting)
+        prepare_jobs.append(PrepareJob(name, engine))
+
+    prepare_profiles(prepare_jobs, workers=jobs)
+    print_summary(prepare_jobs)
+    if any(job.failed() for job in prepare_jobs):
+        sys.exit(1)
+
+
+# _________________________________________________________________________
+# Command: lock [--remove] [--profile=PROFILE | --profile-path=CONANFILE]
+@main.command("lock")
+@options.profile()
+@options.profile_path()
+@options.conan_arg()
+@options.conan_option()
+@options.conan_setting()
+@click.option(
+    "--remove",
+    is_flag=True,
+    help="Remove the lockfile instead of creating it.",
+)
+@click.pass_obj
+def cli_lock(
+    opt,
+    profile: str,
+    profile_path: str,
+    conan_arg: List[str],
+    conan_option: List[str],
+    conan_setting: List[str],
+    remove: bool,
+) -> None:
+    """Pin the dependency graph of the selected profile in a lockfile.
+
+    The lockfile is stored in the runtime cache and is used by the exec,
+    shell, activate, and prepare commands for the same profile, Conan
+    arguments, options, and settings. Run this command again to update
+    the lockfile.
+    """
+    options.deny_profile_and_path(profile, profile_path)
+    from cloe_launch.exec import Engine
+
+    conf = Configuration(profile)
+    engine = Engine(conf, conanfile=profile_path)
+    engine.conan_args = list(conan_arg)
+    engine.conan_options = list(conan_option)
+    engine.conan_settings = list(conan_setting)
+
+    if remove:
+        engine.unlock()
+        return
+
+    try:
+        print(engine.lock())
+    except ChildProcessError:
+        sys.exit(1)
+
+
 # _________________________________________________________________________
 # Command: clean [--profile PROFILE | --profile-path=CONANFILE]
 @main.command("clean")
@@ -360,11 +1602,241 @@ def cli_prepare(
 def cli_clean(opt, profile: str, profile_path: str) -> None:
     """Clean launcher profile cache."""
     options.deny_profile_and_path(profile, profile_path)
+    from cloe_launch.exec import Engine
+
     conf = Configuration(profile)
     engine = Engine(conf, conanfile=profile_path)
     engine.clean()
 
 
+# _________________________________________________________________________
+# Command: bundle (create | run)
+@main.group("bundle")
+def cli_bundle():
+    """Export profiles into relocatable bundles and run them.
+
+    A bundle contains cloe-engine, the shared libraries of all packages,
+    and the plugins of a prepared profile, with the environment of the
+    profile. It can be copied to machines without Conan and run there.
+    """
+
+
+# _________________________________________________________________________
+# Command: bundle create [--force] [--profile=PROFILE | --profile-path=CONANFILE] OUTPUT
+@cli_bundle.command("create")
+@options.profile()
+@options.profile_path()
+@options.conan_arg()
+@options.conan_option()
+@options.conan_setting()
+@options.cache()
+@click.option(
+    "-f",
+    "--force",
+    is_flag=True,
+    help="Replace an existing bundle.",
+)
+@click.argument("output", type=click.Path(dir_okay=True, file_okay=True))
+@click.pass_obj
+def cli_bundle_create(
+    opt,
+    profile: str,
+    profile_path: str,
+    conan_arg: List[str],
+    conan_option: List[str],
+    conan_setting: List[str],
+    cache: bool,
+    force: bool,
+    output: str,
+) -> None:
+    """Export the profile into a bundle at OUTPUT.
+
+    If OUTPUT ends with .tar.gz, .tgz, or .tar, the bundle is written as a
+    tarball, otherwise as a directory. The profile is prepared first, if
+    necessary.
+
+    Libraries that the packages do not contain, such as the C library, are
+    not bundled and must be installed where the bundle is run. Environment
+    variables that refer to package directories that are not bundled are
+    reported.
+    """
+    options.deny_profile_and_path(profile, profile_path)
+    from cloe_launch.bundle import BundleError
+    from cloe_launch.bundle import create_bundle
+    from cloe_launch.exec import Engine
+
+    conf = Configuration(profile)
+    engine = Engine(conf, conanfile=profile_path)
+    engine.conan_args = list(conan_arg)
+    engine.conan_options = list(conan_option)
+    engine.conan_settings = list(conan_setting)
+
+    try:
+        env = engine.runtime_env(use_cache=cache)
+        manifest = create_bundle(engine, env, Path(output), force=force)
+    except ChildProcessError:
+        sys.exit(1)
+    except BundleError as err:
+        raise click.ClickException(str(err))
+    print(f"Bundle: {output} ({len(manifest['packages'])} packages)")
+
+
+# _________________________________________________________________________
+# Command: bundle run [--preserve-env] [--override-env=VAR] BUNDLE [--] ENGINE_ARGS
+@cli_bundle.command("run")
+@options.preserve_env()
+@click.option(
+    "-e",
+    "--override-env",
+    multiple=True,
+    type=click.STRING,
+    help="Use environment variable as set or preserve.",
+)
+@click.option(
+    "--concurrent-setup/--sequential-setup",
+    default=None,
+    help="Set up and tear down plugins concurrently. [default: from configuration]",
+)
+@click.argument("bundle", type=click.Path(exists=True, dir_okay=True, file_okay=True))
+@click.argument("engine_args", nargs=-1)
+@click.pass_obj
+def cli_bundle_run(
+    opt,
+    preserve_env: bool,
+    override_env: List[str],
+    concurrent_setup: Optional[bool],
+    bundle: str,
+    engine_args: List[str],
+) -> None:
+    """Launch cloe-engine from the bundle at BUNDLE.
+
+    BUNDLE is a bundle directory or tarball; tarballs are unpacked into the
+    bundle cache the first time they are run. ENGINE_ARGS are passed on to
+    cloe-engine. Neither Conan nor a profile is required.
+    """
+    from cloe_launch.bundle import BundleEngine
+    from cloe_launch.bundle import BundleError
+    from cloe_launch.bundle import open_bundle
+
+    conf = Configuration()
+    try:
+        bundle_dir = open_bundle(Path(bundle), Path(conf.bundles_dir))
+        engine = BundleEngine(conf, bundle_dir)
+    except BundleError as err:
+        raise click.ClickException(str(err))
+    engine.preserve_env = preserve_env
+    if concurrent_setup is not None:
+        engine.concurrent_plugin_setup = concurrent_setup
+
+    # Prepare environment overrides:
+    overrides = {}
+    for line in override_env:
+        kv = line.split("=", 1)
+        if len(kv) == 1:
+            kv.append(os.getenv(kv[0], ""))
+        overrides[kv[0]] = kv[1]
+
+    launched = time.time()
+    result = engine.exec(engine_args, override_env=overrides)
+    if engine.run_uuid is not None:
+        _record_launch(conf, engine, result.returncode, launched)
+    sys.exit(result.returncode)
+
+
+# _________________________________________________________________________
+# Command: cache (stats | gc)
+@main.group("cache")
+def cli_cache():
+    """Show and limit the size of the runtime cache.
+
+    The runtime cache contains the runtime directories of all profiles. The
+    least recently used runtime directories are evicted automatically,
+    according to the runtime_cache section of the configuration, unless
+    they are in use by a running cloe-launch.
+    """
+
+
+def _format_size(size: int) -> str:
+    for unit in ["B", "KiB", "MiB", "GiB"]:
+        if size < 1024 or unit == "GiB":
+            break
+        size /= 1024
+    return f"{size:.1f} {unit}" if unit != "B" else f"{size} B"
+
+
+# _________________________________________________________________________
+# Command: cache stats [--json]
+@cli_cache.command("stats")
+@click.option("--json", "as_json", is_flag=True, help="Print statistics as JSON.")
+@click.pass_obj
+def cli_cache_stats(opt, as_json: bool) -> None:
+    """Show the size and use of the runtime cache."""
+    conf = Configuration()
+    stats = conf.runtime_cache().stats()
+    if as_json:
+        print(json.dumps(stats, indent=2))
+        return
+    print(f"Runtime cache: {stats['path']}")
+    print(
+        f"  {stats['runtime_dirs']} runtime directories in {len(stats['profiles'])} profiles, "
+        f"{_format_size(stats['size'])} of {_format_size(stats['max_size'])}"
+    )
+    print(f"  {stats['in_use']} in use, oldest unused for {stats['oldest_age'] / 86400:.1f} days")
+    print(f"  {stats['stale_files']} stale files, {_format_size(stats['stale_size'])}")
+    for name, profile in sorted(stats["profiles"].items()):
+        used = time.strftime("%Y-%m-%d %H:%M", time.localtime(profile["last_used"]))
+        size = _format_size(profile["size"])
+        print(f"  {name:<40} {profile['runtime_dirs']:>4} {size:>10}  {used}")
+
+
+# _________________________________________________________________________
+# Command: cache gc [--max-size=MB] [--max-age=DAYS] [--dry-run]
+@cli_cache.command("gc")
+@click.option(
+    "--max-size",
+    type=click.IntRange(min=0),
+    help="Maximum size of the runtime cache in MiB, 0 for no limit. [default: configured]",
+)
+@click.option(
+    "--max-age",
+    type=click.FloatRange(min=0),
+    help="Maximum days since a runtime directory was used, 0 for no limit. [default: configured]",
+)
+@click.option(
+    "-n",
+    "--dry-run",
+    is_flag=True,
+    help="Only print what would be removed.",
+)
+@click.pass_obj
+def cli_cache_gc(opt, max_size: Optional[int], max_age: Optional[float], dry_run: bool) -> None:
+    """Evict runtime directories and remove stale files from the runtime cache.
+
+    Runtime directories that have not been used for the maximum age are
+    evicted, and then the least recently used ones until the cache fits into
+    the maximum size. Runtime directories that are in use are kept. Stale
+    files are copies of relayed anonymous files and temporary files whose
+    cloe-launch process has exited.
+    """
+    conf = Configuration()
+    cache = conf.runtime_cache()
+    if max_size is not None:
+        cache.max_size = max_size << 20
+    if max_age is not None:
+        cache.max_age = max_age * 86400
+    result = cache.gc(dry_run=dry_run)
+    for path in result["evicted"] + result["removed"]:
+        if dry_run:
+            print(f"Would remove: {path}")
+        else:
+            logging.info(f"Remove: {path}")
+    print(
+        f"{'Would evict' if dry_run else 'Evicted'} {len(result['evicted'])} runtime directories "
+        f"and {len(result['removed'])} stale files, {_format_size(result['freed'])}; "
+        f"{_format_size(result['size'])} remain"
+    )
+
+
 # _________________________________________________________________________
 # Command: profile (show | list | add | edit | remove | default)
 @main.group("profile")
@@ -483,6 +1955,10 @@ def entry_point():
         main()
     except ConfigurationError as e:
         print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    except StackfileError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
 
 
 if __name__ == "__main__":
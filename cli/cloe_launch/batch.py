@@ -0,0 +1,430 @@
+# pylint: disable=logging-fstring-interpolation
+
+"""
+This module contains the execution of many simulations in one batch.
+
+The runtime environment and the plugin setups of the profile are prepared
+once, after which each stackfile is run by its own cloe-engine process in a
+bounded pool of workers. Each run gets its own simulation UUID and its own
+directory, which contains the registry and output of cloe-engine, as well
+as the captured stdout and stderr. A summary of all runs is written to the
+output directory at the end.
+
+If a result cache is given, the merged stack of each run is dumped first,
+and if a run with the same inputs has been cached, its result and output
+are copied instead of running the simulation again.
+
+If a run index is given, each run is added to it once it is done, together
+with the profile it was run with.
+
+If a telemetry interval is given, the resource usage of each cloe-engine
+process is sampled into telemetry.csv in the run directory, and its peak and
+mean values are added to the summary of the run.
+"""
+
+import json
+import logging
+import shutil
+import sqlite3
+import subprocess
+import time
+import uuid
+
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from pathlib import Path
+from typing import Any
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Set
+
+from cloe_launch.exec import Engine
+from cloe_launch.exec import Environment
+from cloe_launch.exec import PluginSetup
+from cloe_launch.registry import RunIndex
+from cloe_launch.results import ResultCache
+from cloe_launch.telemetry import Sampler
+
+# These correspond to the EXIT_OUTCOME_* definitions in cloe-engine.
+# The codes are not all distinct bits, but they are designed to be combined.
+EXIT_OUTCOME_SUCCESS = 0
+EXIT_OUTCOME_UNKNOWN = 1
+EXIT_OUTCOME_NOSTART = 4
+EXIT_OUTCOME_STOPPED = 8
+EXIT_OUTCOME_FAILURE = 9
+EXIT_OUTCOME_ABORTED = 16
+
+exit_outcomes = {
+    EXIT_OUTCOME_SUCCESS: "success",
+    EXIT_OUTCOME_NOSTART: "no-start",
+    EXIT_OUTCOME_STOPPED: "stopped",
+    EXIT_OUTCOME_FAILURE: "failure",
+    EXIT_OUTCOME_ABORTED: "aborted",
+}
+
+# Only results of simulations that ran are cached; the other outcomes may
+# be caused by the environment rather than the inputs.
+cacheable_outcomes = {"success", "stopped", "failure"}
+
+# The stack is dumped with a fixed UUID, so that it does not vary between
+# runs that are otherwise the same.
+dump_uuid = "00000000-0000-0000-0000-000000000000"
+
+
+def outcome_from_exit(returncode: Optional[int], result: Optional[Any]) -> str:
+    """Return the outcome of a run of cloe-engine.
+
+    The outcome in the result that cloe-engine printed takes precedence,
+    since a simulation that is stopped only leads to a non-zero exit code
+    if success is required. If cloe-engine did not print a result, it did
+    not get past the initialization.
+    """
+    if isinstance(result, dict) and isinstance(result.get("outcome"), str):
+        return result["outcome"]
+    if returncode is None:
+        return "unknown"
+    if returncode < 0:
+        # cloe-engine was killed by a signal.
+        return "aborted"
+    if returncode == EXIT_OUTCOME_UNKNOWN:
+        return "no-start"
+    return exit_outcomes.get(returncode, "unknown")
+
+
+def exit_code_from_codes(returncodes: Iterable[Optional[int]]) -> int:
+    """Return the exit codes of cloe-engine combined into one."""
+    code = 0
+    for returncode in returncodes:
+        if returncode is None:
+            code |= EXIT_OUTCOME_UNKNOWN
+        elif returncode < 0:
+            code |= EXIT_OUTCOME_ABORTED
+        else:
+            code |= returncode
+    return code
+
+
+def exit_code_from_runs(runs: Iterable["BatchRun"]) -> int:
+    """Return the exit codes of all runs combined into one."""
+    return exit_code_from_codes(run.returncode for run in runs)
+
+
+class BatchRun:
+    """BatchRun describes a single run of cloe-engine in a batch.
+
+    The stackfiles in args are merged by cloe-engine. If stdin is not None,
+    it is passed to cloe-engine on standard input, and args should contain
+    "-" at the position the stackfile read from stdin should be merged.
+    """
+
+    def __init__(self, index: int, name: str, args: List[str], stdin: bytes = None):
+        self.index = index
+        self.name = name
+        self.args = args
+        self.stdin = stdin
+        self.params: Optional[Dict[str, Any]] = None
+        self.digest: Optional[str] = None
+        self.uuid = str(uuid.uuid4())
+        self.run_dir: Optional[Path] = None
+        self.returncode: Optional[int] = None
+        self.outcome = "pending"
+        self.duration = 0.0
+        self.result: Optional[Any] = None
+        self.error: Optional[str] = None
+        self.cached = False
+        self.telemetry: Optional[Dict[str, Any]] = None
+
+    def summary(self) -> Dict[str, Any]:
+        """Return a machine-readable summary of the run."""
+        summary = {
+            "index": self.index,
+            "name": self.name,
+            "stackfiles": self.args,
+            "uuid": self.uuid,
+            "outcome": self.outcome,
+            "exit_code": self.returncode,
+            "duration": round(self.duration, 6),
+            "run_dir": str(self.run_dir),
+            "error": self.error,
+            "cached": self.cached,
+        }
+        if self.params is not None:
+            summary["params"] = self.params
+        if self.digest is not None:
+            summary["digest"] = self.digest
+        if self.telemetry is not None:
+            summary["telemetry"] = self.telemetry
+        return summary
+
+
+def _write_json(path: Path, data: Any) -> None:
+    with path.open("w") as file:
+        json.dump(data, file, indent=2)
+        file.write("\n")
+
+
+class Batch:
+    """Batch runs many simulations with the runtime environment of an engine."""
+
+    def __init__(
+        self,
+        engine: Engine,
+        output_dir: Path,
+        workers: int = 1,
+        require_success: bool = False,
+        result_cache: Optional[ResultCache] = None,
+        telemetry_interval: Optional[float] = None,
+        runs_index: Optional[RunIndex] = None,
+    ):
+        self.engine = engine
+        self.output_dir = output_dir
+        self.workers = max(1, workers)
+        self.require_success = require_success
+        self.result_cache = result_cache
+        self.telemetry_interval = telemetry_interval
+        self.runs_index = runs_index
+        self.profile_hash: Optional[str] = None
+        self.env: Optional[Environment] = None
+        self.runs: List[BatchRun] = []
+        self.duration = 0.0
+        self.print_runs = True
+
+    def _run_args(self, run: BatchRun, overlay: Path) -> List[str]:
+        args = ["run", "--uuid", run.uuid, "--write-output"]
+        if self.require_success:
+            args.append("--require-success")
+        return args + run.args + [str(overlay)]
+
+    def _fingerprint(self, run: BatchRun, env: Dict[str, str]) -> Optional[str]:
+        """Return the fingerprint of the inputs of the run, if it has one.
+
+        The merged stack is dumped by cloe-engine, so that changes in any
+        included stackfile are accounted for, but not the formatting.
+        """
+        assert self.result_cache is not None
+        env = dict(env, CLOE_SIMULATION_UUID=dump_uuid)
+        cmd = self.engine.engine_cmd(["dump"] + run.args)
+        logging.debug(f"Exec: {' '.join(cmd)}")
+        try:
+            proc = subprocess.run(
+                cmd,
+                env=env,
+                input=run.stdin,
+                stdin=subprocess.DEVNULL if run.stdin is None else None,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                check=False,
+            )
+        except OSError as err:
+            logging.warning(f"Warning: cannot dump stack: {err}")
+            return None
+        if proc.returncode != 0:
+            # The run will fail, there's no point in caching it.
+            return None
+        # The UUID and the overlay differ for every run, but they do not
+        # influence the result.
+        args = ["run", "--write-output"]
+        if self.require_success:
+            args.append("--require-success")
+        return self.result_cache.fingerprint(
+            proc.stdout.decode(errors="replace"),
+            Path(self.engine.engine_path),
+            env,
+            self.engine.engine_pre_args + args + self.engine.engine_post_args,
+        )
+
+    def _restore(self, run: BatchRun, key: str) -> bool:
+        """Copy the cached result of the run into its directory."""
+        assert self.result_cache is not None and run.run_dir is not None
+        entry = self.result_cache.lookup(key)
+        if entry is None:
+            return False
+        try:
+            meta = self.result_cache.read(entry)
+            stdout = (entry / "stdout.json").read_bytes()
+            if (entry / "output").is_dir():
+                shutil.copytree(entry / "output", run.run_dir / "output", symlinks=True)
+        except (OSError, ValueError) as err:
+            logging.warning(f"Warning: cannot use cached result {entry}: {err}")
+            return False
+        (run.run_dir / "stdout.json").write_bytes(stdout)
+        (run.run_dir / "stderr.log").write_text(f"Result copied from cache: {entry}\n")
+        run.returncode = meta["returncode"]
+        try:
+            run.result = json.loads(stdout.decode(errors="replace"))
+        except ValueError:
+            run.result = None
+        run.cached = True
+        return True
+
+    def _execute(self, run: BatchRun) -> BatchRun:
+        """Run cloe-engine for a single run and record the results."""
+        assert self.env is not None
+        run.run_dir = self.output_dir / run.uuid
+        run.run_dir.mkdir(parents=True)
+        # Each run sets its own simulation UUID, so it needs its own copy of
+        # the environment, which concurrent runs share.
+        env = dict(self.env.as_dict())
+
+        start = time.monotonic()
+        key = None
+        if self.result_cache is not None:
+            key = self._fingerprint(run, env)
+            if key is not None and self._restore(run, key):
+                run.duration = time.monotonic() - start
+                run.outcome = outcome_from_exit(run.returncode, run.result)
+                _write_json(run.run_dir / "run.json", run.summary())
+                return run
+
+        # The overlay is merged last, so it overrides where the stackfiles
+        # would have cloe-engine write its registry and output.
+        overlay = run.run_dir / "overlay.json"
+        _write_json(
+            overlay,
+            {
+                "version": "4",
+                "engine": {
+                    "registry_path": str(run.run_dir / "registry"),
+                    "output": {"path": str(run.run_dir / "output")},
+                },
+            },
+        )
+
+        env["CLOE_SIMULATION_UUID"] = run.uuid
+        cmd = self.engine.engine_cmd(self._run_args(run, overlay))
+        logging.debug(f"Exec: {' '.join(cmd)}")
+        stdout = b""
+        try:
+            with (run.run_dir / "stderr.log").open("wb") as stderr:
+                proc = subprocess.Popen(
+                    cmd,
+                    env=env,
+                    stdin=subprocess.DEVNULL if run.stdin is None else subprocess.PIPE,
+                    stdout=subprocess.PIPE,
+                    stderr=stderr,
+                )
+                if self.telemetry_interval is None:
+                    stdout, _ = proc.communicate(run.stdin)
+                else:
+                    sampler = Sampler(
+                        proc.pid, run.run_dir / "telemetry.csv", self.telemetry_interval
+                    )
+                    with sampler:
+                        stdout, _ = proc.communicate(run.stdin)
+                    run.telemetry = sampler.summary()
+            run.returncode = proc.returncode
+            (run.run_dir / "stdout.json").write_bytes(stdout)
+            try:
+                run.result = json.loads(stdout.decode(errors="replace"))
+            except ValueError:
+                run.result = None
+        except OSError as err:
+            run.error = str(err)
+        run.duration = time.monotonic() - start
+        run.outcome = outcome_from_exit(run.returncode, run.result)
+        if (
+            key is not None
+            and run.returncode is not None
+            and run.outcome in cacheable_outcomes
+        ):
+            assert self.result_cache is not None
+            self.result_cache.store(key, run.returncode, stdout, run.run_dir / "output")
+        _write_json(run.run_dir / "run.json", run.summary())
+        return run
+
+    def _index(self, run: BatchRun) -> None:
+        """Add the run to the run index, if there is one."""
+        if self.runs_index is None or run.run_dir is None:
+            return
+        try:
+            self.runs_index.record_launch(
+                run.uuid, self.engine.profile, self.profile_hash, run.returncode
+            )
+            self.runs_index.add(run.run_dir / "output", run.uuid)
+        except sqlite3.Error as err:
+            logging.warning(f"Warning: cannot add run to index: {err}")
+
+    def _report(self, run: BatchRun) -> None:
+        # This is called in the thread that created the run index.
+        self._index(run)
+        if not self.print_runs:
+            return
+        cached = " (cached)" if run.cached else ""
+        print(
+            f"{run.outcome:<9} {run.duration:8.2f}s  {run.uuid}  {run.name}{cached}",
+            flush=True,
+        )
+
+    def prepare(self, use_cache: bool = True) -> None:
+        """Prepare the runtime environment for all runs."""
+        self.env = self.engine.runtime_env(use_cache)
+        self.engine.engine_path = self.env["CLOE_ENGINE"]
+        self.profile_hash = self.engine.runtime_key()
+
+    def run(
+        self,
+        runs: Iterable[BatchRun],
+        references: Optional[Set[str]] = None,
+    ) -> List[BatchRun]:
+        """Run all runs and return them once they are done.
+
+        Runs may be a generator; only a bounded number of runs is taken
+        from it ahead of the workers. The plugin setups are loaded with
+        the references (see Engine.prepare_plugin_setups) and set up once
+        for the whole batch.
+        """
+        if self.env is None:
+            self.prepare()
+        assert self.env is not None
+        start = time.monotonic()
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        plugin_setups = self.engine.prepare_plugin_setups(self.env, references)
+        started: List[PluginSetup] = []
+        try:
+            self.engine.setup_plugins(plugin_setups, started)
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                pending: Set[Future] = set()
+                for run in runs:
+                    if len(pending) >= 2 * self.workers:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            self._report(future.result())
+                    self.runs.append(run)
+                    pending.add(executor.submit(self._execute, run))
+                for future in pending:
+                    self._report(future.result())
+        finally:
+            self.engine.teardown_plugins(started)
+            self.duration = time.monotonic() - start
+            self.write_summary()
+        return self.runs
+
+    def outcomes(self) -> Dict[str, int]:
+        """Return the number of runs for each outcome."""
+        counts: Dict[str, int] = {}
+        for run in self.runs:
+            counts[run.outcome] = counts.get(run.outcome, 0) + 1
+        return counts
+
+    def summary_path(self) -> Path:
+        """Return the path to the summary of the batch."""
+        return self.output_dir / "summary.json"
+
+    def write_summary(self) -> None:
+        """Write a machine-readable summary of all runs."""
+        runs = sorted(self.runs, key=lambda x: x.index)
+        _write_json(
+            self.summary_path(),
+            {
+                "profile": self.engine.profile,
+                "workers": self.workers,
+                "duration": round(self.duration, 6),
+                "exit_code": exit_code_from_runs(runs),
+                "outcomes": self.outcomes(),
+                "runs": [run.summary() for run in runs],
+            },
+        )
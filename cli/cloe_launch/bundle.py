@@ -0,0 +1,407 @@
+# pylint: disable=logging-fstring-interpolation
+
+"""
+This module contains the export of prepared profiles into bundles, and the
+launching of cloe-engine from them.
+
+Preparing a profile requires Conan and its cache, and resolves packages
+anew on each machine. A bundle instead contains everything that cloe-engine
+needs to run, copied from a prepared runtime environment:
+
+    bundle.json     manifest with the environment of the profile
+    activate.sh     script that sets the environment in a shell
+    bin/            cloe-engine
+    lib/            shared libraries of all packages, first one wins
+    lib/cloe/       plugins and their plugin setups
+
+Paths in the environment that lead into the copied directories are
+rewritten relative to the bundle directory, which is referred to as
+${CLOE_BUNDLE}, so that a bundle can be moved or unpacked anywhere. Other
+paths into packages are kept as they are, and reported. Libraries that the
+packages do not contain, such as the C library, are expected to be installed
+on the machine that runs the bundle.
+
+A bundle can be a directory or a tarball. Tarballs are unpacked once into
+the bundle cache, and then launched from there.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import shlex
+import shutil
+import subprocess
+import tarfile
+import time
+
+from pathlib import Path
+from typing import Any
+from typing import Dict
+from typing import List
+
+from cloe_launch import Configuration
+from cloe_launch.exec import Engine
+from cloe_launch.exec import Environment
+from cloe_launch.exec import _read_conan_requires
+from cloe_launch.exec import _shared_library_regex
+from cloe_launch.exec import _volatile_shell_vars
+from cloe_launch.utility import lock_file
+
+bundle_version = 1
+manifest_name = "bundle.json"
+archive_suffixes = (".tar.gz", ".tgz", ".tar")
+
+bundle_var = "CLOE_BUNDLE"
+_bundle_ref = "${" + bundle_var + "}"
+
+# Variables that are derived from the contents of the bundle.
+_bundle_vars = {
+    "CLOE_ENGINE",
+    "CLOE_PLUGIN_PATH",
+    "CLOE_SHELL",
+    "LD_LIBRARY_PATH",
+    "PATH",
+}
+
+
+class BundleError(Exception):
+    """BundleError signifies that a bundle cannot be created or used."""
+
+
+def is_archive(path: Path) -> bool:
+    return path.name.endswith(archive_suffixes)
+
+
+def _copy_entries(src_dir: str, dst_dir: Path, select=None) -> None:
+    """Copy the entries of src_dir into dst_dir, unless they are already there.
+
+    Entries of earlier directories take precedence, like in a search path.
+    Symlinks to entries in the same directory, such as libfoo.so pointing to
+    libfoo.so.1, are kept; other symlinks are copied as what they point to.
+    """
+    with os.scandir(src_dir) as it:
+        entries = sorted(it, key=lambda x: x.name)
+    names = {x.name for x in entries if select is None or select(x)}
+    for entry in entries:
+        if entry.name not in names:
+            continue
+        dst = dst_dir / entry.name
+        if os.path.lexists(dst):
+            continue
+        if entry.is_symlink():
+            target = os.readlink(entry.path)
+            if "/" not in target and target in names:
+                dst.symlink_to(target)
+                continue
+        if entry.is_dir():
+            shutil.copytree(entry.path, dst)
+        else:
+            shutil.copy2(entry.path, dst)
+
+
+def _shell_value(value: str) -> str:
+    """Return the value quoted for the shell, with the bundle expanded."""
+    parts = value.split(_bundle_ref)
+    return f'"${bundle_var}"'.join(shlex.quote(x) if x else "" for x in parts) or "''"
+
+
+def _missing_libraries(bundle_dir: Path) -> Dict[str, List[str]]:
+    """Return the libraries that cloe-engine and the plugins in the bundle
+    need but that are neither in the bundle nor on this machine.
+
+    This requires ldd; without it, nothing is reported.
+    """
+    if shutil.which("ldd") is None:
+        return {}
+    env = dict(os.environ)
+    env["LD_LIBRARY_PATH"] = str(bundle_dir / "lib")
+    result = {}
+    files = [bundle_dir / "bin" / "cloe-engine"] + sorted(
+        (bundle_dir / "lib" / "cloe").glob("*.so")
+    )
+    for file in files:
+        proc = subprocess.run(
+            ["ldd", str(file)],
+            env=env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True,
+            check=False,
+        )
+        missing = re.findall(r"^\s*(\S+) => not found", proc.stdout, re.MULTILINE)
+        if missing:
+            result[str(file.relative_to(bundle_dir))] = missing
+    return result
+
+
+def _relocate(value: str, relocations: Dict[str, str]) -> str:
+    """Return the value with paths into bundled directories replaced by
+    their place in the bundle, relative to ${CLOE_BUNDLE}."""
+    # Longer directories first, so that lib/cloe is not replaced as lib.
+    for src in sorted(relocations, key=len, reverse=True):
+        value = re.sub(
+            re.escape(src) + r"(?=/|:|$)", lambda _, x=src: relocations[x], value
+        )
+    return value
+
+
+def _bundle_environment(
+    env: Environment, relocations: Dict[str, str]
+) -> Dict[str, Any]:
+    """Return the variables that the profile sets, apart from those that are
+    derived from the contents of the bundle, and the variables that refer to
+    package directories, which are not relocatable.
+
+    Paths into directories that were copied into the bundle, given by
+    relocations, are replaced by their place in the bundle.
+    """
+    base = env.shell_env()
+    package_dirs = set()
+    for key in ["PATH", "LD_LIBRARY_PATH"]:
+        base_paths = base.get(key, "").split(os.pathsep)
+        for path in env.get_list(key, default=[]):
+            if path and path not in base_paths:
+                package_dirs.add(os.path.dirname(path.rstrip("/")))
+    # Packages usually share a storage directory, such as ~/.conan/data,
+    # which also contains packages that only provide variables.
+    if len(package_dirs) > 1:
+        storage_dir = os.path.commonpath(list(package_dirs))
+        if len(Path(storage_dir).parts) > 3:
+            package_dirs.add(storage_dir)
+
+    variables = {}
+    unrelocatable = []
+    for key, value in sorted(env.as_dict().items()):
+        if key in _bundle_vars or key in _volatile_shell_vars or base.get(key) == value:
+            continue
+        value = _relocate(value, relocations)
+        variables[key] = value
+        if any(x and x in value for x in package_dirs):
+            unrelocatable.append(key)
+    return {"variables": variables, "unrelocatable": unrelocatable}
+
+
+def _write_activate_sh(bundle_dir: Path, variables: Dict[str, str]) -> None:
+    lines = [
+        "# Generated by cloe-launch, source this file to use the bundle.",
+        f'{bundle_var}="$(cd "$(dirname "${{BASH_SOURCE[0]:-$0}}")" && pwd)"',
+        f"export {bundle_var}",
+        f'export PATH="${bundle_var}/bin:$PATH"',
+        f'export LD_LIBRARY_PATH="${bundle_var}/lib'
+        '${LD_LIBRARY_PATH:+:$LD_LIBRARY_PATH}"',
+        f'export CLOE_ENGINE="${bundle_var}/bin/cloe-engine"',
+        f'export CLOE_PLUGIN_PATH="${bundle_var}/lib/cloe"',
+    ]
+    for key, value in sorted(variables.items()):
+        lines.append(f"export {key}={_shell_value(value)}")
+    with (bundle_dir / "activate.sh").open("w") as file:
+        file.write("\n".join(lines) + "\n")
+
+
+def create_bundle(
+    engine: Engine, env: Environment, output: Path, force: bool = False
+) -> Dict[str, Any]:
+    """Export the prepared runtime environment into a bundle at output.
+
+    If output ends with .tar.gz, .tgz, or .tar, the bundle is a tarball,
+    otherwise a directory. Return the manifest of the bundle.
+    """
+    if os.path.lexists(output) and not force:
+        raise BundleError(f"bundle already exists: {output}")
+    output.parent.mkdir(parents=True, exist_ok=True)
+    name = output.name
+    for suffix in archive_suffixes:
+        if name.endswith(suffix):
+            name = name[: -len(suffix)]
+    staging_dir = output.with_name(f".{name}.{os.getpid()}.tmp")
+    if staging_dir.exists():
+        shutil.rmtree(staging_dir)
+    try:
+        manifest = _populate_bundle(engine, env, staging_dir)
+        if is_archive(output):
+            tmp = output.with_name(f".{output.name}.{os.getpid()}.tmp")
+            mode = "w" if output.name.endswith(".tar") else "w:gz"
+            logging.info(f"Write: {output}")
+            with tarfile.open(str(tmp), mode) as tar:
+                tar.add(str(staging_dir), arcname=name)
+            os.replace(tmp, output)
+        else:
+            if os.path.lexists(output):
+                shutil.rmtree(output)
+            os.rename(staging_dir, output)
+    finally:
+        if staging_dir.exists():
+            shutil.rmtree(staging_dir, ignore_errors=True)
+    return manifest
+
+
+def _populate_bundle(
+    engine: Engine, env: Environment, bundle_dir: Path
+) -> Dict[str, Any]:
+    (bundle_dir / "bin").mkdir(parents=True)
+    (bundle_dir / "lib" / "cloe").mkdir(parents=True)
+
+    engine_path = Path(env["CLOE_ENGINE"])
+    logging.info(f"Copy: {engine_path}")
+    shutil.copy2(str(engine_path), str(bundle_dir / "bin" / "cloe-engine"))
+
+    # Copy the libraries in the order the loader would find them; the base
+    # paths are those of the machine, not of the profile.
+    relocations: Dict[str, str] = {}
+    base_paths = env.shell_env().get("LD_LIBRARY_PATH", "").split(os.pathsep)
+    for path in env.get_list("LD_LIBRARY_PATH", default=[]):
+        if not path or path in base_paths or not os.path.isdir(path):
+            continue
+        logging.info(f"Copy libraries: {path}")
+        relocations.setdefault(path.rstrip("/"), f"{_bundle_ref}/lib")
+        _copy_entries(
+            path,
+            bundle_dir / "lib",
+            lambda x: not x.is_dir()
+            and _shared_library_regex.search(x.name) is not None,
+        )
+    for path in env.get_list("CLOE_PLUGIN_PATH", default=[]):
+        if os.path.isdir(path):
+            logging.info(f"Copy plugins: {path}")
+            relocations[path.rstrip("/")] = f"{_bundle_ref}/lib/cloe"
+            _copy_entries(path, bundle_dir / "lib" / "cloe")
+
+    environment = _bundle_environment(env, relocations)
+    for key in environment["unrelocatable"]:
+        logging.warning(
+            f"Warning: {key} refers to a package directory that is not bundled"
+        )
+    _write_activate_sh(bundle_dir, environment["variables"])
+
+    missing = _missing_libraries(bundle_dir)
+    for file, libraries in missing.items():
+        logging.warning(
+            f"Warning: {file} needs libraries that are missing: {', '.join(libraries)}"
+        )
+
+    manifest = {
+        "version": bundle_version,
+        "profile": engine.profile,
+        "runtime_key": engine.runtime_key(),
+        "packages": _read_conan_requires(engine.runtime_dir / "conaninfo.txt"),
+        "created": time.time(),
+        "environment": environment["variables"],
+        "unrelocatable": environment["unrelocatable"],
+        "missing_libraries": missing,
+    }
+    with (bundle_dir / manifest_name).open("w") as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+    return manifest
+
+
+def _escapes(path: str) -> bool:
+    """Return true if the relative path leads outside of its directory."""
+    path = os.path.normpath(path)
+    return os.path.isabs(path) or path == ".." or path.startswith("../")
+
+
+def _extract_archive(archive: Path, dst_dir: Path) -> None:
+    """Extract the tarball, refusing members that would be written outside
+    of dst_dir, directly or through links."""
+    with tarfile.open(str(archive)) as tar:
+        for member in tar.getmembers():
+            if _escapes(member.name):
+                raise BundleError(f"bundle contains unsafe path: {member.name}")
+            if member.issym():
+                target = os.path.join(os.path.dirname(member.name), member.linkname)
+                if os.path.isabs(member.linkname) or _escapes(target):
+                    raise BundleError(f"bundle contains unsafe link: {member.name}")
+            elif member.islnk() and _escapes(member.linkname):
+                raise BundleError(f"bundle contains unsafe link: {member.name}")
+            elif not (member.isfile() or member.isdir()):
+                raise BundleError(f"bundle contains special file: {member.name}")
+        if hasattr(tarfile, "data_filter"):
+            tar.extractall(str(dst_dir), filter="data")
+        else:
+            tar.extractall(str(dst_dir))
+
+
+def open_bundle(path: Path, cache_dir: Path) -> Path:
+    """Return the directory of the bundle at path, unpacking it if necessary.
+
+    A tarball is unpacked into the cache directory only once, so that it can
+    be launched repeatedly without overhead.
+    """
+    path = path.resolve()
+    if path.is_dir():
+        bundle_dir = path
+    elif not is_archive(path):
+        raise BundleError(f"not a bundle directory or tarball: {path}")
+    else:
+        stat = path.stat()
+        hasher = hashlib.blake2b(digest_size=10)
+        hasher.update(f"{path}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+        bundle_dir = cache_dir / hasher.hexdigest()
+        if not bundle_dir.exists():
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            fd = lock_file(bundle_dir.with_suffix(".lock"))
+            try:
+                if not bundle_dir.exists():
+                    tmp = bundle_dir.with_name(f".{bundle_dir.name}.{os.getpid()}.tmp")
+                    logging.info(f"Unpack bundle: {path} -> {bundle_dir}")
+                    try:
+                        _extract_archive(path, tmp)
+                        os.rename(tmp, bundle_dir)
+                    finally:
+                        if tmp.exists():
+                            shutil.rmtree(tmp, ignore_errors=True)
+            finally:
+                os.close(fd)
+        # The tarball contains a single directory with the bundle.
+        subdirs = [x for x in bundle_dir.iterdir() if x.is_dir()]
+        if not (bundle_dir / manifest_name).exists() and len(subdirs) == 1:
+            bundle_dir = subdirs[0]
+    if not (bundle_dir / manifest_name).exists():
+        raise BundleError(f"bundle has no {manifest_name}: {path}")
+    return bundle_dir
+
+
+class BundleEngine(Engine):
+    """BundleEngine launches cloe-engine from a bundle instead of a profile.
+
+    The environment of the bundle replaces the run environment that Conan
+    generates for a profile, so nothing needs to be resolved or prepared.
+    The runtime directory only contains relayed files and converted
+    stackfiles.
+    """
+
+    def __init__(self, conf: Configuration, bundle_dir: Path):
+        self.bundle_dir = bundle_dir
+        super().__init__(conf, conanfile=str(bundle_dir / manifest_name))
+        try:
+            self.manifest = json.loads(self.profile_data)
+        except ValueError as err:
+            raise BundleError(f"bundle manifest is corrupt: {err}")
+        if self.manifest.get("version") != bundle_version:
+            raise BundleError(
+                f"unsupported bundle version: {self.manifest.get('version')}"
+            )
+        self.compact_library_path = False
+
+    def _prepare_runtime_env(self, use_cache: bool = True) -> Environment:
+        logging.info(f"Bundle directory: {self.bundle_dir}")
+        self._use_runtime_dir()
+        self.runtime_dir.mkdir(parents=True, exist_ok=True)
+        self.runtime_cache.touch(self.runtime_dir)
+
+        preserve = None if not self.preserve_env else list(os.environ.keys())
+        env = Environment(
+            dict(Environment({}, preserve=preserve).shell_env()), preserve=preserve
+        )
+        bundle = str(self.bundle_dir)
+        for key, value in self.manifest["environment"].items():
+            env.set(key, value.replace(_bundle_ref, bundle))
+        env.set(bundle_var, bundle)
+        env.path_prepend("PATH", self.bundle_dir / "bin")
+        env.path_prepend("LD_LIBRARY_PATH", self.bundle_dir / "lib")
+        env.set("CLOE_ENGINE", self.bundle_dir / "bin" / "cloe-engine")
+        env.path_set("CLOE_PLUGIN_PATH", [self.bundle_dir / "lib" / "cloe"])
+        env.set("CLOE_SHELL", self.runtime_env_path())
+        return env
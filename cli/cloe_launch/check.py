@@ -0,0 +1,396 @@
+# pylint: disable=logging-fstring-interpolation
+
+"""
+This module contains the validation of many stackfiles with cloe-engine.
+
+Validating a stackfile with `cloe-engine check` is dominated by starting
+cloe-engine and loading its plugins. A Checker therefore validates many
+stackfiles with each process, with `cloe-engine check --distinct --json`,
+and runs several such processes in parallel.
+
+The verdict of each stackfile is cached by the fingerprint of everything it
+depends on:
+
+- the content of the stackfile and of all stackfiles it includes,
+- the cloe-engine binary and the plugin libraries it can load,
+- the system stackfiles that cloe-engine merges, and
+- the environment variables that stackfiles refer to.
+
+Only stackfiles that have changed since they were last validated are
+validated again.
+"""
+
+import glob
+import hashlib
+import json
+import logging
+import math
+import os
+import re
+import subprocess
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+
+from cloe_launch.stackfile import strip_comments
+from cloe_launch.stackfile import system_stackfiles
+from cloe_launch.stackfile import yaml_suffixes
+from cloe_launch.utility import file_digest
+
+# Environment variables that influence validation, in addition to those
+# that the stackfiles refer to.
+default_env_vars = ["CLOE_PLUGIN_PATH", "CLOE_STRICT_MODE", "CLOE_SECURE_MODE"]
+
+stackfile_suffixes = [".json"] + yaml_suffixes
+
+_interpolation_regex = re.compile(r"\$\{([A-Za-z_][A-Za-z0-9_]*)(?::?-([^}]*))?\}")
+
+
+class Verdict:
+    """Verdict is the result of validating a single stackfile."""
+
+    def __init__(self, file: str, ok: bool, error: Any = None, cached: bool = False):
+        self.file = file
+        self.ok = ok
+        self.error = error
+        self.cached = cached
+
+    def message(self) -> str:
+        """Return the error as a single human-readable string."""
+        if self.error is None:
+            return ""
+        if isinstance(self.error, dict):
+            parts = [str(self.error.get("error", ""))]
+            if self.error.get("explanation"):
+                parts.append(str(self.error["explanation"]))
+            return ": ".join(x for x in parts if x) or json.dumps(self.error)
+        return str(self.error)
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "file": self.file,
+            "ok": self.ok,
+            "error": self.error,
+            "cached": self.cached,
+        }
+
+
+def interpolate(value: str, env: Dict[str, str], used: Set[str]) -> Optional[str]:
+    """Return the value with ${VAR} and ${VAR-default} replaced from env.
+
+    The names of the variables are added to used. If a variable is not set
+    and has no default, None is returned.
+    """
+    unresolved = False
+
+    def replace(match: "re.Match") -> str:
+        nonlocal unresolved
+        used.add(match.group(1))
+        if match.group(1) in env:
+            return env[match.group(1)]
+        if match.group(2) is not None:
+            return match.group(2)
+        unresolved = True
+        return ""
+
+    result = _interpolation_regex.sub(replace, value)
+    return None if unresolved else result
+
+
+def include_closure(
+    path: Path, env: Dict[str, str], max_depth: int = 64
+) -> Optional[Tuple[List[Tuple[str, str]], Set[str]]]:
+    """Return the digest of the stackfile and each file it includes, and the
+    environment variables they refer to.
+
+    If an include cannot be resolved, None is returned. Files that cannot be
+    read or parsed are part of the closure, but do not include anything.
+    """
+    digests: Dict[str, str] = {}
+    used: Set[str] = set()
+    pending = [(path.resolve(), 0)]
+    while pending:
+        file, depth = pending.pop()
+        if str(file) in digests:
+            continue
+        if depth > max_depth:
+            return None
+        try:
+            content = file.read_bytes()
+        except OSError:
+            digests[str(file)] = "missing"
+            continue
+        digests[str(file)] = hashlib.sha256(content).hexdigest()
+        text = content.decode(errors="replace")
+        used.update(m.group(1) for m in _interpolation_regex.finditer(text))
+        try:
+            data = json.loads(strip_comments(text))
+        except ValueError:
+            continue
+        includes = data.get("include", []) if isinstance(data, dict) else []
+        for include in includes if isinstance(includes, list) else [includes]:
+            if not isinstance(include, str):
+                continue
+            include = include.replace("${THIS_STACKFILE_DIR}", str(file.parent))
+            include = interpolate(include, env, used)
+            if include is None:
+                return None
+            pending.append(((file.parent / include).resolve(), depth + 1))
+    return sorted(digests.items()), used
+
+
+def expand_stackfiles(patterns: List[str]) -> List[str]:
+    """Return the stackfiles that match the patterns, in order.
+
+    Patterns can be files, glob patterns, where ** matches directories
+    recursively, or directories, which are searched recursively for JSON
+    and YAML files.
+    """
+    result: List[str] = []
+    seen: Set[str] = set()
+
+    def add(file: str) -> None:
+        if file not in seen:
+            seen.add(file)
+            result.append(file)
+
+    for pattern in patterns:
+        matches = (
+            sorted(glob.glob(pattern, recursive=True))
+            if glob.has_magic(pattern)
+            else [pattern]
+        )
+        if not matches:
+            logging.warning(f"Warning: no stackfiles match: {pattern}")
+        for match in matches:
+            if not os.path.isdir(match):
+                add(match)
+                continue
+            for root, dirs, files in os.walk(match):
+                dirs.sort()
+                for file in sorted(files):
+                    if os.path.splitext(file)[1] in stackfile_suffixes:
+                        add(os.path.join(root, file))
+    return result
+
+
+class CheckCache:
+    """CheckCache stores the verdicts of stackfiles in a single file.
+
+    Entries that have not been used for max_age seconds are removed when
+    the cache is saved.
+    """
+
+    version = 1
+
+    def __init__(self, path: Path, max_age: float = 30 * 86400):
+        self.path = path
+        self.max_age = max_age
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        self._changed = False
+        try:
+            with path.open() as file:
+                data = json.load(file)
+            if data.get("version") == self.version:
+                self.entries = data["entries"]
+        except (OSError, ValueError, KeyError, AttributeError):
+            pass
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        entry = self.entries.get(key)
+        if entry is not None:
+            entry["time"] = time.time()
+            self._changed = True
+        return entry
+
+    def put(self, key: str, ok: bool, error: Any) -> None:
+        self.entries[key] = {"ok": ok, "error": error, "time": time.time()}
+        self._changed = True
+
+    def save(self) -> None:
+        """Write the cache, merged with entries other processes have written."""
+        if not self._changed:
+            return
+        try:
+            with self.path.open() as file:
+                data = json.load(file)
+            if data.get("version") == self.version:
+                for key, entry in data["entries"].items():
+                    if entry["time"] > self.entries.get(key, {}).get("time", 0):
+                        self.entries[key] = entry
+        except (OSError, ValueError, KeyError, AttributeError, TypeError):
+            pass
+        cutoff = time.time() - self.max_age
+        entries = {k: v for k, v in self.entries.items() if v["time"] >= cutoff}
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(f".{self.path.name}.{os.getpid()}.tmp")
+        with tmp.open("w") as file:
+            json.dump({"version": self.version, "entries": entries}, file)
+        os.replace(tmp, self.path)
+
+
+class Checker:
+    """Checker validates stackfiles with cloe-engine in parallel."""
+
+    version = 1
+
+    def __init__(
+        self,
+        engine_cmd: List[str],
+        env: Dict[str, str],
+        cache: Optional[CheckCache] = None,
+        workers: int = 1,
+        chunk_size: int = 100,
+    ):
+        self.engine_cmd = engine_cmd
+        self.env = env
+        self.cache = cache
+        self.workers = max(1, workers)
+        self.chunk_size = chunk_size
+        self._fingerprint: Optional[Dict[str, Any]] = None
+
+    def _files_fingerprint(self, paths: List[Path]) -> Dict[str, List[int]]:
+        """Return the size and modification time of each file.
+
+        Binaries are not hashed, since that would take longer than checking;
+        a rebuilt binary therefore invalidates all verdicts.
+        """
+        result = {}
+        for path in paths:
+            try:
+                stat = path.stat()
+                result[str(path)] = [stat.st_size, stat.st_mtime_ns]
+            except OSError:
+                continue
+        return result
+
+    def fingerprint(self) -> Dict[str, Any]:
+        """Return the fingerprint of what all verdicts depend on."""
+        if self._fingerprint is None:
+            libraries = []
+            for path in self.env.get("CLOE_PLUGIN_PATH", "").split(os.pathsep):
+                if path and os.path.isdir(path):
+                    libraries.extend(sorted(Path(path).glob("*.so")))
+                elif path:
+                    libraries.append(Path(path))
+            self._fingerprint = {
+                "version": self.version,
+                "cmd": self.engine_cmd,
+                "engine": self._files_fingerprint([Path(self.engine_cmd[0])]),
+                "plugins": self._files_fingerprint(libraries),
+                "system": {str(x): file_digest(x) for x in system_stackfiles()},
+            }
+        return self._fingerprint
+
+    def key(self, path: Path) -> Optional[str]:
+        """Return the cache key of the stackfile, or None if it has none."""
+        closure = include_closure(path, self.env)
+        if closure is None:
+            return None
+        digests, used = closure
+        used.update(default_env_vars)
+        inputs = {
+            "fingerprint": self.fingerprint(),
+            "closure": digests,
+            "env": {k: self.env.get(k) for k in sorted(used)},
+        }
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+    def _check_chunk(self, files: List[str]) -> Dict[str, Tuple[bool, Any]]:
+        """Validate the files with one cloe-engine process."""
+        cmd = self.engine_cmd + ["check", "--distinct", "--json"] + files
+        logging.debug(f"Exec: {' '.join(cmd[:8])} ... ({len(files)} files)")
+        proc = None
+        try:
+            proc = subprocess.run(
+                cmd,
+                env=self.env,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                check=False,
+            )
+            output = json.loads(proc.stdout.decode(errors="replace"))
+            if not isinstance(output, dict):
+                raise ValueError("unexpected output")
+        except (OSError, ValueError) as err:
+            stderr = (
+                "" if proc is None else proc.stderr.decode(errors="replace").strip()
+            )
+            message = f"cloe-engine check failed: {stderr or err}"
+            return {x: (False, message) for x in files}
+        return {x: (output.get(x) is None, output.get(x)) for x in files}
+
+    def check(self, files: List[str]) -> List[Verdict]:
+        """Validate the stackfiles and return their verdicts in order.
+
+        The files must be JSON stackfiles.
+        """
+        verdicts: Dict[str, Verdict] = {}
+        keys: Dict[str, Optional[str]] = {}
+        pending: List[str] = []
+        for file in files:
+            if file in keys:
+                continue
+            key = None if self.cache is None else self.key(Path(file))
+            keys[file] = key
+            entry = None if key is None or self.cache is None else self.cache.get(key)
+            if entry is not None:
+                verdicts[file] = Verdict(file, entry["ok"], entry["error"], cached=True)
+            else:
+                pending.append(file)
+
+        if pending:
+            # Spread the files evenly over the workers, but in chunks that
+            # are small enough to balance the load.
+            size = min(self.chunk_size, math.ceil(len(pending) / self.workers))
+            chunks = [pending[i : i + size] for i in range(0, len(pending), size)]
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                for results in executor.map(self._check_chunk, chunks):
+                    for file, (ok, error) in results.items():
+                        verdicts[file] = Verdict(file, ok, error)
+                        # Failures of cloe-engine itself are not verdicts.
+                        key = keys[file]
+                        if (
+                            self.cache is not None
+                            and key is not None
+                            and not isinstance(error, str)
+                        ):
+                            self.cache.put(key, ok, error)
+        return [verdicts[x] for x in files]
+
+
+def junit_report(verdicts: List[Verdict], duration: float) -> str:
+    """Return the verdicts as a JUnit XML report."""
+    import xml.etree.ElementTree as ET  # pylint: disable=import-outside-toplevel
+
+    failures = [x for x in verdicts if not x.ok]
+    suite = ET.Element(
+        "testsuite",
+        name="cloe-launch check",
+        tests=str(len(verdicts)),
+        failures=str(len(failures)),
+        errors="0",
+        skipped="0",
+        time=f"{duration:.3f}",
+    )
+    for verdict in verdicts:
+        case = ET.SubElement(
+            suite, "testcase", classname="stackfile", name=verdict.file
+        )
+        if not verdict.ok:
+            failure = ET.SubElement(case, "failure", message=verdict.message())
+            if isinstance(verdict.error, dict):
+                failure.text = json.dumps(verdict.error, indent=2)
+    suites = ET.Element("testsuites")
+    suites.append(suite)
+    return '<?xml version="1.0" encoding="UTF-8"?>\n' + ET.tostring(
+        suites, encoding="unicode"
+    )
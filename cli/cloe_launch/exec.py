@@ -7,27 +7,46 @@ This module also contains the PluginSetup class, which encapsulates the
 PluginSetup that each Cloe plugin should implement.
 """
 
+import ast
 import hashlib
 import importlib.util
+import json
 import logging
 import os
 import re
 import shutil
 import subprocess
 import sys
+import tempfile
 import textwrap
+import time
 import shlex
+import uuid
 
 from pathlib import Path
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
 from typing import Dict
 from typing import List
 from typing import Mapping
 from typing import Optional
+from typing import Set
+from typing import Tuple
 from typing import Type
 from typing import Union
 
+from cloe_launch.utility import file_digest
+from cloe_launch.utility import fingerprint_files
+from cloe_launch.utility import fingerprints_match
+from cloe_launch.utility import lock_file
+from cloe_launch.utility import relocate_files
 from cloe_launch.utility import run_cmd
+from cloe_launch.runtime_cache import owner_tag
+from cloe_launch.stackfile import StackfileCompiler
+from cloe_launch.stackfile import is_yaml
+from cloe_launch.stackfile import stackfile_strings
+from cloe_launch.stackfile import system_stackfiles
 from cloe_launch import Configuration
 
 
@@ -233,7 +252,7 @@ class Environment:
         This uses ":" as the separator between multiple values in the path.
         """
         if key in self._data:
-            self._data[key] = self._sep + str(value) + self._data[key]
+            self._data[key] = str(value) + self._sep + self._data[key]
         else:
             self._data[key] = str(value)
 
@@ -287,16 +306,26 @@ class Environment:
                 self._data[key] = value
 
     def export(self, filepath: Path) -> None:
-        """Write the environment variables to a file in KEY=VALUE pairs."""
-        with filepath.open("w") as file:
+        """Write the environment variables to a file in KEY=VALUE pairs.
+
+        The file is replaced atomically, since concurrent launches may write
+        it at the same time.
+        """
+        tmp = filepath.with_name(f"{filepath.name}.{os.getpid()}.tmp")
+        with tmp.open("w") as file:
             for k in self._data.keys():
                 qv = shlex.quote(self._data[k])
                 file.write(f"{k}={qv}\n")
+        os.replace(tmp, filepath)
 
     def as_dict(self) -> Dict[str, str]:
         """Return a reference to the internal dictionary."""
         return self._data
 
+    def shell_env(self) -> Dict[str, str]:
+        """Return the environment that files are sourced in by init_from_shell."""
+        return self._shell_env
+
 
 class PluginSetup:
     """
@@ -320,6 +349,11 @@ class PluginSetup:
     name = None
     plugin = None
 
+    # How long to wait for ready() to return true after setup(), in seconds,
+    # and how long to wait in between calls to ready().
+    ready_timeout = 60.0
+    ready_interval = 0.1
+
     def __init__(self, env: Environment):
         self.env = env
 
@@ -337,8 +371,149 @@ class PluginSetup:
     def setup(self) -> None:
         """Perform plugin setup required for simulation."""
 
+    def ready(self) -> bool:
+        """
+        Return true when the plugin is ready for simulation.
+
+        This is called repeatedly after setup() until it returns true or
+        ready_timeout has expired. It can be used to probe whether an
+        external process started in setup() is usable, instead of sleeping
+        for a fixed amount of time.
+        """
+        return True
+
     def teardown(self) -> None:
-        """Perform plugin teardown after simulation."""
+        """Perform plugin teardown after simulation.
+
+        This is called even if setup() or the simulation failed.
+        """
+
+
+def _setup_plugin(plugin: PluginSetup) -> None:
+    """Call setup() of the plugin and wait until it is ready."""
+    start = time.monotonic()
+    plugin.setup()
+    while not plugin.ready():
+        if time.monotonic() - start > plugin.ready_timeout:
+            raise TimeoutError(
+                f"plugin {plugin.name} not ready after {plugin.ready_timeout}s"
+            )
+        time.sleep(plugin.ready_interval)
+    logging.info(f"Plugin setup for {plugin.name} took {time.monotonic() - start:.3f}s")
+
+
+def _teardown_plugin(plugin: PluginSetup) -> None:
+    """Call teardown() of the plugin and log any error."""
+    start = time.monotonic()
+    try:
+        plugin.teardown()
+    except Exception as err:  # pylint: disable=broad-except
+        logging.error(f"Error: plugin teardown for {plugin.name} failed: {err}")
+    logging.info(
+        f"Plugin teardown for {plugin.name} took {time.monotonic() - start:.3f}s"
+    )
+
+
+# Variables that the shell sets by itself and that therefore do not influence
+# the result of sourcing files in Environment.init_from_shell:
+_volatile_shell_vars = {"PWD", "OLDPWD", "SHLVL", "_"}
+
+# Variables that cannot be replaced by markers in Engine._write_activate_flat,
+# because the shell interprets them or sets them itself:
+_unmarkable_shell_vars = _volatile_shell_vars | {
+    "BASHOPTS",
+    "BASH_ENV",
+    "ENV",
+    "EUID",
+    "IFS",
+    "PPID",
+    "PS4",
+    "SHELLOPTS",
+    "UID",
+}
+
+_shell_var_regex = re.compile(r"\$\{?([A-Za-z_][A-Za-z0-9_]*)")
+
+
+def _shell_template(value: str, markers: Dict[str, str]) -> str:
+    """Return value as a quoted shell word with markers replaced by variables.
+
+    The markers argument maps each marker to the name of the variable it
+    stands in for.
+    """
+    if not markers:
+        return shlex.quote(value)
+    regex = re.compile("|".join(re.escape(m) for m in sorted(markers, key=len)[::-1]))
+    if not regex.search(value):
+        return shlex.quote(value)
+
+    # Within double quotes, only these characters need to be escaped:
+    escape = re.compile(r'([\\"$`])')
+    result = '"'
+    pos = 0
+    for match in regex.finditer(value):
+        result += escape.sub(r"\\\1", value[pos : match.start()])
+        result += "${" + markers[match.group()] + "}"
+        pos = match.end()
+    result += escape.sub(r"\\\1", value[pos:])
+    return result + '"'
+
+
+def _fd_is_open(fd: int) -> bool:
+    """Return true if the file descriptor is open in this process."""
+    try:
+        os.fstat(fd)
+        return True
+    except OSError:
+        return False
+
+
+# Shared libraries, such as libfoo.so or libfoo.so.1.2.
+_shared_library_regex = re.compile(r"\.so(\.[0-9]+)*$")
+
+
+def _link_first(src_dir: str, dst_dir: Path, select=None) -> None:
+    """Link the entries of src_dir into dst_dir, unless they are already there.
+
+    Entries of earlier directories take precedence, like in a search path.
+    """
+    with os.scandir(src_dir) as it:
+        for entry in sorted(it, key=lambda x: x.name):
+            if select is not None and not select(entry):
+                continue
+            dst = dst_dir / entry.name
+            if not os.path.lexists(dst):
+                dst.symlink_to(entry.path)
+
+
+def _remove_files(paths: List[Path]) -> None:
+    for path in paths:
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def _read_conan_requires(conaninfo: Path) -> List[str]:
+    """Return the fully resolved package references from a conaninfo.txt file."""
+    if not conaninfo.exists():
+        return []
+    refs = []
+    in_section = False
+    with conaninfo.open() as file:
+        for line in file:
+            line = line.strip()
+            if line.startswith("["):
+                in_section = line == "[full_requires]"
+            elif in_section and line != "":
+                refs.append(line)
+    return sorted(refs)
+
+
+def _normalize_ref(ref: str) -> str:
+    """Return name/version@user/channel of a reference, without revisions or package ID."""
+    ref = ref.split(":", 1)[0].split("#", 1)[0]
+    return ref[: -len("@_/_")] if ref.endswith("@_/_") else ref
 
 
 def _find_plugin_setups(file: Path) -> List[Type[PluginSetup]]:
@@ -348,27 +523,117 @@ def _find_plugin_setups(file: Path) -> List[Type[PluginSetup]]:
     mod = importlib.util.module_from_spec(spec)
     spec.loader.exec_module(mod)
 
-    # Find all PluginSetup sub-classes. This requires PluginSetup to be
-    # imported into the namespace.
-    return mod.PluginSetup.__subclasses__()
+    # Find all PluginSetup sub-classes, including sub-classes of sub-classes.
+    # This requires PluginSetup to be imported into the namespace.
+    result: List[Type[PluginSetup]] = []
+    queue = list(mod.PluginSetup.__subclasses__())
+    while queue:
+        cls = queue.pop(0)
+        if cls not in result:
+            result.append(cls)
+            queue.extend(cls.__subclasses__())
+    return result
+
+
+# Plugin setups that have been imported by this process, by file path:
+_loaded_plugin_setups: Dict[str, List[Type[PluginSetup]]] = {}
+
+
+def _index_plugin_setups(file: Path) -> Optional[List[Dict[str, Optional[str]]]]:
+    """Find all PluginSetups in a Python module without importing it.
+
+    For each PluginSetup sub-class, the class name and the name and plugin
+    class attributes are returned, if they are literal strings. Sub-classes
+    that other sub-classes derive from and that have neither a name nor a
+    plugin are left out. If the file cannot be parsed, None is returned.
+    """
+    try:
+        tree = ast.parse(file.read_text(), filename=str(file))
+    except (OSError, SyntaxError, ValueError) as err:
+        logging.info(f"Cannot index plugin setup {file}: {err}")
+        return None
+
+    def base_name(base: ast.expr) -> Optional[str]:
+        if isinstance(base, ast.Name):
+            return base.id
+        if isinstance(base, ast.Attribute):
+            return base.attr
+        return None
+
+    # Sub-classes of sub-classes defined in the same file count as well.
+    setup_classes = {"PluginSetup"}
+    derived_from = set()
+    setups = []
+    for node in tree.body:
+        if not isinstance(node, ast.ClassDef):
+            continue
+        if not any(base_name(b) in setup_classes for b in node.bases):
+            continue
+        setup_classes.add(node.name)
+        derived_from.update(base_name(b) for b in node.bases)
+        setup: Dict[str, Optional[str]] = {"class": node.name, "name": None, "plugin": None}
+        for stmt in node.body:
+            if not isinstance(stmt, ast.Assign) or len(stmt.targets) != 1:
+                continue
+            target = stmt.targets[0]
+            if not isinstance(target, ast.Name) or target.id not in ["name", "plugin"]:
+                continue
+            try:
+                value = ast.literal_eval(stmt.value)
+            except ValueError:
+                continue
+            if isinstance(value, str):
+                setup[target.id] = value
+        setups.append(setup)
+
+    # Base classes of other setups without a name or plugin are not set up.
+    return [
+        s
+        for s in setups
+        if s["class"] not in derived_from or s["name"] is not None or s["plugin"] is not None
+    ]
+
+
+def _setup_is_referenced(setup: Dict[str, Optional[str]], references: Set[str]) -> bool:
+    """Return true if the name or plugin of the setup occurs in references."""
+    name = setup.get("name")
+    plugin = setup.get("plugin")
+    if name is None and plugin is None:
+        # We cannot tell what this setup is for, so it is always needed.
+        return True
+    if name is not None and name in references:
+        return True
+    if plugin is not None:
+        plugin_name = os.path.basename(plugin)
+        for ref in references:
+            if os.path.basename(ref) in [plugin_name, os.path.splitext(plugin_name)[0]]:
+                return True
+    return False
 
 
 class Engine:
     """Engine represents the configuration of a single execution of cloe-engine."""
 
-    anonymous_file_regex = "^(/proc/self|/dev)/fd/[0-9]+$"
+    anonymous_file_regex = "^(/proc/self|/dev)/fd/([0-9]+)$"
     engine_path = "cloe-engine"
 
+    # Increment this whenever the contents of the runtime directory change
+    # in a way that makes existing runtime directories unusable.
+    cache_version = 1
+
     def __init__(self, conf: Configuration, conanfile: str = None):
         # Set options:
         self.conan_path = Path(conf._conf["conan_path"])
         self.shell_path = Path(conf._conf["shell_path"])
         self.relay_anonymous_files = conf._conf["relay_anonymous_files"]
+        self.concurrent_plugin_setup = conf._conf["concurrent_plugin_setup"]
+        self.relay_pass_fds = conf._conf["relay_pass_fds"]
+        self.compact_library_path = conf._conf.get("compact_library_path", False)
         if conanfile is None:
             self._read_conf_profile(conf)
         else:
             self._read_anonymous_profile(conanfile)
-        self.runtime_dir = Path(conf.profile_runtime(self.profile))
+        self.profile_runtime_dir = Path(conf.profile_runtime(self.profile))
         self.engine_pre_args = conf._conf["engine"]["pre_arguments"]
         self.engine_post_args = conf._conf["engine"]["post_arguments"]
         self.abort_recursive_shell = True
@@ -376,14 +641,31 @@ class Engine:
         self.conan_args = []
         self.conan_options = []
         self.conan_settings = []
+        self.build_policy = None
         self.capture_output = True
+        self.log_file = None
+        self.telemetry_dir: Optional[Path] = None
+        self.telemetry_interval = 1.0
+        self.profiler: Optional[str] = None
+        self.profiler_args: List[str] = []
+        self.run_uuid: Optional[str] = None
+        self.runtime_cache = conf.runtime_cache()
+        self._runtime_lock: Optional[Tuple[Path, int]] = None
+        self._users_lock: Optional[int] = None
+        self._staging_dir: Optional[Path] = None
+        self._lockfile_stat = None
+        self._lockfile_hash = None
+        self._resolved_packages: Optional[List[str]] = None
+        self.resolve_interval = (
+            float(conf._conf.get("runtime_cache", {}).get("resolve_interval_hours", 1)) * 3600
+        )
 
         logging.info(f"Profile name: {self.profile}")
         logging.info("Configuration:")
         logging.info(textwrap.indent(self.profile_data, "    "))
 
         # Prepare runtime environment
-        logging.info(f"Runtime directory: {self.runtime_dir}")
+        logging.info(f"Profile runtime directory: {self.profile_runtime_dir}")
 
     def _read_conf_profile(self, conf: Configuration) -> None:
         self.profile = conf.current_profile
@@ -399,17 +681,260 @@ class Engine:
         hasher.update(self.profile_data.encode())
         self.profile = hasher.hexdigest()
 
+    @property
+    def runtime_dir(self) -> Path:
+        """Return the runtime directory for the current profile inputs.
+
+        Each distinct combination of profile contents and Conan arguments,
+        options, and settings gets its own runtime directory within the
+        profile runtime directory, so that they do not clobber each other.
+
+        While the runtime directory is prepared, this is the staging directory
+        that it is prepared in.
+        """
+        if self._staging_dir is not None:
+            return self._staging_dir
+        return self.profile_runtime_dir / self.runtime_key()
+
+    def _profile_inputs(self) -> Dict[str, Union[int, str, List[str]]]:
+        """Return everything that determines the dependency graph of the profile."""
+        return {
+            "version": self.cache_version,
+            "profile": self.profile_data,
+            "conan_args": self.conan_args,
+            "conan_options": self.conan_options,
+            "conan_settings": self.conan_settings,
+        }
+
+    def _runtime_inputs(self) -> Dict[str, Union[int, str, List[str], None]]:
+        """Return everything that determines the contents of the runtime directory."""
+        inputs = self._profile_inputs()
+        inputs["lockfile"] = self._lockfile_digest()
+        if self.compact_library_path:
+            inputs["compact_library_path"] = True
+        return inputs
+
+    @staticmethod
+    def _digest(inputs: Mapping) -> str:
+        hasher = hashlib.blake2b(digest_size=10)
+        hasher.update(json.dumps(inputs, sort_keys=True).encode())
+        return hasher.hexdigest()
+
+    def runtime_key(self) -> str:
+        """Return a digest of the inputs to the runtime directory."""
+        return self._digest(self._runtime_inputs())
+
+    def lockfile_path(self) -> Path:
+        """Return the path to the lockfile of the profile.
+
+        The lockfile is stored next to the runtime directories of the profile,
+        since it depends on the same inputs, apart from itself.
+        """
+        return self.profile_runtime_dir / f"{self._digest(self._profile_inputs())}.lock"
+
+    def _lockfile_digest(self) -> Optional[str]:
+        """Return the digest of the lockfile, if it exists."""
+        try:
+            stat = self.lockfile_path().stat()
+        except FileNotFoundError:
+            return None
+        # The runtime directory is queried often, so only re-hash on change:
+        if self._lockfile_stat != (stat.st_mtime_ns, stat.st_size):
+            self._lockfile_stat = (stat.st_mtime_ns, stat.st_size)
+            self._lockfile_hash = file_digest(self.lockfile_path())
+        return self._lockfile_hash
+
     def runtime_env_path(self) -> Path:
         """Return the path to the list of pruned environment variables."""
         return self.runtime_dir / "environment_all.sh.env"
 
+    def runtime_snapshot_path(self) -> Path:
+        """Return the path to the snapshot of the resolved runtime environment."""
+        return self.runtime_dir / "environment_snapshot.json"
+
+    def runtime_manifest_path(self) -> Path:
+        """Return the path to the manifest describing the runtime directory."""
+        return self.runtime_dir / "launcher_manifest.json"
+
+    def _write_runtime_manifest(self, env: Environment) -> None:
+        """Write the manifest that is used to validate the runtime directory.
+
+        The manifest records the inputs, the package references that Conan
+        resolved, and the modification times of all package directories that
+        the environment refers to. If a package is rebuilt or removed from the
+        Conan cache, its directory changes and the runtime directory is
+        no longer considered up-to-date.
+        """
+        base_paths = Environment._shell_env.get("PATH", "").split(os.pathsep)
+        package_paths = {}
+        for key in ["PATH", "LD_LIBRARY_PATH"]:
+            for path in env.get_list(key, default=[]):
+                if path in base_paths or not os.path.isdir(path):
+                    continue
+                package_paths[path] = os.stat(path).st_mtime_ns
+        manifest = {
+            "key": self.runtime_key(),
+            "inputs": self._runtime_inputs(),
+            "packages": _read_conan_requires(self.runtime_dir / "conaninfo.txt"),
+            "package_paths": package_paths,
+        }
+        logging.debug(f"Write: {self.runtime_manifest_path()}")
+        with self.runtime_manifest_path().open("w") as file:
+            json.dump(manifest, file, indent=2, sort_keys=True)
+        self.resolve_stamp_path().touch()
+
+    def resolve_stamp_path(self) -> Path:
+        """Return the path to the file whose mtime is the last time the profile was resolved."""
+        return self.runtime_dir / ".resolved"
+
+    def _resolved_packages_match(self, manifest: Dict[str, Any]) -> bool:
+        """Return false if the profile now resolves to other packages than in the manifest.
+
+        Without a lockfile, version ranges in the profile may resolve to
+        newer packages once they are published. Resolving the graph takes
+        a moment, so this is checked at most once per resolve_interval.
+        With a lockfile, the inputs already pin the resolved packages.
+        """
+        if self.resolve_interval <= 0 or self._lockfile_digest() is not None:
+            return True
+        if "packages" not in manifest:
+            return True
+        stamp = self.resolve_stamp_path()
+        try:
+            if time.time() - stamp.stat().st_mtime < self.resolve_interval:
+                return True
+        except FileNotFoundError:
+            pass
+        # The graph is resolved only once per launch, even if validity is
+        # checked again under the prepare lock.
+        if self._resolved_packages is None:
+            try:
+                self._resolved_packages = self.resolve_packages()
+            except ChildProcessError:
+                logging.warning("Cannot resolve profile, using existing runtime directory.")
+                return True
+        recorded = {_normalize_ref(x) for x in manifest["packages"]}
+        if set(self._resolved_packages) != recorded:
+            logging.info("Profile resolves to other packages now.")
+            return False
+        stamp.touch()
+        return True
+
+    def runtime_is_valid(self) -> bool:
+        """Return true if the runtime directory exists and is up-to-date."""
+        manifest_path = self.runtime_manifest_path()
+        if not manifest_path.exists():
+            logging.info("Runtime directory is not prepared.")
+            return False
+        try:
+            with manifest_path.open() as file:
+                manifest = json.load(file)
+        except ValueError:
+            logging.info(f"Runtime manifest is corrupt: {manifest_path}")
+            return False
+        if manifest.get("key") != self.runtime_key():
+            logging.info("Runtime manifest does not match profile.")
+            return False
+        for path, mtime in manifest.get("package_paths", {}).items():
+            try:
+                if os.stat(path).st_mtime_ns != mtime:
+                    logging.info(f"Package directory was modified: {path}")
+                    return False
+            except FileNotFoundError:
+                logging.info(f"Package directory was removed: {path}")
+                return False
+        return self._resolved_packages_match(manifest)
+
+    def prepare_lock_path(self) -> Path:
+        """Return the path to the file that is locked while the runtime directory is prepared."""
+        return self.profile_runtime_dir / f"{self.runtime_key()}.prepare"
+
+    def _prepare_runtime_dir_once(self, use_cache: bool = True) -> None:
+        """Prepare the runtime directory, unless a concurrent launch just did.
+
+        Only one launch prepares a runtime directory at a time. Others wait
+        for it and then use the runtime directory it prepared, instead of
+        running Conan again. Since another launch may also have finished
+        just before the lock was taken, validity is checked again under the
+        lock, unless use_cache is false and the lock was free.
+        """
+        self.profile_runtime_dir.mkdir(parents=True, exist_ok=True)
+        lock = self.prepare_lock_path()
+        fd = lock_file(lock, blocking=False)
+        waited = fd is None
+        if waited:
+            logging.info("Waiting for concurrent preparation of runtime directory ...")
+            fd = lock_file(lock)
+        try:
+            if (use_cache or waited) and self.runtime_is_valid():
+                logging.debug("Using runtime directory prepared concurrently.")
+                return
+            logging.debug("Initializing runtime directory ...")
+            self._prepare_runtime_dir()
+        finally:
+            os.close(fd)
+
     def _prepare_runtime_dir(self) -> None:
-        """Clean and create runtime directory."""
-        self.clean()
-        logging.debug(f"Create: {self.runtime_dir}")
-        self.runtime_dir.mkdir(parents=True)
+        """Prepare the runtime directory in a staging directory and move it into place.
+
+        The runtime directory is replaced at once, so that concurrent launches
+        never see a partially prepared one. The files that refer to the staging
+        directory are relocated before.
+        """
+        final_dir = self.runtime_dir
+        staging_dir = final_dir.with_name(f".{final_dir.name}.prepare-{owner_tag()}")
+        if staging_dir.exists():
+            shutil.rmtree(staging_dir, ignore_errors=True)
+        logging.debug(f"Create: {staging_dir}")
+        staging_dir.mkdir(parents=True)
+        self._staging_dir = staging_dir
+        try:
+            self._populate_runtime_dir()
+            relocate_files(staging_dir, str(staging_dir), str(final_dir))
+            self._refresh_activate_flat_sources(str(staging_dir), str(final_dir))
+        except BaseException:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            raise
+        finally:
+            self._staging_dir = None
+        self._replace_runtime_dir(staging_dir, final_dir)
+
+    def _replace_runtime_dir(self, staging_dir: Path, final_dir: Path) -> None:
+        """Move the prepared staging directory into place of the runtime directory.
+
+        The previous runtime directory is removed right away, unless other
+        launches still use it; then the runtime cache removes it once they exit.
+        """
+        replaced_dir = final_dir.with_name(f".{final_dir.name}.replaced-{owner_tag()}")
+        try:
+            os.rename(final_dir, replaced_dir)
+        except FileNotFoundError:
+            replaced_dir = None
+        logging.debug(f"Move: {staging_dir} -> {final_dir}")
+        os.rename(staging_dir, final_dir)
+        if replaced_dir is None:
+            return
+        if self._users_lock is not None:
+            os.close(self._users_lock)
+            self._users_lock = None
+        self.runtime_cache.remove_replaced(replaced_dir)
+
+    def _refresh_activate_flat_sources(self, old: str, new: str) -> None:
+        """Record the sources of activate_flat.sh after they were relocated."""
+        sources_path = self.activate_flat_path().with_suffix(".json")
+        if not sources_path.exists():
+            return
+        sources = {
+            k.replace(old, new, 1): v
+            for k, v in fingerprint_files(self._snapshot_sources()).items()
+        }
+        with sources_path.open("w") as file:
+            json.dump({"sources": sources}, file, indent=2)
+
+    def _populate_runtime_dir(self) -> None:
+        """Write the contents of the runtime directory."""
         self._prepare_virtualenv()
-        self._write_cloe_env()
+        conan_env = self._write_cloe_env()
         self._write_activate_all(
             [
                 # From Conan VirtualRunEnv (!= virtualrunenv) generator:
@@ -426,9 +951,11 @@ class Engine:
                 self.runtime_dir / "environment_cloe.sh.env",
             ]
         )
+        self._write_activate_flat()
         self._write_prompt_sh()
         self._write_bashrc()
         self._write_zshrc()
+        self._write_runtime_manifest(conan_env)
 
     def _write_prompt_sh(self) -> None:
         """Write prompt.sh file."""
@@ -460,7 +987,7 @@ class Engine:
                 source ~/.bashrc
             fi
             OLD_PS1="$PS1"
-            source "$(dirname "$BASH_SOURCE[0]")/activate_all.sh"
+            source "$(dirname "$BASH_SOURCE[0]")/activate_flat.sh"
             PS1="$OLD_PS1"
             source "$(dirname "$BASH_SOURCE[0]")/prompt.sh"
             """
@@ -485,7 +1012,7 @@ class Engine:
                 fi
             done
             OLD_PS1="$PS1"
-            source "{self.runtime_dir}/activate_all.sh"
+            source "{self.runtime_dir}/activate_flat.sh"
             PS1="$OLD_PS1"
             source "{self.runtime_dir}/prompt.sh"
             """
@@ -494,8 +1021,11 @@ class Engine:
         with zshrc_file.open("w") as file:
             file.write(zshrc_data)
 
-    def _write_cloe_env(self) -> None:
-        """Derive important CLOE_ variables and write environment_cloe.sh.env file."""
+    def _write_cloe_env(self) -> Environment:
+        """Derive important CLOE_ variables and write environment_cloe.sh.env file.
+
+        Returns the environment of the Conan run environment it was derived from.
+        """
         conanrun = self.runtime_dir / "conanrun.sh"    # From newer VirtualRunEnv generator
         activate_run = self.runtime_dir / "activate_run.sh"  # From older virtualrunenv generator
         if conanrun.exists():
@@ -524,12 +1054,16 @@ class Engine:
             if self.abort_recursive_shell:
                 sys.exit(2)
 
+        if self.compact_library_path:
+            self._write_library_dir(env)
+
         cloe_env = Environment({})
         cloe_env.set("CLOE_SHELL", self.runtime_env_path())
         cloe_env.set("CLOE_PROFILE_HASH", self.profile)
         cloe_env.set("CLOE_ENGINE", self._extract_engine_path(env))
         cloe_env.path_set("CLOE_PLUGIN_PATH", self._extract_plugin_paths(env))
         cloe_env.export(self.runtime_dir / "environment_cloe.sh.env")
+        return env
 
     def _write_activate_all(self, source_files: List[Path], env_files: List[Path]) -> None:
         """Write activate_all.sh file."""
@@ -566,6 +1100,92 @@ class Engine:
         with activate_file.open("w") as file:
             file.write(activate_data)
 
+    def activate_flat_path(self) -> Path:
+        """Return the path to the pre-expanded activation script."""
+        return self.runtime_dir / "activate_flat.sh"
+
+    def _write_activate_flat(self) -> None:
+        """Write activate_flat.sh, a pre-expanded equivalent of activate_all.sh.
+
+        Sourcing activate_all.sh evaluates every line of the environment files
+        in a sub-shell, which is slow for large profiles. Instead, we source it
+        here with every variable that it refers to set to a unique marker,
+        and write the resulting variables as plain export statements, in which
+        the markers are replaced by references to the original variables.
+        Sourcing the result is equivalent to sourcing activate_all.sh, except
+        that command substitutions are only evaluated once, here.
+        """
+        sources = self._snapshot_sources()
+        referenced = set()
+        for path in sources:
+            with path.open(errors="replace") as file:
+                referenced.update(_shell_var_regex.findall(file.read()))
+        referenced -= _unmarkable_shell_vars
+
+        base_env = dict(Environment({}).shell_env())
+        marked_env = dict(base_env)
+        markers = {}
+        for key in sorted(referenced):
+            marker = f"__cloe_launch_{key}__"
+            if key == "PATH":
+                # PATH needs to remain usable while sourcing, so we append
+                # a non-existent directory as the marker.
+                marker = base_env.get("PATH", "") + os.pathsep + "/" + marker
+            markers[marker] = key
+            marked_env[key] = marker
+
+        # Sourcing without markers tells us which variables are exported, since
+        # a marked variable may also just be a shell variable in the sources.
+        plain_vars = self._source_activate_all(base_env)
+        marked_vars = self._source_activate_all(marked_env)
+
+        lines = ["# Generated by cloe-launch from activate_all.sh, do not edit."]
+        for key in sorted(plain_vars.keys() - _volatile_shell_vars):
+            if base_env.get(key) == plain_vars[key]:
+                continue
+            value = marked_vars.get(key, plain_vars[key])
+            lines.append(f"export {key}={_shell_template(value, markers)}")
+        for key in sorted(base_env.keys() - plain_vars.keys() - _volatile_shell_vars):
+            lines.append(f"unset {key}")
+
+        logging.debug(f"Write: {self.activate_flat_path()}")
+        with self.activate_flat_path().open("w") as file:
+            file.write("\n".join(lines) + "\n")
+        with self.activate_flat_path().with_suffix(".json").open("w") as file:
+            json.dump({"sources": fingerprint_files(sources)}, file, indent=2)
+
+    def _source_activate_all(self, shell_env: Dict[str, str]) -> Dict[str, str]:
+        """Return the environment after sourcing activate_all.sh in a shell."""
+        activate_all = shlex.quote((self.runtime_dir / "activate_all.sh").as_posix())
+        cmd = [
+            str(self.shell_path),
+            "-c",
+            f"source {activate_all} &>/dev/null && env -0",
+        ]
+        result = run_cmd(cmd, env=shell_env)
+        env_vars = {}
+        for item in result.stdout.split("\0"):
+            kv = item.split("=", 1)
+            if len(kv) == 2:
+                env_vars[kv[0]] = kv[1]
+        return env_vars
+
+    def _ensure_activate_flat(self) -> None:
+        """Re-generate activate_flat.sh if any of its inputs changed."""
+        sources_path = self.activate_flat_path().with_suffix(".json")
+        try:
+            with sources_path.open() as file:
+                sources = json.load(file)["sources"]
+            if self.activate_flat_path().exists() and set(sources.keys()) == {
+                str(x) for x in self._snapshot_sources()
+            }:
+                if fingerprints_match(sources):
+                    return
+        except (FileNotFoundError, KeyError, ValueError):
+            pass
+        logging.info("Re-generating activate_flat.sh, since its inputs changed.")
+        self._write_activate_flat()
+
     def _prepare_virtualenv(self) -> None:
         # Get conan to create a virtualenv AND virtualrunenv for us:
         # One gives us the LD_LIBRARY_PATH and the other gives us env_info
@@ -580,14 +1200,132 @@ class Engine:
         ]
         for arg in self.conan_args:
             conan_cmd.append(arg)
+        conan_cmd.extend(self._conan_build_args())
+        conan_cmd.extend(self._conan_graph_args())
+        conan_cmd.append(self.profile_path)
+        self._run_cmd(conan_cmd, must_succeed=True)
+
+    def _conan_build_args(self) -> List[str]:
+        """Return the --build arguments for the build policy.
+
+        The build policy may be a single policy, such as "outdated", or a list
+        of policies and patterns, which are passed to Conan one by one.
+        An empty policy builds everything.
+        """
+        if self.build_policy is None:
+            return []
+        policies = self.build_policy
+        if isinstance(policies, str):
+            policies = [policies]
+        return ["--build" if x == "" else f"--build={x}" for x in policies]
+
+    def _conan_graph_args(self) -> List[str]:
+        """Return the arguments that select the dependency graph for Conan."""
+        if self.lockfile_path().exists():
+            # Options and settings are already captured in the lockfile,
+            # and Conan does not accept them in combination with it.
+            logging.info(f"Using lockfile: {self.lockfile_path()}")
+            return ["--lockfile", str(self.lockfile_path())]
+        return self._conan_options_and_settings()
+
+    def _conan_info(self, build_policy: Optional[str] = None) -> List[Any]:
+        """Return the output of 'conan info' for the profile.
+
+        This resolves the dependency graph, which neither downloads nor
+        builds anything. With --build, Conan writes the list of references
+        to build instead of the graph.
+        """
+        self.profile_runtime_dir.mkdir(parents=True, exist_ok=True)
+        info_file = self.profile_runtime_dir / f"conan_info.{owner_tag()}.json"
+        conan_cmd = [str(self.conan_path), "info", "--json", str(info_file)]
+        conan_cmd.extend(self.conan_args)
+        if build_policy is not None:
+            conan_cmd.append("--build" if build_policy == "" else f"--build={build_policy}")
+        conan_cmd.extend(self._conan_graph_args())
+        conan_cmd.append(self.profile_path)
+        try:
+            self._run_cmd(conan_cmd, must_succeed=True)
+            with info_file.open() as file:
+                return json.load(file)
+        finally:
+            if info_file.exists():
+                info_file.unlink()
+
+    def build_plan(self, build_policy: str = "outdated") -> List[str]:
+        """Return the references of the packages Conan would build for the profile."""
+        refs = set()
+        for node in self._conan_info(build_policy):
+            if isinstance(node, str):
+                refs.add(node)
+            elif node.get("binary") == "Build" and node.get("is_ref", True):
+                refs.add(node["reference"])
+        return sorted(refs)
+
+    def resolve_packages(self) -> List[str]:
+        """Return the references of the packages the profile resolves to now.
+
+        Like the full_requires of conaninfo.txt, these are the packages that
+        the profile requires, directly or indirectly, but not its build
+        requirements. References are normalized with _normalize_ref.
+        """
+        nodes = [x for x in self._conan_info() if isinstance(x, dict)]
+        by_ref = {_normalize_ref(x["reference"]): x for x in nodes if x.get("is_ref", True)}
+        roots = [x for x in nodes if not x.get("is_ref", True)]
+        if not roots:
+            return sorted(by_ref)
+        refs: Set[str] = set()
+        queue = [_normalize_ref(r) for x in roots for r in x.get("requires", [])]
+        while queue:
+            ref = queue.pop()
+            if ref in refs or ref not in by_ref:
+                continue
+            refs.add(ref)
+            queue.extend(_normalize_ref(r) for r in by_ref[ref].get("requires", []))
+        return sorted(refs)
+
+    def _conan_options_and_settings(self) -> List[str]:
+        result = []
         for option in self.conan_options:
-            conan_cmd.append("-o")
-            conan_cmd.append(option)
+            result.append("-o")
+            result.append(option)
         for setting in self.conan_settings:
-            conan_cmd.append("-s")
-            conan_cmd.append(setting)
+            result.append("-s")
+            result.append(setting)
+        return result
+
+    def lock(self) -> Path:
+        """Capture the dependency graph of the profile in a lockfile.
+
+        Subsequent preparations of the runtime directory install exactly the
+        packages in the lockfile, instead of resolving version ranges again.
+        """
+        lockfile = self.lockfile_path()
+        lockfile_tmp = lockfile.with_name(f"{lockfile.name}.{owner_tag()}.tmp")
+        self.profile_runtime_dir.mkdir(parents=True, exist_ok=True)
+        conan_cmd = [
+            str(self.conan_path),
+            "lock",
+            "create",
+            "--lockfile-out",
+            str(lockfile_tmp),
+        ]
+        conan_cmd.extend(self.conan_args)
+        conan_cmd.extend(self._conan_options_and_settings())
         conan_cmd.append(self.profile_path)
-        self._run_cmd(conan_cmd, must_succeed=True)
+        try:
+            self._run_cmd(conan_cmd, must_succeed=True)
+            os.replace(lockfile_tmp, lockfile)
+        finally:
+            if lockfile_tmp.exists():
+                lockfile_tmp.unlink()
+        logging.info(f"Write: {lockfile}")
+        return lockfile
+
+    def unlock(self) -> None:
+        """Remove the lockfile of the profile, if it exists."""
+        if self.lockfile_path().exists():
+            logging.debug(f"Remove: {self.lockfile_path()}")
+            self.lockfile_path().unlink()
 
     def _extract_engine_path(self, env: Environment) -> Path:
         """Return the first cloe-engine we find in the PATH."""
@@ -604,80 +1342,498 @@ class Engine:
         logging.error("  However, unconvential or unsupported package configuration may also trigger this.")
         sys.exit(2)
 
+    def library_dir(self) -> Path:
+        """Return the directory that the libraries of all packages are linked into."""
+        return self.runtime_dir / "lib"
+
+    def _write_library_dir(self, env: Environment) -> None:
+        """Link the shared libraries in LD_LIBRARY_PATH into the library directory.
+
+        The dynamic loader searches every directory in LD_LIBRARY_PATH for
+        every library that cloe-engine and its plugins load, and there is one
+        per Conan package, which is slow, in particular on network
+        filesystems. The libraries, and the plugins in the cloe subdirectory
+        of each, are therefore linked into a single directory, in the order
+        the loader would find them. The directories that were linked are
+        recorded, so that _compact_library_path can replace them.
+        """
+        lib_dir = self.library_dir()
+        plugin_dir = lib_dir / "cloe"
+        plugin_dir.mkdir(parents=True, exist_ok=True)
+        base_paths = Environment._shell_env.get("LD_LIBRARY_PATH", "").split(os.pathsep)
+        linked: List[str] = []
+        for path in env.get_list("LD_LIBRARY_PATH", default=[]):
+            if path in base_paths or path in linked or not os.path.isdir(path):
+                continue
+            _link_first(
+                path,
+                lib_dir,
+                lambda x: not x.is_dir() and _shared_library_regex.search(x.name) is not None,
+            )
+            if os.path.isdir(os.path.join(path, "cloe")):
+                _link_first(os.path.join(path, "cloe"), plugin_dir)
+            linked.append(path)
+        logging.debug(f"Linked {len(linked)} library directories into {lib_dir}")
+        with (lib_dir / "compacted.json").open("w") as file:
+            json.dump({"paths": linked}, file, indent=2)
+
+    def _compact_library_path(self, paths: List[str]) -> List[str]:
+        """Return the library path with the linked directories replaced by the
+        library directory, if it is compacted."""
+        if not self.compact_library_path:
+            return paths
+        try:
+            with (self.library_dir() / "compacted.json").open() as file:
+                linked = set(json.load(file)["paths"])
+        except (OSError, ValueError, KeyError):
+            return paths
+        result = []
+        for path in paths:
+            if not path:
+                # An empty entry, which is left if LD_LIBRARY_PATH was unset,
+                # makes the loader search the working directory as well.
+                continue
+            if path not in linked:
+                result.append(path)
+            elif str(self.library_dir()) not in result:
+                result.append(str(self.library_dir()))
+        return result
+
     def _extract_plugin_paths(self, env: Environment) -> List[Path]:
-        """Return all Cloe plugin paths we find in LD_LIBRARY_PATH."""
+        """Return all Cloe plugin paths we find in LD_LIBRARY_PATH.
+
+        If the library path is compacted, these are all linked into the
+        cloe subdirectory of the library directory.
+        """
         plugin_paths = []
-        for libdir in env.get_list("LD_LIBRARY_PATH", default=[]):
+        for libdir in self._compact_library_path(env.get_list("LD_LIBRARY_PATH", default=[])):
             pp = Path(libdir) / "cloe"
             if pp.exists():
                 plugin_paths.append(pp)
         return plugin_paths
 
-    def _extract_plugin_setups(self, lib_paths: List[Path]) -> List[Type[PluginSetup]]:
+    def plugin_setup_index_path(self) -> Path:
+        """Return the path to the index of plugin setups in the runtime directory."""
+        return self.runtime_dir / "plugin_setups.json"
+
+    def _plugin_setup_index(self, lib_paths: List[Path]) -> Dict[str, Dict]:
+        """Return the index of all plugin setups in the plugin directories.
+
+        The index is cached in the runtime directory and only the entries
+        of files that have changed since are rebuilt.
+        """
+        index_path = self.plugin_setup_index_path()
+        cached: Dict[str, Dict] = {}
+        if index_path.exists():
+            try:
+                with index_path.open() as file:
+                    data = json.load(file)
+                if data.get("version") == self.cache_version:
+                    cached = data["files"]
+            except (OSError, ValueError, KeyError) as err:
+                logging.info(f"Cannot read plugin setup index: {err}")
+
+        index: Dict[str, Dict] = {}
         for lib_dir in lib_paths:
-            for file in lib_dir.iterdir():
+            for file in sorted(lib_dir.iterdir()):
                 if not file.suffix == ".py":
                     continue
-                path = lib_dir / file
+                stat = file.stat()
+                entry = cached.get(str(file))
+                if (
+                    entry is None
+                    or entry["mtime_ns"] != stat.st_mtime_ns
+                    or entry["size"] != stat.st_size
+                ):
+                    logging.debug(f"Index plugin setup: {file}")
+                    entry = {
+                        "mtime_ns": stat.st_mtime_ns,
+                        "size": stat.st_size,
+                        "setups": _index_plugin_setups(file),
+                    }
+                index[str(file)] = entry
+
+        if index != cached and index_path.parent.exists():
+            logging.debug(f"Write: {index_path}")
+            index_tmp = index_path.with_name(f"{index_path.name}.{os.getpid()}.tmp")
+            with index_tmp.open("w") as file:
+                json.dump({"version": self.cache_version, "files": index}, file, indent=2)
+            os.replace(index_tmp, index_path)
+        return index
+
+    def _extract_plugin_setups(
+        self, lib_paths: List[Path], references: Optional[Set[str]] = None
+    ) -> List[Type[PluginSetup]]:
+        """Import the plugin setups that are referenced and return them.
+
+        If references is None, all plugin setups are imported. Otherwise
+        only the modules containing a plugin setup whose name or plugin
+        occurs in references are imported.
+        """
+        result: List[Type[PluginSetup]] = []
+        for path, entry in self._plugin_setup_index(lib_paths).items():
+            setups = entry["setups"]
+            if setups is None or references is None:
+                selected = None
+            else:
+                selected = [
+                    s["class"] for s in setups if _setup_is_referenced(s, references)
+                ]
+                if not selected:
+                    logging.debug(f"Skip unreferenced plugin setup: {path}")
+                    continue
+            if path not in _loaded_plugin_setups:
                 logging.info(f"Loading plugin setup: {path}")
-                _find_plugin_setups(path)
-        return PluginSetup.__subclasses__()
+                module = os.path.splitext(path)[0]
+                _loaded_plugin_setups[path] = [
+                    x for x in _find_plugin_setups(Path(path)) if x.__module__ == module
+                ]
+            for setup_type in _loaded_plugin_setups[path]:
+                if selected is None or setup_type.__name__ in selected:
+                    result.append(setup_type)
+        return result
+
+    def stackfile_references(self, args: List[str]) -> Optional[Set[str]]:
+        """Return all strings in the stackfiles that cloe-engine will read.
+
+        Stackfiles are found heuristically among the engine arguments, which
+        is sufficient, since all we need is a superset of the strings. If
+        the stackfiles cannot be determined, None is returned.
+        """
+        engine_args = list(self.engine_pre_args) + list(args) + list(self.engine_post_args)
+        files = []
+        for arg in engine_args:
+            if arg == "-":
+                # Stackfile is read from stdin, which we cannot inspect.
+                return None
+            if re.match(self.anonymous_file_regex, arg):
+                # Reading the file would consume it, it must be relayed.
+                return None
+            if arg.startswith("-") or not os.path.isfile(arg):
+                continue
+            if arg.endswith(".so"):
+                continue
+            files.append(Path(arg))
+        if "--no-system-confs" not in engine_args:
+            files.extend(system_stackfiles())
+        return stackfile_strings(files)
+
+    def _use_runtime_dir(self) -> None:
+        """Protect the runtime directory from eviction while we are running.
+
+        The lock is held until the process exits, including cloe-engine or
+        the shell that the process is replaced with.
+        """
+        if self._runtime_lock is not None:
+            if self._runtime_lock[0] == self.runtime_dir:
+                return
+            os.close(self._runtime_lock[1])
+        self._runtime_lock = (self.runtime_dir, self.runtime_cache.acquire(self.runtime_dir))
+        self.runtime_cache.gc_if_due()
+
+    def _mark_runtime_dir_used(self) -> None:
+        """Mark the runtime directory as used and keep it while we are running.
+
+        Unlike the lock against eviction, this lock is on the runtime directory
+        itself, so that it is kept if it is replaced while we are running.
+        """
+        if self._users_lock is not None:
+            os.close(self._users_lock)
+        self._users_lock = self.runtime_cache.use(self.runtime_dir)
 
-    def _prepare_runtime_env(self, use_cache: bool = False) -> Environment:
-        if self.runtime_env_path().exists() and use_cache:
+    def _prepare_runtime_env(self, use_cache: bool = True) -> Environment:
+        logging.info(f"Runtime directory: {self.runtime_dir}")
+        self._use_runtime_dir()
+        self._resolved_packages = None
+        preserve = None if not self.preserve_env else list(os.environ.keys())
+        if use_cache and self.runtime_is_valid():
             logging.debug("Re-using existing runtime directory.")
+            env = self._read_env_snapshot(preserve)
+            if env is not None:
+                self._mark_runtime_dir_used()
+                return env
         else:
-            logging.debug("Initializing runtime directory ...")
-            self._prepare_runtime_dir()
+            self._prepare_runtime_dir_once(use_cache)
 
         # Get environment variables we need:
-        return Environment(
+        env = Environment(
             self.runtime_dir / "activate_all.sh",
-            preserve=None if not self.preserve_env else list(os.environ.keys()),
+            preserve=preserve,
             source_file=True,
         )
+        self._write_env_snapshot(env)
+        self._mark_runtime_dir_used()
+        return env
+
+    def _snapshot_sources(self) -> List[Path]:
+        """Return the files that the resolved runtime environment is derived from."""
+        sources = [self.runtime_dir / "activate_all.sh"]
+        for pattern in ["conanrun*.sh", "activate_run.sh", "environment*.sh.env"]:
+            sources.extend(self.runtime_dir.glob(pattern))
+        return sorted(set(sources) - {self.runtime_env_path()})
+
+    @staticmethod
+    def _shell_env_digest(shell_env: Mapping[str, str]) -> str:
+        """Return a digest of the shell environment, ignoring volatile variables."""
+        stable = {k: v for k, v in shell_env.items() if k not in _volatile_shell_vars}
+        hasher = hashlib.blake2b(digest_size=20)
+        hasher.update(json.dumps(stable, sort_keys=True).encode())
+        return hasher.hexdigest()
+
+    def _write_env_snapshot(self, env: Environment) -> None:
+        """Persist the resolved runtime environment for subsequent launches.
+
+        Resolving the environment requires sourcing activate_all.sh in a shell.
+        The result only depends on the files that are sourced and on the shell
+        environment they are sourced in, so we record both alongside the
+        result, which allows _read_env_snapshot to skip the shell entirely.
+        """
+        snapshot = {
+            "version": self.cache_version,
+            "shell_env": self._shell_env_digest(env.shell_env()),
+            "sources": fingerprint_files(self._snapshot_sources()),
+            "environment": env.as_dict(),
+        }
+        self._dump_env_snapshot(snapshot)
+
+    def _dump_env_snapshot(self, snapshot: Dict[str, Any]) -> None:
+        """Replace the snapshot atomically, since concurrent launches read it."""
+        logging.debug(f"Write: {self.runtime_snapshot_path()}")
+        snapshot_path = self.runtime_snapshot_path()
+        snapshot_tmp = snapshot_path.with_name(f"{snapshot_path.name}.{os.getpid()}.tmp")
+        with snapshot_tmp.open("w") as file:
+            json.dump(snapshot, file, indent=2, sort_keys=True)
+        os.replace(snapshot_tmp, snapshot_path)
+
+    def _read_env_snapshot(
+        self, preserve: Optional[List[str]]
+    ) -> Optional[Environment]:
+        """Return the resolved runtime environment from the snapshot if it is valid."""
+        snapshot_path = self.runtime_snapshot_path()
+        if not snapshot_path.exists():
+            return None
+        try:
+            with snapshot_path.open() as file:
+                snapshot = json.load(file)
+        except FileNotFoundError:
+            # The runtime directory is being replaced concurrently.
+            return None
+        except ValueError:
+            logging.info(f"Environment snapshot is corrupt: {snapshot_path}")
+            return None
+        if snapshot.get("version") != self.cache_version:
+            return None
+
+        env = Environment(dict(snapshot["environment"]), preserve=preserve)
+        shell_env = env.shell_env()
+        if snapshot.get("shell_env") != self._shell_env_digest(shell_env):
+            logging.info("Environment snapshot was made in a different environment.")
+            return None
+        sources = snapshot.get("sources", {})
+        if set(sources.keys()) != {str(x) for x in self._snapshot_sources()}:
+            logging.info("Environment snapshot sources have changed.")
+            return None
+        mtimes = {k: v["mtime_ns"] for k, v in sources.items()}
+        if not fingerprints_match(sources):
+            logging.info("Environment snapshot sources have been modified.")
+            return None
+        if mtimes != {k: v["mtime_ns"] for k, v in sources.items()}:
+            # Sources were touched but not modified, store new times:
+            self._dump_env_snapshot(snapshot)
+
+        # The shell would have set these variables from the current process:
+        env.set("PWD", os.getcwd())
+        for key in _volatile_shell_vars - {"PWD"}:
+            if key in shell_env:
+                env.set(key, shell_env[key])
+        logging.debug(f"Using environment snapshot: {snapshot_path}")
+        return env
 
     def _write_runtime_env(self, env: Environment) -> None:
         logging.debug(f"Write: {self.runtime_env_path()}")
         env.export(self.runtime_env_path())
 
-    def _process_arg(self, src_path) -> str:
-        # FIXME: It may be possible to replace this with the Popen
-        # pass_fds argument.
+    def stackfile_cache_dir(self) -> Path:
+        """Return the directory that YAML stackfiles are converted into."""
+        return self.runtime_dir / "stackfiles"
 
-        if not re.match(self.anonymous_file_regex, src_path):
-            return src_path
+    def compile_stackfiles(self, args: List[str]) -> List[str]:
+        """Replace YAML stackfiles in args by their JSON versions.
 
-        dst_file = src_path.replace("/", "_")
-        dst_path = self.runtime_dir / dst_file
+        Raises StackfileError if a YAML stackfile cannot be converted.
+        """
+        compiler = None
+        result = []
+        for arg in args:
+            path = Path(arg)
+            if arg.startswith("-") or not is_yaml(path) or not path.is_file():
+                result.append(arg)
+                continue
+            if compiler is None:
+                compiler = StackfileCompiler(self.stackfile_cache_dir())
+            result.append(str(compiler.compile(path)))
+        return result
+
+    def relay_dir(self) -> Path:
+        """Return the directory that anonymous files are copied into."""
+        return self.runtime_dir / "relay"
+
+    def _copy_anonymous_file(self, src_path: str) -> Path:
+        """Copy the anonymous file into a unique file in the relay directory.
+
+        The file is copied in chunks, so that large files do not need to fit
+        into memory, and concurrent launches do not overwrite each other.
+        """
+        self.relay_dir().mkdir(exist_ok=True)
+        fd, dst_path = tempfile.mkstemp(
+            prefix=f"{owner_tag()}.{src_path.replace('/', '_')}-",
+            suffix=".json",
+            dir=self.relay_dir(),
+        )
         logging.info(f"Relay anonymous file {src_path} into {dst_path}")
         with open(src_path, "rb") as src:
-            with open(dst_path, "wb") as dst:
-                dst.write(src.read())
-        return dst_path
+            with open(fd, "wb") as dst:
+                shutil.copyfileobj(src, dst, 1 << 16)
+        return Path(dst_path)
+
+    def _relay_args(
+        self, args: List[str], copy: bool = False
+    ) -> Tuple[List[str], List[int], List[Path]]:
+        """Relay anonymous files in args to cloe-engine.
+
+        When invoking cloe-launch with a line like:
+
+            cloe-launch exec -- dump <(cat your-file) <(cat next-file)
+
+        the arguments are of the form `/proc/self/fd/N` or `/dev/fd/N`. These
+        are only valid in our process, so either the file descriptors need
+        to be passed on to cloe-engine, which is the default, or the files
+        need to be copied, which is necessary if the launcher needs to read
+        them too (copy is true) or the descriptors are not open.
 
-    def _engine_cmd(self, args) -> List[str]:
+        Return the relayed arguments, the file descriptors to pass on, and
+        the files that were created, which the caller should remove once
+        cloe-engine has exited.
+        """
+        if not self.relay_anonymous_files:
+            return args, [], []
+
+        result: List[str] = []
+        pass_fds: List[int] = []
+        copies: List[Path] = []
+        for arg in args:
+            match = re.match(self.anonymous_file_regex, arg)
+            if match is None:
+                result.append(arg)
+                continue
+            fd = int(match.group(2))
+            if not copy and self.relay_pass_fds and _fd_is_open(fd):
+                logging.info(f"Relay anonymous file {arg} by passing descriptor {fd}")
+                pass_fds.append(fd)
+                result.append(arg)
+                continue
+            try:
+                dst_path = self._copy_anonymous_file(arg)
+            except BaseException:
+                _remove_files(copies)
+                raise
+            copies.append(dst_path)
+            result.append(str(dst_path))
+        return result, pass_fds, copies
+
+    def engine_cmd(self, args: List[str]) -> List[str]:
+        """Return the command that runs cloe-engine with the arguments."""
         result = [self.engine_path]
         result.extend(self.engine_pre_args)
-
-        # When invoking cloe-launch with a line like:
-        #
-        #  cloe-launch exec -- dump <(cat your-file) <(cat next-file)
-        #
-        # we need to read these files, which are in the format `/proc/self/fd/XYZ`,
-        # store them in the runtime directory, and pass them on to the cloe
-        # executable.
-        if self.relay_anonymous_files:
-            result.extend([self._process_arg(a) for a in args])
-        else:
-            result.extend(args)
+        result.extend(args)
         result.extend(self.engine_post_args)
         return result
 
-    def _prepare_plugin_setups(self, env: Environment) -> List[PluginSetup]:
+    @staticmethod
+    def _parse_run_args(args: List[str]) -> Optional[Tuple[int, List[str], Optional[str]]]:
+        """Return the position of the run subcommand in args, its stackfiles,
+        and the simulation UUID it is given, or None if there is none."""
+        value_options = {"-l", "--level", "-p", "--plugin-path", "-i", "--ignore"}
+        i = 0
+        while i < len(args) and args[i].startswith("-"):
+            i += 2 if args[i] in value_options else 1
+        if i >= len(args) or args[i] != "run":
+            return None
+
+        files = []
+        sim_uuid = None
+        rest = iter(args[i + 1 :])
+        for arg in rest:
+            if arg in ("-u", "--uuid"):
+                sim_uuid = next(rest, sim_uuid)
+            elif arg.startswith("--uuid="):
+                sim_uuid = arg[len("--uuid=") :]
+            elif arg in ("-J", "--json-indent"):
+                next(rest, None)
+            elif arg == "-" or not arg.startswith("-"):
+                files.append(arg)
+        return i, files, sim_uuid
+
+    def run_output_dir(self, args: List[str], env: Environment) -> Optional[Path]:
+        """Return the output directory of cloe-engine run with the arguments.
+
+        The directory is determined by dumping the stack, in the same way
+        that cloe-engine does. This is not possible if the stackfiles can
+        only be read once, such as stdin, or if args does not contain the
+        run subcommand, in which case None is returned.
+        """
+        parsed = self._parse_run_args(args)
+        if parsed is None:
+            return None
+        i, files, sim_uuid = parsed
+        if sim_uuid is None:
+            sim_uuid = env.get("CLOE_SIMULATION_UUID")
+        for file in files:
+            if file == "-" or re.match(self.anonymous_file_regex, file):
+                return None
+
+        dump_env = dict(env.as_dict())
+        if sim_uuid is not None:
+            dump_env["CLOE_SIMULATION_UUID"] = sim_uuid
+        cmd = self.engine_cmd(args[:i] + ["dump"] + files)
+        logging.debug(f"Exec: {' '.join(cmd)}")
+        try:
+            proc = subprocess.run(
+                cmd,
+                check=True,
+                env=dump_env,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+            )
+            conf = json.loads(proc.stdout.decode()).get("engine", {})
+        except (OSError, ValueError, AttributeError, subprocess.CalledProcessError):
+            return None
+
+        # This corresponds to SimulationResult::set_output_dir in cloe-engine.
+        output_path = (conf.get("output") or {}).get("path")
+        registry_path = conf.get("registry_path")
+        if not output_path:
+            return None
+        if sim_uuid is not None:
+            output_path = output_path.replace("${CLOE_SIMULATION_UUID}", sim_uuid)
+        if os.path.isabs(output_path):
+            return Path(output_path)
+        if registry_path:
+            return Path(registry_path) / output_path
+        return None
+
+    def prepare_plugin_setups(
+        self, env: Environment, references: Optional[Set[str]] = None
+    ) -> List[PluginSetup]:
+        """Load the plugin setups and let them augment the environment.
+
+        If references is not None, only plugin setups that are referenced
+        are loaded, see _extract_plugin_setups.
+        """
         # Augment environment:
         plugin_paths = self._extract_plugin_paths(env)
-        plugin_setup_types = self._extract_plugin_setups(plugin_paths)
+        plugin_setup_types = self._extract_plugin_setups(plugin_paths, references)
         plugin_setups = []
         for setup_type in plugin_setup_types:
             setup = setup_type(env)
@@ -687,21 +1843,30 @@ class Engine:
         return plugin_setups
 
     def clean(self) -> None:
-        """Clean the runtime directory."""
-        if self.runtime_dir.exists():
-            logging.debug(f"Remove: {self.runtime_dir}")
-            shutil.rmtree(self.runtime_dir, ignore_errors=True)
+        """Clean all runtime directories of the profile.
+
+        Runtime directories that other launches use are skipped. The lockfile
+        is kept; it is only removed by unlock.
+        """
+        if not self.profile_runtime_dir.exists():
+            return
+        for path in sorted(self.profile_runtime_dir.iterdir()):
+            if path.name.startswith(".") or not path.is_dir():
+                continue
+            if not self.runtime_cache.evict(path):
+                logging.warning(f"Warning: skip runtime directory in use: {path}")
 
     def shell(
         self,
         arguments: List[str] = None,
-        use_cache: bool = False,
+        use_cache: bool = True,
     ) -> None:
         """Launch a SHELL with the environment variables adjusted."""
         env = self._prepare_runtime_env(use_cache)
         self._write_runtime_env(env)
+        self._ensure_activate_flat()
 
-        plugin_setups = self._prepare_plugin_setups(env)
+        plugin_setups = self.prepare_plugin_setups(env)
         shell = os.getenv("SHELL", "/bin/bash")
 
         # Print the final environment, if desired
@@ -734,73 +1899,209 @@ class Engine:
         if arguments is not None:
             cmd.extend(arguments)
         logging.debug(f"Exec: {' '.join(cmd)}")
+        if self._runtime_lock is not None:
+            # Keep the runtime directory from being evicted while the shell runs.
+            os.set_inheritable(self._runtime_lock[1], True)
+        if self._users_lock is not None:
+            os.set_inheritable(self._users_lock, True)
         os.execvpe(shell, cmd, env.as_dict())
 
     def activate(
         self,
-        use_cache: bool = False,
+        use_cache: bool = True,
     ) -> None:
         """Print shell commands to activate a cloe-engine environment."""
         env = self._prepare_runtime_env(use_cache)
         self._write_runtime_env(env)
+        self._ensure_activate_flat()
 
         print("# Please see `cloe-launch activate --help` before activating this.")
         print()
-        print(f"source {self.runtime_dir / 'activate_all.sh'}")
+        print(f"source {self.activate_flat_path()}")
         print(f"source {self.runtime_dir / 'prompt.sh'}")
 
-    def prepare(self, build_policy: str = "outdated") -> None:
+    def prepare(self, build_policy: Union[str, List[str]] = "outdated") -> None:
         """Prepare (by downloading or building) dependencies for the profile."""
-        self.capture_output = False
-        if build_policy == "":
-            self.conan_args.append("--build")
-        else:
-            self.conan_args.append(f"--build={build_policy}")
+        if self.log_file is None:
+            self.capture_output = False
+        self.build_policy = build_policy
         self._prepare_runtime_env(use_cache=False)
 
+    def runtime_env(self, use_cache: bool = True) -> Environment:
+        """Return the runtime environment, preparing it if necessary.
+
+        If the library path is compacted, this is the environment that
+        cloe-engine runs in, while shells keep the full library path.
+        """
+        env = self._prepare_runtime_env(use_cache)
+        if env.has("LD_LIBRARY_PATH"):
+            env.path_set(
+                "LD_LIBRARY_PATH",
+                self._compact_library_path(env.get_list("LD_LIBRARY_PATH", default=[])),
+            )
+        self._write_runtime_env(env)
+        return env
+
     def exec(
         self,
         args: List[str],
-        use_cache: bool = False,
+        use_cache: bool = True,
         debug: bool = False,
         override_env: Dict[str, str] = None,
     ) -> subprocess.CompletedProcess:
         """Launch cloe-engine with the environment variables adjusted and with
         plugin setup and teardown."""
-        env = self._prepare_runtime_env(use_cache)
-        self._write_runtime_env(env)
-        plugin_setups = self._prepare_plugin_setups(env)
+        env = self.runtime_env(use_cache)
+
+        # Plugins are torn down even if setup or cloe-engine fails, but only
+        # if their setup was started.
+        args = self.compile_stackfiles(args)
+        args, pass_fds, relay_files = self._relay_args(args)
+        started: List[PluginSetup] = []
+        try:
+            # Only load the plugin setups of plugins that the stackfiles refer to.
+            references = self.stackfile_references(args)
+            plugin_setups = self.prepare_plugin_setups(env, references)
+            self.setup_plugins(plugin_setups, started)
+
+            # Override environment setup.
+            if override_env is not None:
+                for k in override_env.keys():
+                    env[k] = override_env[k]
+
+            # Print the final environment, if desired
+            logging.debug(f"Environment: {env}")
+
+            # The simulation UUID is fixed, so that the run can be found
+            # in the run index by the launcher.
+            parsed = self._parse_run_args(args)
+            if parsed is not None:
+                self.run_uuid = parsed[2] or env.get("CLOE_SIMULATION_UUID")
+                if self.run_uuid is None:
+                    self.run_uuid = str(uuid.uuid4())
+                    env["CLOE_SIMULATION_UUID"] = self.run_uuid
+
+            # Run cloe engine:
+            self.engine_path = env["CLOE_ENGINE"]
+            cmd = self.engine_cmd(args)
+            if debug:
+                cmd.insert(0, "gdb")
+                cmd.insert(1, "--args")
+            profiler = None
+            if self.profiler is not None:
+                profiler = self._prepare_profiler(args, env)
+                cmd = profiler.wrap(cmd)
+            logging.info(f"Exec: {' '.join(cmd)}")
+            logging.info("---")
+            print(end="", flush=True)
+            if self.telemetry_dir is None:
+                result = subprocess.run(
+                    cmd, check=False, env=env.as_dict(), pass_fds=pass_fds
+                )
+            else:
+                result = self._exec_with_telemetry(cmd, env, pass_fds)
+            if profiler is not None:
+                print(profiler.summary(), file=sys.stderr)
+        finally:
+            self.teardown_plugins(started)
+            _remove_files(relay_files)
+        return result
+
+    def _prepare_profiler(self, args: List[str], env: Environment):
+        """Return the profiler that cloe-engine should be run with.
+
+        The profiler output is written to the output directory of the run.
+        So that cloe-engine uses the same directory that the stack was
+        dumped with, the simulation UUID is fixed in the environment.
+        """
+        from cloe_launch.profiling import profilers
+
+        assert self.profiler is not None
+        profiler_type = profilers[self.profiler]
+        profiler_type.check(env.as_dict())
+        if not env.has("CLOE_SIMULATION_UUID"):
+            env["CLOE_SIMULATION_UUID"] = str(uuid.uuid4())
+        output_dir = self.run_output_dir(args, env)
+        if output_dir is None:
+            output_dir = Path(f"profile-{env['CLOE_SIMULATION_UUID']}")
+            logging.warning(
+                f"Warning: cannot determine output directory, using: {output_dir}"
+            )
+        output_dir.mkdir(parents=True, exist_ok=True)
+        return profiler_type(output_dir, self.profiler_args, env.as_dict())
+
+    def _exec_with_telemetry(
+        self, cmd: List[str], env: Environment, pass_fds: List[int]
+    ) -> subprocess.CompletedProcess:
+        """Run the command while sampling its resource usage.
 
-        # Initialize plugin setups:
-        for plugin in plugin_setups:
+        The time series is written to telemetry.csv and the summary to
+        telemetry.json in the telemetry directory.
+        """
+        from cloe_launch.telemetry import Sampler
+        from cloe_launch.telemetry import format_summary
+
+        assert self.telemetry_dir is not None
+        self.telemetry_dir.mkdir(parents=True, exist_ok=True)
+        with subprocess.Popen(cmd, env=env.as_dict(), pass_fds=pass_fds) as proc:
+            sampler = Sampler(
+                proc.pid, self.telemetry_dir / "telemetry.csv", self.telemetry_interval
+            )
+            with sampler:
+                try:
+                    proc.wait()
+                except BaseException:
+                    proc.kill()
+                    raise
+        summary = sampler.summary()
+        with (self.telemetry_dir / "telemetry.json").open("w") as file:
+            json.dump(summary, file, indent=2)
+            file.write("\n")
+        print(f"Telemetry: {format_summary(summary)}", file=sys.stderr)
+        return subprocess.CompletedProcess(cmd, proc.returncode)
+
+    def setup_plugins(
+        self, plugin_setups: List[PluginSetup], started: List[PluginSetup]
+    ) -> None:
+        """Set up all plugins, concurrently if so configured.
+
+        Each plugin is appended to started before its setup is called. If
+        the setup of any plugin fails, the first error is raised once all
+        setups that were started have finished.
+        """
+
+        def setup(plugin: PluginSetup) -> None:
             logging.debug(
                 f"Initializing plugin setup for {plugin.name} at {plugin.plugin}"
             )
-            plugin.setup()
+            started.append(plugin)
+            _setup_plugin(plugin)
 
-        # Override environment setup.
-        if override_env is not None:
-            for k in override_env.keys():
-                env[k] = override_env[k]
+        if not self.concurrent_plugin_setup or len(plugin_setups) < 2:
+            for plugin in plugin_setups:
+                setup(plugin)
+            return
 
-        # Print the final environment, if desired
-        logging.debug(f"Environment: {env}")
+        with ThreadPoolExecutor(max_workers=len(plugin_setups)) as executor:
+            futures = [executor.submit(setup, x) for x in plugin_setups]
+        for future in futures:
+            future.result()
 
-        # Run cloe engine:
-        self.engine_path = env["CLOE_ENGINE"]
-        cmd = self._engine_cmd(args)
-        if debug:
-            cmd.insert(0, "gdb")
-            cmd.insert(1, "--args")
-        logging.info(f"Exec: {' '.join(cmd)}")
-        logging.info("---")
-        print(end="", flush=True)
-        result = subprocess.run(cmd, check=False, env=env.as_dict())
-        for setup in plugin_setups:
-            setup.teardown()
-        return result
+    def teardown_plugins(self, plugin_setups: List[PluginSetup]) -> None:
+        """Tear down all plugins, concurrently if so configured."""
+        if not self.concurrent_plugin_setup or len(plugin_setups) < 2:
+            for plugin in reversed(plugin_setups):
+                _teardown_plugin(plugin)
+            return
+
+        with ThreadPoolExecutor(max_workers=len(plugin_setups)) as executor:
+            for plugin in plugin_setups:
+                executor.submit(_teardown_plugin, plugin)
 
     def _run_cmd(self, cmd, must_succeed=True) -> subprocess.CompletedProcess:
         return run_cmd(
-            cmd, must_succeed=must_succeed, capture_output=self.capture_output
+            cmd,
+            must_succeed=must_succeed,
+            capture_output=self.capture_output,
+            log_file=self.log_file,
         )
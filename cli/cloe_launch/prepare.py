@@ -0,0 +1,156 @@
+# pylint: disable=logging-fstring-interpolation
+
+"""
+This module contains the concurrent preparation of multiple profiles.
+
+Preparing a profile means downloading and building all of its packages,
+which can take a long time. Many profiles share packages, so preparing them
+naively in parallel would build shared packages several times, at best.
+Instead, we first compute which packages each profile needs to have built,
+assign each of these packages to exactly one profile, its owner, and let
+profiles wait for the owners of the packages they need before they install.
+"""
+
+import logging
+import threading
+import time
+
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict
+from typing import List
+from typing import Optional
+
+from cloe_launch.exec import Engine
+
+
+class PrepareJob:
+    """PrepareJob tracks the preparation of a single profile."""
+
+    def __init__(self, name: str, engine: Engine):
+        self.name = name
+        self.engine = engine
+        self.log_path = engine.profile_runtime_dir / "prepare.log"
+        self.needs_build: List[str] = []
+        self.owned: List[str] = []
+        self.owners: List["PrepareJob"] = []
+        self.status = "pending"
+        self.error: Optional[str] = None
+        self.duration = 0.0
+        self.done = threading.Event()
+
+    def failed(self) -> bool:
+        """Return true if preparation failed or was skipped."""
+        return self.status not in ["pending", "ok"]
+
+
+def _describe_error(err: BaseException) -> str:
+    if isinstance(err, ChildProcessError):
+        return "conan failed"
+    if isinstance(err, SystemExit):
+        return f"aborted with exit code {err.code}"
+    return str(err) or type(err).__name__
+
+
+def _plan(job: PrepareJob, build_policy: str) -> None:
+    """Find out which packages the profile of the job would build."""
+    job.engine.profile_runtime_dir.mkdir(parents=True, exist_ok=True)
+    with job.log_path.open("w") as log_file:
+        job.engine.log_file = log_file
+        try:
+            job.needs_build = job.engine.build_plan(build_policy)
+        except (Exception, SystemExit) as err:  # pylint: disable=broad-except
+            job.status = "plan failed"
+            job.error = _describe_error(err)
+        finally:
+            job.engine.log_file = None
+
+
+def _assign_owners(jobs: List[PrepareJob]) -> None:
+    """Assign each package that needs building to the first job that needs it.
+
+    Since the owner of a package is always the first job that needs it, jobs
+    only ever wait for jobs that precede them, so there can be no cycles.
+    """
+    owners: Dict[str, PrepareJob] = {}
+    for job in jobs:
+        if job.failed():
+            continue
+        for ref in job.needs_build:
+            owner = owners.setdefault(ref, job)
+            if owner is job:
+                job.owned.append(ref)
+            elif owner not in job.owners:
+                job.owners.append(owner)
+
+
+def _prepare(job: PrepareJob) -> None:
+    """Prepare the profile of the job once the owners it depends on are done."""
+    try:
+        if job.failed():
+            return
+        for owner in job.owners:
+            owner.done.wait()
+            if owner.failed():
+                job.status = "skipped"
+                job.error = f"dependency of {owner.name} failed"
+                return
+
+        start = time.monotonic()
+        with job.log_path.open("a") as log_file:
+            job.engine.log_file = log_file
+            try:
+                # Only build the packages this job owns; all others have
+                # either been built by their owners or can be downloaded.
+                job.engine.prepare(build_policy=job.owned)
+                job.status = "ok"
+            except (Exception, SystemExit) as err:  # pylint: disable=broad-except
+                job.status = "failed"
+                job.error = _describe_error(err)
+            finally:
+                job.engine.log_file = None
+                job.duration = time.monotonic() - start
+    finally:
+        job.done.set()
+
+
+def prepare_profiles(
+    jobs: List[PrepareJob], workers: int = 1, build_policy: str = "outdated"
+) -> None:
+    """Prepare the profiles of all jobs with a bounded number of workers.
+
+    The output of Conan for each profile is written to the log file of each
+    job. The status of each job is updated in place.
+    """
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        logging.info("Resolving dependency graphs ...")
+        futures: List[Future] = [
+            executor.submit(_plan, job, build_policy) for job in jobs
+        ]
+        for future in futures:
+            future.result()
+
+        _assign_owners(jobs)
+        for job in jobs:
+            if job.owned:
+                logging.info(f"Profile {job.name} builds: {', '.join(job.owned)}")
+
+        # Jobs are started in order and only wait for preceding jobs, which
+        # are therefore already running or done, so the pool cannot deadlock.
+        logging.info("Preparing profiles ...")
+        futures = [executor.submit(_prepare, job) for job in jobs]
+        for future in futures:
+            future.result()
+
+
+def print_summary(jobs: List[PrepareJob]) -> None:
+    """Print a table of the status of each job."""
+    width = max([len("PROFILE")] + [len(job.name) for job in jobs])
+    print(f"{'PROFILE':<{width}}  {'STATUS':<11}  {'BUILT':>5}  {'TIME':>8}  LOG")
+    for job in jobs:
+        print(
+            f"{job.name:<{width}}  {job.status:<11}  {len(job.owned):>5}  "
+            f"{job.duration:>7.1f}s  {job.log_path}"
+        )
+        if job.error is not None:
+            print(f"{'':<{width}}  -> {job.error}")
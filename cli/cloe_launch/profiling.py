@@ -0,0 +1,292 @@
+# pylint: disable=logging-fstring-interpolation
+
+"""
+This module contains the profilers that cloe-engine can be run with.
+
+Each profiler wraps the cloe-engine command, writes its output into a
+directory, and can summarize the output as a short list of the functions
+where the most time is spent or the most memory is allocated:
+
+    perf        CPU time by sampling, with call graphs (perf.data)
+    callgrind   Instructions by function (callgrind.out.<pid>)
+    massif      Heap usage over time (massif.out.<pid>)
+    heaptrack   Heap allocations by call stack (heaptrack.cloe-engine.*)
+
+The output files can be inspected further with the usual tools, such as
+perf report, kcachegrind, massif-visualizer, and heaptrack_gui.
+"""
+
+import logging
+import re
+import shutil
+import subprocess
+
+from pathlib import Path
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+from typing import Type
+
+
+class ProfilerError(Exception):
+    """ProfilerError signifies that a profiler cannot be used."""
+
+
+class Profiler:
+    """Profiler wraps cloe-engine in a profiling tool."""
+
+    name = ""
+    tools: List[str] = []
+
+    def __init__(
+        self,
+        output_dir: Path,
+        args: Optional[List[str]] = None,
+        env: Optional[Dict[str, str]] = None,
+    ):
+        self.output_dir = output_dir
+        self.args = args or []
+        self.env = env
+
+    @classmethod
+    def check(cls, env: Optional[Dict[str, str]] = None) -> None:
+        """Raise ProfilerError if the tools are not in the PATH of env."""
+        path = None if env is None else env.get("PATH")
+        for tool in cls.tools:
+            if shutil.which(tool, path=path) is None:
+                raise ProfilerError(f"cannot find {tool} for profiling with {cls.name}")
+
+    def wrap(self, cmd: List[str]) -> List[str]:
+        """Return the command that runs cmd with the profiler."""
+        raise NotImplementedError()
+
+    def output_files(self) -> List[Path]:
+        """Return the files the profiler has written."""
+        raise NotImplementedError()
+
+    def hot_functions(self, limit: int = 10) -> List[Tuple[str, str]]:
+        """Return the cost and name of the most expensive functions."""
+        raise NotImplementedError()
+
+    def summary(self, limit: int = 10) -> str:
+        """Return the most expensive functions as a human-readable string."""
+        try:
+            hot = self.hot_functions(limit)
+        except (OSError, subprocess.CalledProcessError) as err:
+            logging.warning(f"Warning: cannot summarize {self.name} output: {err}")
+            hot = []
+        lines = [
+            f"Profile ({self.name}): {', '.join(str(x) for x in self.output_files())}"
+        ]
+        lines.extend(f"  {cost:>14}  {name}" for cost, name in hot)
+        return "\n".join(lines)
+
+
+def _tool_output(cmd: List[str], env: Optional[Dict[str, str]]) -> str:
+    logging.debug(f"Exec: {' '.join(cmd)}")
+    proc = subprocess.run(
+        cmd,
+        check=True,
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    return proc.stdout.decode(errors="replace")
+
+
+class PerfProfiler(Profiler):
+    """PerfProfiler samples CPU time with perf record."""
+
+    name = "perf"
+    tools = ["perf"]
+
+    def data_file(self) -> Path:
+        return self.output_dir / "perf.data"
+
+    def wrap(self, cmd: List[str]) -> List[str]:
+        return (
+            ["perf", "record", "-g", "-o", str(self.data_file())]
+            + self.args
+            + ["--"]
+            + cmd
+        )
+
+    def output_files(self) -> List[Path]:
+        return [self.data_file()] if self.data_file().exists() else []
+
+    def hot_functions(self, limit: int = 10) -> List[Tuple[str, str]]:
+        if not self.data_file().exists():
+            return []
+        output = _tool_output(
+            [
+                "perf",
+                "report",
+                "-i",
+                str(self.data_file()),
+                "--stdio",
+                "--no-children",
+                "--sort",
+                "dso,symbol",
+                "-g",
+                "none",
+            ],
+            self.env,
+        )
+        return parse_perf_report(output)[:limit]
+
+
+def parse_perf_report(output: str) -> List[Tuple[str, str]]:
+    """Return the overhead and symbol of each line of perf report --stdio."""
+    result = []
+    for line in output.splitlines():
+        match = re.match(r"^\s*([0-9.]+%)\s+(\S.*)$", line)
+        if match:
+            result.append((match.group(1), " ".join(match.group(2).split())))
+    return result
+
+
+class ValgrindProfiler(Profiler):
+    """ValgrindProfiler runs one of the valgrind tools."""
+
+    tools = ["valgrind"]
+    prefix = ""
+
+    def wrap(self, cmd: List[str]) -> List[str]:
+        out_file = self.output_dir / f"{self.prefix}.%p"
+        return (
+            ["valgrind", f"--tool={self.name}", f"--{self.name}-out-file={out_file}"]
+            + self.args
+            + ["--"]
+            + cmd
+        )
+
+    def output_files(self) -> List[Path]:
+        return sorted(self.output_dir.glob(f"{self.prefix}.*"))
+
+
+class CallgrindProfiler(ValgrindProfiler):
+    """CallgrindProfiler counts instructions by function with callgrind."""
+
+    name = "callgrind"
+    tools = ["valgrind", "callgrind_annotate"]
+    prefix = "callgrind.out"
+
+    def hot_functions(self, limit: int = 10) -> List[Tuple[str, str]]:
+        result = []
+        for file in self.output_files():
+            output = _tool_output(
+                ["callgrind_annotate", "--inclusive=no", str(file)], self.env
+            )
+            result.extend(parse_callgrind_annotate(output))
+        result.sort(key=lambda x: -int(x[0].replace(",", "")))
+        return result[:limit]
+
+
+def parse_callgrind_annotate(output: str) -> List[Tuple[str, str]]:
+    """Return the instruction count and function of each line of callgrind_annotate."""
+    result = []
+    in_table = False
+    for line in output.splitlines():
+        if "file:function" in line:
+            in_table = True
+            continue
+        if not in_table:
+            continue
+        match = re.match(r"^\s*([0-9,]+)\s+(?:\(\s*[0-9.]+%\)\s+)?(\S.*)$", line)
+        if match:
+            result.append((match.group(1), match.group(2).strip()))
+        elif result and line.strip() == "":
+            # The table ends with an empty line.
+            break
+    return result
+
+
+class MassifProfiler(ValgrindProfiler):
+    """MassifProfiler measures heap usage over time with massif."""
+
+    name = "massif"
+    prefix = "massif.out"
+
+    def hot_functions(self, limit: int = 10) -> List[Tuple[str, str]]:
+        result = []
+        for file in self.output_files():
+            result.extend(parse_massif_peak(file.read_text(errors="replace")))
+        result.sort(key=lambda x: -x[0])
+        return [(f"{size:,}B", name) for size, name in result[:limit]]
+
+
+def parse_massif_peak(output: str) -> List[Tuple[int, str]]:
+    """Return the heap bytes and allocation site at the peak of massif output.
+
+    The allocation sites are the children of the root of the heap tree of
+    the peak snapshot, which are indented by one space.
+    """
+    result: List[Tuple[int, str]] = []
+    in_peak = False
+    for line in output.splitlines():
+        if line.startswith("heap_tree="):
+            in_peak = line == "heap_tree=peak"
+            continue
+        if not in_peak:
+            continue
+        if line.startswith("snapshot="):
+            break
+        match = re.match(r"^ n[0-9]+: ([0-9]+) (.*)$", line)
+        if match:
+            # Strip the code address: "0x4005B4: main (example.c:20)"
+            name = re.sub(r"^0x[0-9A-Fa-f]+: ", "", match.group(2))
+            result.append((int(match.group(1)), name))
+    return result
+
+
+class HeaptrackProfiler(Profiler):
+    """HeaptrackProfiler records heap allocations with heaptrack."""
+
+    name = "heaptrack"
+    tools = ["heaptrack", "heaptrack_print"]
+
+    def wrap(self, cmd: List[str]) -> List[str]:
+        out_file = self.output_dir / "heaptrack.cloe-engine"
+        return ["heaptrack", "-o", str(out_file)] + self.args + cmd
+
+    def output_files(self) -> List[Path]:
+        return sorted(self.output_dir.glob("heaptrack.cloe-engine*"))
+
+    def hot_functions(self, limit: int = 10) -> List[Tuple[str, str]]:
+        result = []
+        for file in self.output_files():
+            output = _tool_output(
+                [
+                    "heaptrack_print",
+                    "--print-peaks=1",
+                    "--print-allocators=0",
+                    "--print-temporary=0",
+                    "--print-leaks=0",
+                    f"--peak-limit={limit}",
+                    "--sub-peak-limit=0",
+                    str(file),
+                ],
+                self.env,
+            )
+            result.extend(parse_heaptrack_peaks(output))
+        return result[:limit]
+
+
+def parse_heaptrack_peaks(output: str) -> List[Tuple[str, str]]:
+    """Return the peak memory and function of each entry of heaptrack_print."""
+    result = []
+    lines = output.splitlines()
+    for i, line in enumerate(lines[:-1]):
+        match = re.match(r"^(\S+) peak memory consumed over [0-9]+ calls from$", line)
+        if match:
+            result.append((match.group(1), lines[i + 1].strip()))
+    return result
+
+
+profilers: Dict[str, Type[Profiler]] = {
+    "perf": PerfProfiler,
+    "callgrind": CallgrindProfiler,
+    "massif": MassifProfiler,
+    "heaptrack": HeaptrackProfiler,
+}
@@ -0,0 +1,376 @@
+# pylint: disable=logging-fstring-interpolation
+
+"""
+This module contains the index of simulation runs in an SQLite database.
+
+cloe-engine writes the config, result, triggers, and api_recording files of
+each run into its output directory, which by default is a directory named
+after the simulation UUID in the registry. The index contains one row per
+run, with the outcome and statistics from the result file and the location
+of the files, so that runs can be found with SQL instead of by parsing all
+files:
+
+    SELECT uuid, output_dir FROM runs
+    WHERE outcome = 'failure' AND finished > strftime('%s', 'now', '-7 days')
+      AND cycle_time_ms_max > 20
+
+The index is updated incrementally: for each directory that contains runs,
+the modification time of each run directory is recorded, and only the files
+of directories that changed since are read again.
+
+The launcher adds the profile of runs it starts to the index, since the
+output of cloe-engine does not contain it.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import time
+
+from pathlib import Path
+from typing import Any
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+# These correspond to the accumulators in SimulationStatistics in cloe-engine,
+# each of which is stored with the following aggregates.
+statistics = [
+    "cycle_time_ms",
+    "engine_time_ms",
+    "simulator_time_ms",
+    "controller_time_ms",
+    "padding_time_ms",
+    "controller_retries",
+]
+aggregates = {"min": "min", "max": "max", "mean": "mean", "std": "std_deviation"}
+
+# These are the default names of the output files of cloe-engine.
+output_files = {
+    "config": "config.json",
+    "result": "result.json",
+    "triggers": "triggers.json",
+    "api_recording": None,
+}
+
+columns = [
+    ("uuid", "TEXT PRIMARY KEY"),
+    ("output_dir", "TEXT"),
+    ("profile", "TEXT"),
+    ("profile_hash", "TEXT"),
+    ("stack_hash", "TEXT"),
+    ("outcome", "TEXT"),
+    ("exit_code", "INTEGER"),
+    ("launched", "REAL"),
+    ("finished", "REAL"),
+    ("elapsed_s", "REAL"),
+    ("steps", "INTEGER"),
+    ("sim_time_ms", "INTEGER"),
+    ("realtime_factor", "REAL"),
+    ("achievable_realtime_factor", "REAL"),
+]
+columns += [(f"{s}_{a}", "REAL") for s in statistics for a in aggregates]
+columns += [(f"{k}_file", "TEXT") for k in output_files]
+
+# Columns that are only known to the launcher and not from the output files.
+launch_columns = ["profile", "profile_hash", "exit_code", "launched"]
+result_columns = [c for c, _ in columns if c != "uuid" and c not in launch_columns]
+
+_duration_units = {"ns": 1e-9, "us": 1e-6, "ms": 1e-3, "s": 1.0}
+
+
+def parse_duration(value: Any) -> Optional[float]:
+    """Return the duration in seconds, as serialized by cloe-engine ("1.5s")."""
+    if isinstance(value, (int, float)):
+        return float(value)
+    if not isinstance(value, str):
+        return None
+    match = re.match(r"^([0-9.]+)(ns|us|ms|s)$", value)
+    if match is None:
+        return None
+    return float(match.group(1)) * _duration_units[match.group(2)]
+
+
+def parse_since(value: str) -> float:
+    """Return the time of a relative age like "7d", "12h", "30m", or "90s"."""
+    match = re.match(r"^([0-9.]+)([smhdw])$", value)
+    if match is None:
+        raise ValueError(f"invalid age, expected for example 7d or 12h: {value}")
+    factor = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}[match.group(2)]
+    return time.time() - float(match.group(1)) * factor
+
+
+def stack_hash(config: Any) -> str:
+    """Return the hash of a merged stack, without the output locations.
+
+    The output locations usually contain the simulation UUID, and would
+    otherwise make the hash of each run unique.
+    """
+    if isinstance(config, dict) and isinstance(config.get("engine"), dict):
+        config = dict(config)
+        engine = dict(config["engine"])
+        engine.pop("registry_path", None)
+        if isinstance(engine.get("output"), dict):
+            engine["output"] = dict(engine["output"])
+            engine["output"].pop("path", None)
+        config["engine"] = engine
+    data = json.dumps(config, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(data.encode()).hexdigest()[:32]
+
+
+def _read_json(path: Path) -> Optional[Any]:
+    try:
+        with path.open() as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def read_run(
+    output_dir: Path, run_uuid: Optional[str] = None
+) -> Optional[Dict[str, Any]]:
+    """Return the row of the run in the output directory, if there is one.
+
+    The UUID is taken from the result file, unless run_uuid is given.
+    """
+    config = _read_json(output_dir / "config.json")
+    files = dict(output_files)
+    if isinstance(config, dict):
+        try:
+            files.update(config["engine"]["output"]["files"])
+        except (KeyError, TypeError):
+            pass
+
+    def locate(name: Optional[str]) -> Optional[Path]:
+        if not name:
+            return None
+        path = Path(name) if os.path.isabs(name) else output_dir / name
+        return path if path.exists() else None
+
+    result_file = locate(files["result"])
+    if result_file is None:
+        return None
+    result = _read_json(result_file)
+    if not isinstance(result, dict):
+        return None
+
+    row: Dict[str, Any] = {
+        "uuid": run_uuid or result.get("uuid") or output_dir.name,
+        "output_dir": str(output_dir),
+        "stack_hash": None if config is None else stack_hash(config),
+        "outcome": result.get("outcome"),
+        "finished": result_file.stat().st_mtime,
+        "elapsed_s": parse_duration(result.get("elapsed")),
+    }
+    sync = result.get("simulation") or {}
+    row["steps"] = sync.get("step")
+    row["sim_time_ms"] = (sync.get("time") or {}).get("ms")
+    row["realtime_factor"] = sync.get("realtime_factor")
+    row["achievable_realtime_factor"] = sync.get("achievable_realtime_factor")
+    stats = result.get("statistics") or {}
+    for stat in statistics:
+        for agg, key in aggregates.items():
+            row[f"{stat}_{agg}"] = (stats.get(stat) or {}).get(key)
+    for key in output_files:
+        path = result_file if key == "result" else locate(files.get(key))
+        row[f"{key}_file"] = None if path is None else str(path)
+    return row
+
+
+class RunIndex:
+    """RunIndex is an SQLite index of simulation runs."""
+
+    version = 1
+
+    def __init__(self, path: Path):
+        self.path = path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(path), timeout=60.0)
+        self._migrate()
+
+    def close(self) -> None:
+        self.db.close()
+
+    def _migrate(self) -> None:
+        with self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+            )
+            row = self.db.execute(
+                "SELECT value FROM meta WHERE key = 'version'"
+            ).fetchone()
+            if row is not None and int(row[0]) != self.version:
+                # The index can always be rebuilt from the output files.
+                logging.info(
+                    f"Rebuild run index with version {self.version}: {self.path}"
+                )
+                self.db.execute("DROP TABLE IF EXISTS runs")
+                self.db.execute("DROP TABLE IF EXISTS dirs")
+            self.db.execute(
+                "INSERT OR REPLACE INTO meta VALUES ('version', ?)",
+                (str(self.version),),
+            )
+            schema = ", ".join(f"{c} {t}" for c, t in columns)
+            self.db.execute(f"CREATE TABLE IF NOT EXISTS runs ({schema})")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS dirs "
+                "(path TEXT PRIMARY KEY, mtime_ns INTEGER)"
+            )
+            for column in ["finished", "outcome", "profile", "stack_hash"]:
+                self.db.execute(
+                    f"CREATE INDEX IF NOT EXISTS runs_{column} ON runs ({column})"
+                )
+
+    def _upsert(self, rows: Iterable[Dict[str, Any]], keys: List[str]) -> None:
+        """Insert the rows or update the keys of existing rows.
+
+        This does not use the UPSERT syntax, since that requires SQLite 3.24.
+        """
+        for row in rows:
+            self.db.execute(
+                "INSERT OR IGNORE INTO runs (uuid) VALUES (?)", (row["uuid"],)
+            )
+            values = [row.get(k) for k in keys]
+            self.db.execute(
+                f"UPDATE runs SET {', '.join(f'{k} = ?' for k in keys)} WHERE uuid = ?",
+                values + [row["uuid"]],
+            )
+
+    def record_launch(
+        self,
+        run_uuid: str,
+        profile: Optional[str],
+        profile_hash: Optional[str],
+        exit_code: Optional[int] = None,
+        launched: Optional[float] = None,
+    ) -> None:
+        """Record what only the launcher knows about a run."""
+        row = {
+            "uuid": run_uuid,
+            "profile": profile,
+            "profile_hash": profile_hash,
+            "exit_code": exit_code,
+            "launched": launched or time.time(),
+        }
+        with self.db:
+            self._upsert([row], launch_columns)
+
+    def add(self, output_dir: Path, run_uuid: Optional[str] = None) -> bool:
+        """Index the run in the output directory, returning whether there was one."""
+        row = read_run(output_dir, run_uuid)
+        if row is None:
+            return False
+        with self.db:
+            self._upsert([row], result_columns)
+        return True
+
+    def _run_dirs(self, root: Path) -> Iterable[Tuple[Path, int]]:
+        """Return the directories in root that may contain a run."""
+        if not root.is_dir():
+            return
+        try:
+            entries = list(os.scandir(root))
+        except OSError as err:
+            logging.warning(f"Warning: cannot read run directory {root}: {err}")
+            return
+        for entry in entries:
+            try:
+                if entry.is_dir():
+                    yield Path(entry.path), entry.stat().st_mtime_ns
+            except OSError:
+                continue
+
+    def update(self, roots: List[Path], batch_size: int = 1000) -> Tuple[int, int]:
+        """Index runs in directories of the roots that changed.
+
+        Each directory in a root can contain the output files directly, as
+        in the registry of cloe-engine, or in an output directory, as in the
+        output of the batch command. Runs whose directory has been removed
+        are removed from the index. Return the number of runs that have been
+        indexed and removed.
+        """
+        added = removed = 0
+        for root in roots:
+            root = Path(os.path.abspath(root))
+            prefix = os.path.join(str(root), "")
+            known = dict(
+                self.db.execute(
+                    "SELECT path, mtime_ns FROM dirs WHERE substr(path, 1, ?) = ?",
+                    (len(prefix), prefix),
+                )
+            )
+            rows: List[Dict[str, Any]] = []
+            dirs: List[Tuple[str, int]] = []
+
+            def flush() -> None:
+                with self.db:
+                    self._upsert(rows, result_columns)
+                    self.db.executemany(
+                        "INSERT OR REPLACE INTO dirs VALUES (?, ?)", dirs
+                    )
+                rows.clear()
+                dirs.clear()
+
+            for path, mtime_ns in self._run_dirs(root):
+                previous = known.pop(str(path), None)
+                if previous == mtime_ns:
+                    continue
+                # The output of a batch run may have been copied from the
+                # result cache, so its directory has the right UUID.
+                row = read_run(path) or read_run(path / "output", path.name)
+                if row is None:
+                    # Directories without a run, such as runs in progress,
+                    # are not recorded, so that they are read again.
+                    if previous is not None:
+                        known[str(path)] = previous
+                    continue
+                rows.append(row)
+                added += 1
+                dirs.append((str(path), mtime_ns))
+                if len(dirs) >= batch_size:
+                    flush()
+            flush()
+
+            # Whatever is left in known no longer contains a run.
+            with self.db:
+                for path in known:
+                    self.db.execute("DELETE FROM dirs WHERE path = ?", (path,))
+                    cursor = self.db.execute(
+                        "DELETE FROM runs WHERE output_dir IN (?, ?)",
+                        (path, os.path.join(path, "output")),
+                    )
+                    removed += cursor.rowcount
+        return added, removed
+
+    def prune(self) -> int:
+        """Remove runs whose output directory no longer exists."""
+        removed = 0
+        rows = self.db.execute(
+            "SELECT uuid, output_dir FROM runs WHERE output_dir IS NOT NULL"
+        )
+        gone = [(u,) for u, d in rows.fetchall() if not os.path.isdir(d)]
+        with self.db:
+            self.db.executemany("DELETE FROM runs WHERE uuid = ?", gone)
+            removed += len(gone)
+        return removed
+
+    def query(
+        self, sql: str, params: Iterable[Any] = ()
+    ) -> Tuple[List[str], List[Tuple]]:
+        """Run the query and return the column names and rows.
+
+        The query cannot modify the index.
+        """
+        self.db.execute("PRAGMA query_only = ON")
+        try:
+            cursor = self.db.execute(sql, tuple(params))
+            names = [x[0] for x in cursor.description or []]
+            return names, cursor.fetchall()
+        finally:
+            self.db.execute("PRAGMA query_only = OFF")
@@ -0,0 +1,329 @@
+# pylint: disable=logging-fstring-interpolation
+
+"""
+This module contains the aggregation of simulation results into reports.
+
+The result that cloe-engine prints and writes at the end of a simulation
+contains the statistics of each cycle in accumulators (see
+SimulationStatistics in cloe-engine), such as the mean and maximum engine,
+simulator, and controller time. A report reads the results of many runs,
+groups them by scenario and plugin configuration, and aggregates the values
+of each group, such as the mean engine time of each run, into percentiles.
+
+Results are read one at a time, and only the values of the metrics are kept
+in compact columns, so that reports over many thousands of runs do not need
+much memory. NumPy is required to aggregate them.
+
+A report can be saved as a baseline and compared against later. A metric
+of a group regresses if it is worse by more than a relative threshold, and
+the difference is significant, that is, Welch's t statistic of the mean
+values exceeds the given number of standard errors.
+"""
+
+import array
+import hashlib
+import json
+import logging
+import math
+import os
+
+from pathlib import Path
+from typing import Any
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Optional
+
+from cloe_launch.registry import parse_duration
+from cloe_launch.registry import stack_hash
+from cloe_launch.registry import statistics
+
+
+class ReportError(Exception):
+    """ReportError signifies that results cannot be reported or compared."""
+
+
+# The metrics of each run that are aggregated, see read_metrics.
+metrics = [f"{s}.{a}" for s in statistics for a in ("mean", "max")] + [
+    "elapsed_s",
+    "realtime_factor",
+    "achievable_realtime_factor",
+]
+
+# Metrics where a smaller value is a regression. For all others, a larger
+# value is a regression.
+higher_is_better = {"realtime_factor", "achievable_realtime_factor"}
+
+# The padding time is spent waiting to keep the realtime factor, and the
+# cycle time contains it, so they are not a measure of performance.
+default_gates = [
+    "engine_time_ms.mean",
+    "simulator_time_ms.mean",
+    "controller_time_ms.mean",
+    "achievable_realtime_factor",
+]
+
+group_fields = ["scenario", "plugins", "stack"]
+
+# Sections of a stack that make up the plugin configuration of a run.
+plugin_sections = ["plugins", "simulators", "controllers"]
+
+percentiles = [50, 90, 99]
+
+
+def _read_json(path: Path) -> Optional[Any]:
+    try:
+        with path.open() as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def _hash(data: Any) -> str:
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()[:12]
+
+
+def require_numpy():
+    """Return the numpy module, which is an optional dependency."""
+    try:
+        import numpy  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        raise ReportError(
+            "NumPy is required for reports, install it with: pip install numpy"
+        )
+    return numpy
+
+
+def find_results(paths: Iterable[Path]) -> Iterator[Path]:
+    """Return the result files in the paths, searching directories recursively.
+
+    Runs of the batch command that have no output directory are read from
+    the stdout that was captured.
+    """
+    for path in paths:
+        if not path.is_dir():
+            yield path
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            if "result.json" in files:
+                yield Path(root) / "result.json"
+            elif "run.json" in files and "stdout.json" in files:
+                if not os.path.exists(os.path.join(root, "output", "result.json")):
+                    yield Path(root) / "stdout.json"
+
+
+def read_metrics(result: Dict[str, Any]) -> List[float]:
+    """Return the value of each metric in the result, NaN if it is missing."""
+    values = []
+    stats = result.get("statistics") or {}
+    for stat in statistics:
+        acc = stats.get(stat) or {}
+        values.append(acc.get("mean"))
+        values.append(acc.get("max"))
+    sync = result.get("simulation") or {}
+    values.append(parse_duration(result.get("elapsed")))
+    values.append(sync.get("realtime_factor"))
+    values.append(sync.get("achievable_realtime_factor"))
+    return [float(x) if isinstance(x, (int, float)) else math.nan for x in values]
+
+
+def read_groups(result_file: Path) -> Dict[str, str]:
+    """Return the value of each group field for the run of the result file.
+
+    The scenario is the name of the run in a batch, which is the stackfile or
+    the parameters of a sweep. Otherwise it is the hash of the stack.
+    """
+    run_dir = result_file.parent
+    if result_file.name == "result.json" and run_dir.name == "output":
+        run_dir = run_dir.parent
+    run = _read_json(run_dir / "run.json")
+    config = _read_json(result_file.parent / "config.json")
+
+    groups = {"scenario": "-", "plugins": "-", "stack": "-"}
+    if isinstance(config, dict):
+        groups["stack"] = stack_hash(config)[:12]
+        groups["plugins"] = _hash({k: config.get(k) for k in plugin_sections})
+        groups["scenario"] = groups["stack"]
+    if isinstance(run, dict) and isinstance(run.get("name"), str):
+        groups["scenario"] = run["name"]
+    return groups
+
+
+class ResultTable:
+    """ResultTable contains the metrics of runs in columns by group."""
+
+    def __init__(self, group_by: List[str]):
+        # Fail before reading results if they cannot be aggregated.
+        require_numpy()
+        for field in group_by:
+            if field not in group_fields:
+                raise ReportError(f"unknown group field: {field}")
+        self.group_by = group_by
+        self.columns: Dict[str, List[array.array]] = {}
+        self.outcomes: Dict[str, Dict[str, int]] = {}
+        self.skipped = 0
+
+    def add(self, result_file: Path) -> bool:
+        """Add the metrics of the result file, returning whether it is one."""
+        result = _read_json(result_file)
+        if not isinstance(result, dict) or "statistics" not in result:
+            logging.info(f"Skip file without simulation result: {result_file}")
+            self.skipped += 1
+            return False
+        groups = read_groups(result_file)
+        key = " | ".join(groups[x] for x in self.group_by) or "all"
+        if key not in self.columns:
+            self.columns[key] = [array.array("d") for _ in metrics]
+            self.outcomes[key] = {}
+        for column, value in zip(self.columns[key], read_metrics(result)):
+            column.append(value)
+        outcome = str(result.get("outcome"))
+        self.outcomes[key][outcome] = self.outcomes[key].get(outcome, 0) + 1
+        return True
+
+    def extend(self, result_files: Iterable[Path]) -> None:
+        for result_file in result_files:
+            self.add(result_file)
+
+    def runs(self) -> int:
+        """Return the number of runs in the table."""
+        return sum(len(x[0]) for x in self.columns.values())
+
+    def aggregate(self) -> Dict[str, Any]:
+        """Return the aggregates of each metric of each group."""
+        np = require_numpy()
+        groups = {}
+        for key, columns in sorted(self.columns.items()):
+            aggregates = {}
+            for metric, column in zip(metrics, columns):
+                values = np.frombuffer(column, dtype=np.float64)
+                values = values[~np.isnan(values)]
+                if values.size == 0:
+                    continue
+                quantiles = np.percentile(values, percentiles)
+                agg = {
+                    "n": int(values.size),
+                    "mean": float(values.mean()),
+                    "std": float(values.std(ddof=1)) if values.size > 1 else 0.0,
+                    "min": float(values.min()),
+                    "max": float(values.max()),
+                }
+                for p, q in zip(percentiles, quantiles):
+                    agg[f"p{p}"] = float(q)
+                aggregates[metric] = agg
+            groups[key] = {
+                "runs": len(columns[0]),
+                "outcomes": self.outcomes[key],
+                "metrics": aggregates,
+            }
+        return {"version": 1, "group_by": self.group_by, "groups": groups}
+
+
+def compare_metric(
+    metric: str,
+    current: Dict[str, float],
+    baseline: Dict[str, float],
+    threshold: float,
+    significance: float,
+) -> Dict[str, Any]:
+    """Return the change of the metric and whether it is a regression.
+
+    The change is relative to the baseline and positive if it is worse. The
+    t statistic is only computed if both have more than one value; otherwise
+    the threshold alone decides.
+    """
+    sign = -1.0 if metric in higher_is_better else 1.0
+    diff = sign * (current["mean"] - baseline["mean"])
+    change = diff / abs(baseline["mean"]) if baseline["mean"] != 0 else 0.0
+    t = None
+    if current["n"] > 1 and baseline["n"] > 1:
+        se = math.sqrt(
+            current["std"] ** 2 / current["n"] + baseline["std"] ** 2 / baseline["n"]
+        )
+        t = diff / se if se > 0 else math.copysign(math.inf, diff) if diff else 0.0
+    significant = t is None or abs(t) > significance
+    status = "ok"
+    if significant and change > threshold:
+        status = "regression"
+    elif significant and change < -threshold:
+        status = "improvement"
+    return {
+        "metric": metric,
+        "baseline": baseline["mean"],
+        "current": current["mean"],
+        "change": change,
+        "t": t,
+        "status": status,
+    }
+
+
+def compare(
+    report: Dict[str, Any],
+    baseline: Dict[str, Any],
+    gates: List[str],
+    threshold: float = 0.05,
+    significance: float = 3.0,
+) -> List[Dict[str, Any]]:
+    """Return the comparison of the gate metrics of each group in both."""
+    if baseline.get("version") != report["version"]:
+        raise ReportError(f"unsupported baseline version: {baseline.get('version')}")
+    if baseline.get("group_by") != report["group_by"]:
+        raise ReportError(
+            f"baseline is grouped by {', '.join(baseline.get('group_by', []))}, "
+            f"not {', '.join(report['group_by'])}"
+        )
+    result = []
+    for key, group in report["groups"].items():
+        base = baseline["groups"].get(key)
+        if base is None:
+            logging.warning(f"Warning: group not in baseline: {key}")
+            continue
+        for metric in gates:
+            cur_agg = group["metrics"].get(metric)
+            base_agg = base["metrics"].get(metric)
+            if cur_agg is None or base_agg is None:
+                continue
+            comparison = compare_metric(
+                metric, cur_agg, base_agg, threshold, significance
+            )
+            comparison["group"] = key
+            result.append(comparison)
+    for key in baseline["groups"]:
+        if key not in report["groups"]:
+            logging.warning(f"Warning: baseline group not in results: {key}")
+    return result
+
+
+def format_report(report: Dict[str, Any], shown: List[str]) -> str:
+    """Return the aggregates of the shown metrics as human-readable tables."""
+    lines = []
+    for key, group in report["groups"].items():
+        outcomes = ", ".join(f"{v} {k}" for k, v in sorted(group["outcomes"].items()))
+        lines.append(f"{key}: {group['runs']} runs, {outcomes}")
+        lines.append(
+            f"  {'metric':<28} {'n':>6} {'mean':>12} {'std':>12}"
+            + "".join(f" {'p' + str(p):>12}" for p in percentiles)
+        )
+        for metric in shown:
+            agg = group["metrics"].get(metric)
+            if agg is None:
+                continue
+            lines.append(
+                f"  {metric:<28} {agg['n']:>6} {agg['mean']:>12.4g} {agg['std']:>12.4g}"
+                + "".join(f" {agg['p' + str(p)]:>12.4g}" for p in percentiles)
+            )
+    return "\n".join(lines)
+
+
+def format_comparison(comparisons: List[Dict[str, Any]]) -> str:
+    """Return the comparisons as a human-readable table."""
+    lines = []
+    for c in comparisons:
+        t = "-" if c["t"] is None else f"{c['t']:.1f}"
+        lines.append(
+            f"{c['status']:<11} {c['change'] * 100:>+8.1f}%  t={t:<6} "
+            f"{c['metric']:<28} {c['baseline']:.4g} -> {c['current']:.4g}  {c['group']}"
+        )
+    return "\n".join(lines)
@@ -0,0 +1,240 @@
+# pylint: disable=logging-fstring-interpolation
+
+"""
+This module contains the cache of simulation results.
+
+Simulations are deterministic as long as their inputs do not change, so a
+result can be re-used if the following are the same:
+
+- the merged stack, as printed by `cloe-engine dump`,
+- the cloe-engine binary and all plugin libraries it could load,
+- the environment variables that influence cloe-engine, and
+- the arguments that cloe-engine is run with.
+
+The fingerprint of these inputs is the key of an entry in the cache, which
+contains the stdout, exit code, and output files of the simulation. The
+cache has a maximum size; when it is exceeded, the least recently used
+entries are removed.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+from pathlib import Path
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from cloe_launch.utility import file_digest
+
+# Environment variables that influence cloe-engine or the plugins it loads,
+# unless they are configured otherwise.
+default_env_vars = [
+    "CLOE_PLUGIN_PATH",
+    "CLOE_REQUIRE_SUCCESS",
+    "CLOE_SECURE_MODE",
+    "CLOE_STRICT_MODE",
+    "LD_LIBRARY_PATH",
+]
+
+
+class ResultCache:
+    """ResultCache stores simulation results by the fingerprint of their inputs."""
+
+    version = 1
+
+    # Seconds after which the total size is counted from the entries again,
+    # since other processes may have stored results in the meantime.
+    recount_interval = 60.0
+
+    def __init__(
+        self,
+        path: Path,
+        max_size: int = 10 << 30,
+        env_vars: Optional[List[str]] = None,
+    ):
+        self.path = path
+        self.max_size = max_size
+        self.env_vars = default_env_vars if env_vars is None else env_vars
+        self._hashes: Dict[str, Tuple[int, int, str]] = {}
+        self._lock = threading.Lock()
+        self._total_size: Optional[int] = None
+        self._counted = 0.0
+
+    def _file_hash(self, path: Path) -> str:
+        """Return the hash of the file, which is memoized by mtime and size."""
+        stat = path.stat()
+        with self._lock:
+            memo = self._hashes.get(str(path))
+        if memo is not None and memo[0] == stat.st_mtime_ns and memo[1] == stat.st_size:
+            return memo[2]
+        digest = file_digest(path)
+        with self._lock:
+            self._hashes[str(path)] = (stat.st_mtime_ns, stat.st_size, digest)
+        return digest
+
+    def _library_hashes(self, paths: List[str]) -> Dict[str, str]:
+        """Return the hashes of all plugin libraries in the files and directories."""
+        hashes = {}
+        for path in paths:
+            if path == "":
+                continue
+            pp = Path(path)
+            if pp.is_dir():
+                files = sorted(pp.glob("*.so"))
+            elif pp.is_file():
+                files = [pp]
+            else:
+                continue
+            for file in files:
+                hashes[str(file)] = self._file_hash(file)
+        return hashes
+
+    def fingerprint(
+        self,
+        dump: str,
+        engine_path: Path,
+        env: Dict[str, str],
+        args: List[str],
+    ) -> str:
+        """Return the fingerprint of the inputs of a simulation.
+
+        The dump is the merged stack as printed by `cloe-engine dump`, and
+        args are all arguments of cloe-engine that are not stackfiles.
+        """
+        plugin_paths = env.get("CLOE_PLUGIN_PATH", "").split(os.pathsep)
+        try:
+            stack = json.loads(dump)
+            plugins = stack.get("plugins", []) if isinstance(stack, dict) else []
+            plugin_paths.extend(
+                x["path"] for x in plugins if isinstance(x, dict) and "path" in x
+            )
+        except ValueError:
+            pass
+
+        inputs = {
+            "version": self.version,
+            "stack": dump,
+            "engine": self._file_hash(Path(engine_path)),
+            "plugins": self._library_hashes(plugin_paths),
+            "env": {k: env.get(k) for k in self.env_vars},
+            "args": args,
+        }
+        data = json.dumps(inputs, sort_keys=True).encode()
+        return hashlib.sha256(data).hexdigest()
+
+    def _entry_path(self, key: str) -> Path:
+        return self.path / key[:2] / key
+
+    def lookup(self, key: str) -> Optional[Path]:
+        """Return the directory of the cache entry, if it exists.
+
+        The entry is marked as used, so that it is evicted last.
+        """
+        entry = self._entry_path(key)
+        if not (entry / "meta.json").exists():
+            return None
+        try:
+            os.utime(entry)
+        except OSError:
+            # The entry is being evicted concurrently.
+            return None
+        logging.info(f"Use cached result: {entry}")
+        return entry
+
+    def read(self, entry: Path) -> Dict[str, Any]:
+        """Return the metadata of the cache entry."""
+        with (entry / "meta.json").open() as file:
+            return json.load(file)
+
+    def store(
+        self, key: str, returncode: int, stdout: bytes, output_dir: Optional[Path]
+    ) -> None:
+        """Store a result in the cache and evict entries if it is too large.
+
+        The entry is first written to a temporary directory and then renamed,
+        so that concurrent readers never see a partial entry.
+        """
+        entry = self._entry_path(key)
+        tmp = entry.with_name(f".{key}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            tmp.mkdir(parents=True)
+            (tmp / "stdout.json").write_bytes(stdout)
+            if output_dir is not None and output_dir.is_dir():
+                shutil.copytree(output_dir, tmp / "output", symlinks=True)
+            size = sum(f.stat().st_size for f in tmp.rglob("*") if f.is_file())
+            with (tmp / "meta.json").open("w") as file:
+                json.dump(
+                    {
+                        "key": key,
+                        "returncode": returncode,
+                        "size": size,
+                        "time": time.time(),
+                    },
+                    file,
+                )
+            try:
+                os.rename(tmp, entry)
+            except OSError:
+                if not entry.exists():
+                    raise
+                # Another process stored the same result first.
+                return
+        except OSError as err:
+            logging.warning(f"Warning: cannot store result in cache: {err}")
+            return
+        finally:
+            if tmp.exists():
+                shutil.rmtree(tmp, ignore_errors=True)
+
+        # The total size is only counted from the entries now and then, and
+        # tracked in between, so that storing a result does not need to read
+        # them all. Before evicting, it is counted again.
+        with self._lock:
+            now = time.monotonic()
+            if self._total_size is None or now - self._counted > self.recount_interval:
+                self._total_size = sum(size for _, size, _ in self.entries())
+                self._counted = now
+            else:
+                self._total_size += size
+            if self._total_size > self.max_size:
+                self.evict()
+
+    def entries(self) -> List[Tuple[float, int, Path]]:
+        """Return the last use time, size, and path of each cache entry."""
+        result = []
+        if not self.path.exists():
+            return result
+        for shard in self.path.iterdir():
+            if not shard.is_dir():
+                continue
+            for entry in shard.iterdir():
+                if entry.name.startswith("."):
+                    continue
+                try:
+                    with (entry / "meta.json").open() as file:
+                        size = json.load(file)["size"]
+                    result.append((entry.stat().st_mtime, size, entry))
+                except (OSError, ValueError, KeyError):
+                    continue
+        return result
+
+    def evict(self) -> None:
+        """Remove the least recently used entries until the cache fits."""
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in entries:
+            if total <= self.max_size:
+                break
+            logging.debug(f"Evict cached result: {entry}")
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+        self._total_size = total
+        self._counted = time.monotonic()
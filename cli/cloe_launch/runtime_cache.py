@@ -0,0 +1,425 @@
+# pylint: disable=logging-fstring-interpolation
+
+"""
+This module contains the eviction of runtime directories from the launcher
+runtime cache.
+
+The runtime cache (see Configuration.runtime_dir) contains a directory for
+each named profile and each anonymous profile, and these contain a runtime
+directory for each distinct combination of profile inputs (see
+Engine.runtime_dir). Without eviction, these accumulate without bound, as
+do copies of anonymous files that were relayed by launches that did not
+exit cleanly.
+
+Each launch holds a shared lock on the runtime directory it uses for as
+long as it runs, and marks the directory as used. Runtime directories that
+have not been used for the maximum age are evicted, and then the least
+recently used ones until the cache fits into the maximum size. Runtime
+directories that are locked are never evicted. An evicted directory is
+renamed before it is removed, so that launches never see a partially
+removed runtime directory.
+
+The runtime cache may be shared between hosts, for example on NFS, so the
+temporary files and directories of a launch are named after its process ID
+and host name. Whether their launch still runs can only be checked for the
+local host; those of other hosts are removed once they are older than the
+maximum relay age.
+"""
+
+import logging
+import os
+import re
+import shutil
+import socket
+import time
+
+from pathlib import Path
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from cloe_launch.utility import lock_file
+
+# The file in a runtime directory whose modification time is the last use.
+last_used_file = ".last_used"
+
+# The file in a runtime directory that launches using it hold a shared lock on.
+# Unlike the lock against eviction, it moves with the directory when the
+# runtime directory is replaced.
+users_file = ".users"
+
+# Directories next to runtime directories that are being prepared, evicted,
+# or that were replaced, such as .0123abcd.prepare-1234@host.
+_staging_regex = re.compile(r"^\.(.+)\.(prepare|evict|replaced)-(\d+)@([A-Za-z0-9-]+)$")
+
+# Temporary files that launches create contain their owner tag, for example
+# conan_info.1234@host.json or 1234@host._proc_self_fd_3-abcd.json.
+_owner_regex = re.compile(r"(?:^|\.)(\d+)@([A-Za-z0-9-]+)\.")
+
+_host = re.sub(r"[^A-Za-z0-9-]", "-", socket.gethostname())
+
+
+def owner_tag() -> str:
+    """Return the process ID and host name that temporary files are named after."""
+    return f"{os.getpid()}@{_host}"
+
+
+def _owner_of(name: str) -> Optional[Tuple[int, str]]:
+    match = _owner_regex.search(name)
+    if match is None:
+        return None
+    return int(match.group(1)), match.group(2)
+
+
+def _owner_is_running(owner: Tuple[int, str]) -> bool:
+    pid, host = owner
+    if host != _host:
+        # Processes of other hosts cannot be checked.
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _dir_size(path: Path) -> int:
+    """Return the total size of the files in the directory, recursively."""
+    total = 0
+    stack = [str(path)]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        else:
+                            total += entry.stat(follow_symlinks=False).st_size
+                    except OSError:
+                        continue
+        except OSError:
+            continue
+    return total
+
+
+def lock_path(runtime_dir: Path) -> Path:
+    """Return the path to the file locked while the runtime directory is used."""
+    return runtime_dir.with_name(f"{runtime_dir.name}.inuse")
+
+
+class RuntimeCache:
+    """RuntimeCache tracks the use of runtime directories and evicts them."""
+
+    def __init__(
+        self,
+        path: Path,
+        max_size: int = 4 << 30,
+        max_age: float = 30 * 86400,
+        relay_max_age: float = 86400,
+        gc_interval: float = 3600,
+    ):
+        self.path = path
+        self.max_size = max_size
+        self.max_age = max_age
+        self.relay_max_age = relay_max_age
+        self.gc_interval = gc_interval
+
+    def acquire(self, runtime_dir: Path) -> int:
+        """Lock the runtime directory against eviction and return the descriptor.
+
+        The lock is held until the descriptor is closed. The runtime directory
+        does not need to exist yet.
+        """
+        while True:
+            runtime_dir.parent.mkdir(parents=True, exist_ok=True)
+            try:
+                fd = lock_file(lock_path(runtime_dir), shared=True)
+            except FileNotFoundError:
+                # The empty profile directory was removed by gc.
+                continue
+            assert fd is not None
+            return fd
+
+    def use(self, runtime_dir: Path) -> Optional[int]:
+        """Mark the runtime directory as used and return the descriptor of a lock on it.
+
+        The lock is held until the descriptor is closed, and keeps the
+        runtime directory from being removed after it was replaced. None is
+        returned if the runtime directory does not exist.
+        """
+        self.touch(runtime_dir)
+        try:
+            return lock_file(runtime_dir / users_file, shared=True)
+        except OSError as err:
+            logging.debug(f"Cannot lock runtime directory: {err}")
+            return None
+
+    def has_users(self, path: Path) -> bool:
+        """Return true if a launch holds a lock from use() on the directory."""
+        if not (path / users_file).exists():
+            return False
+        try:
+            fd = lock_file(path / users_file, blocking=False)
+        except FileNotFoundError:
+            return False
+        if fd is None:
+            return True
+        os.close(fd)
+        return False
+
+    def remove_replaced(self, path: Path) -> bool:
+        """Remove the replaced runtime directory unless a launch still uses it.
+
+        Return true if it was removed.
+        """
+        try:
+            fd = lock_file(path / users_file, blocking=False)
+        except FileNotFoundError:
+            fd = None
+        else:
+            if fd is None:
+                logging.debug(f"Keep replaced runtime directory in use: {path}")
+                return False
+        try:
+            logging.debug(f"Remove: {path}")
+            shutil.rmtree(path, ignore_errors=True)
+        finally:
+            if fd is not None:
+                os.close(fd)
+        return True
+
+    def touch(self, runtime_dir: Path) -> None:
+        """Mark the runtime directory as used now."""
+        marker = runtime_dir / last_used_file
+        try:
+            os.utime(marker)
+        except FileNotFoundError:
+            try:
+                marker.touch()
+            except OSError as err:
+                logging.debug(f"Cannot mark runtime directory as used: {err}")
+
+    def entries(self) -> List[Tuple[float, int, Path]]:
+        """Return the last use time, size, and path of each runtime directory."""
+        result = []
+        if not self.path.exists():
+            return result
+        for profile_dir in sorted(self.path.iterdir()):
+            if profile_dir.name.startswith(".") or not profile_dir.is_dir():
+                continue
+            for runtime_dir in sorted(profile_dir.iterdir()):
+                if runtime_dir.name.startswith(".") or not runtime_dir.is_dir():
+                    continue
+                try:
+                    try:
+                        used = (runtime_dir / last_used_file).stat().st_mtime
+                    except FileNotFoundError:
+                        used = runtime_dir.stat().st_mtime
+                except OSError:
+                    continue
+                result.append((used, _dir_size(runtime_dir), runtime_dir))
+        return result
+
+    def is_in_use(self, runtime_dir: Path) -> bool:
+        """Return true if a launch holds a lock on the runtime directory."""
+        if not lock_path(runtime_dir).exists():
+            return False
+        fd = lock_file(lock_path(runtime_dir), blocking=False)
+        if fd is None:
+            return True
+        os.close(fd)
+        return False
+
+    def evict(self, runtime_dir: Path) -> bool:
+        """Remove the runtime directory unless it is in use.
+
+        Return true if it was removed.
+        """
+        lock = lock_path(runtime_dir)
+        fd = lock_file(lock, blocking=False)
+        if fd is None:
+            logging.debug(f"Skip runtime directory in use: {runtime_dir}")
+            return False
+        try:
+            trash = runtime_dir.with_name(f".{runtime_dir.name}.evict-{owner_tag()}")
+            try:
+                os.rename(runtime_dir, trash)
+            except FileNotFoundError:
+                pass
+            else:
+                logging.debug(f"Evict runtime directory: {runtime_dir}")
+                shutil.rmtree(trash, ignore_errors=True)
+            # Launches that wait for the lock notice that the file is gone.
+            lock.unlink()
+            try:
+                runtime_dir.with_name(f"{runtime_dir.name}.prepare").unlink()
+            except FileNotFoundError:
+                pass
+        finally:
+            os.close(fd)
+        return True
+
+    def stale_files(self) -> List[Tuple[int, Path]]:
+        """Return the size and path of temporary files that no launch uses.
+
+        These are files that anonymous files were relayed into, temporary
+        files in profile directories, and directories that were being
+        prepared or evicted, whose process no longer runs or that are older
+        than the maximum relay age. Runtime directories that were replaced
+        are stale once no launch uses them.
+        """
+        result = []
+        cutoff = time.time() - self.relay_max_age
+        candidates = []
+        if not self.path.exists():
+            return result
+        for profile_dir in self.path.iterdir():
+            if profile_dir.name.startswith(".") or not profile_dir.is_dir():
+                continue
+            for path in profile_dir.iterdir():
+                match = _staging_regex.match(path.name)
+                if match is not None and match.group(2) == "replaced":
+                    # Launches that used it before it was replaced may still run.
+                    if self.has_users(path):
+                        candidates.append((path, None))
+                    else:
+                        result.append((_dir_size(path), path))
+                elif match is not None:
+                    candidates.append((path, (int(match.group(3)), match.group(4))))
+                elif path.is_file() and path.suffix not in (".inuse", ".prepare"):
+                    owner = _owner_of(path.name)
+                    if owner is not None:
+                        candidates.append((path, owner))
+                elif path.is_dir():
+                    relay_dir = path / "relay"
+                    if relay_dir.is_dir():
+                        candidates.extend(
+                            (x, _owner_of(x.name)) for x in relay_dir.iterdir()
+                        )
+        for path, owner in candidates:
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            if stat.st_mtime < cutoff or (
+                owner is not None and not _owner_is_running(owner)
+            ):
+                size = _dir_size(path) if path.is_dir() else stat.st_size
+                result.append((size, path))
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        """Return statistics of the runtime cache."""
+        entries = self.entries()
+        profiles: Dict[str, Dict[str, Any]] = {}
+        now = time.time()
+        for used, size, runtime_dir in entries:
+            profile = profiles.setdefault(
+                runtime_dir.parent.name,
+                {"runtime_dirs": 0, "size": 0, "last_used": 0.0},
+            )
+            profile["runtime_dirs"] += 1
+            profile["size"] += size
+            profile["last_used"] = max(profile["last_used"], used)
+        stale = self.stale_files()
+        return {
+            "path": str(self.path),
+            "runtime_dirs": len(entries),
+            "size": sum(x[1] for x in entries),
+            "in_use": sum(1 for x in entries if self.is_in_use(x[2])),
+            "oldest_age": max((now - x[0] for x in entries), default=0.0),
+            "max_size": self.max_size,
+            "max_age": self.max_age,
+            "stale_files": len(stale),
+            "stale_size": sum(x[0] for x in stale),
+            "profiles": profiles,
+        }
+
+    def gc(self, dry_run: bool = False) -> Dict[str, Any]:
+        """Evict runtime directories and remove stale files.
+
+        A maximum size or age of 0 is no limit. Return what was removed.
+        """
+        now = time.time()
+        entries = sorted(self.entries())
+        total = sum(x[1] for x in entries)
+        evicted: List[str] = []
+        freed = 0
+        for used, size, runtime_dir in entries:
+            too_old = self.max_age > 0 and now - used > self.max_age
+            too_large = self.max_size > 0 and total > self.max_size
+            if not too_old and not too_large:
+                continue
+            if dry_run:
+                if self.is_in_use(runtime_dir):
+                    continue
+            elif not self.evict(runtime_dir):
+                continue
+            evicted.append(str(runtime_dir))
+            total -= size
+            freed += size
+
+        removed: List[str] = []
+        for lock in self.path.glob("*/*.inuse"):
+            runtime_dir = lock.with_suffix("")
+            if not runtime_dir.exists() and not dry_run:
+                # This only removes the lock file of a cleaned runtime directory.
+                self.evict(runtime_dir)
+        for size, path in self.stale_files():
+            if any(str(path).startswith(x + os.sep) for x in evicted):
+                continue
+            logging.debug(f"Remove stale file: {path}")
+            if not dry_run:
+                if path.is_dir():
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    try:
+                        path.unlink()
+                    except FileNotFoundError:
+                        continue
+            removed.append(str(path))
+            freed += size
+
+        if not dry_run:
+            for profile_dir in self.path.iterdir():
+                if profile_dir.is_dir() and not profile_dir.name.startswith("."):
+                    try:
+                        profile_dir.rmdir()
+                    except OSError:
+                        pass
+        return {"evicted": evicted, "removed": removed, "freed": freed, "size": total}
+
+    def gc_if_due(self) -> None:
+        """Run gc if it was not run for gc_interval seconds.
+
+        Only one launch runs it at a time; others do not wait for it.
+        """
+        if self.gc_interval <= 0:
+            return
+        stamp = self.path / ".gc"
+        try:
+            if time.time() - stamp.stat().st_mtime < self.gc_interval:
+                return
+        except FileNotFoundError:
+            pass
+        self.path.mkdir(parents=True, exist_ok=True)
+        fd = lock_file(self.path / ".gc.lock", blocking=False)
+        if fd is None:
+            return
+        try:
+            stamp.touch()
+            result = self.gc()
+            if result["evicted"] or result["removed"]:
+                logging.info(
+                    f"Evicted {len(result['evicted'])} runtime directories and "
+                    f"{len(result['removed'])} stale files from runtime cache"
+                )
+        except OSError as err:
+            logging.warning(f"Warning: cannot collect runtime cache garbage: {err}")
+        finally:
+            os.close(fd)
@@ -0,0 +1,474 @@
+# pylint: disable=logging-fstring-interpolation,broad-except
+
+"""
+This module contains a work queue of simulations in a spool directory.
+
+The spool directory is meant to be shared between machines, for example via
+NFS, so that simulations can be spread over many workers without a scheduler
+service. It has the following layout:
+
+    new/        jobs that have been submitted, as <id>.json
+    claimed/    jobs that a worker is running
+    done/       records of jobs that have been run
+    failed/     jobs whose lease expired too many times
+    results/    run directories of the jobs, as <id>/<uuid>/
+    workers/    statistics of each worker
+    tmp/        files that are being written
+
+Files are only ever made visible by renaming them, which is atomic, also on
+NFS. A worker claims a job by renaming it from new/ to claimed/; if another
+worker was faster, the rename fails and the worker tries the next job.
+
+While a worker runs a job, it regularly updates the modification time of the
+claimed file, which is its lease on the job. If a worker crashes, its lease
+expires, and any worker moves the job back to new/, so that it is run again.
+A job that is returned too often is moved to failed/ instead. Jobs are thus
+run at least once, but possibly more than once if a worker is only stalled.
+"""
+
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from cloe_launch import Configuration
+from cloe_launch.batch import Batch
+from cloe_launch.batch import BatchRun
+from cloe_launch.exec import Engine
+from cloe_launch.exec import Environment
+from cloe_launch.results import ResultCache
+
+Job = Dict[str, Any]
+
+
+def _write_json_atomic(path: Path, tmp_dir: Path, data: Any) -> None:
+    """Write the file in tmp_dir and then rename it to path."""
+    tmp = (
+        tmp_dir
+        / f"{path.name}.{socket.gethostname()}.{os.getpid()}.{threading.get_ident()}"
+    )
+    with tmp.open("w") as file:
+        json.dump(data, file, indent=2)
+        file.write("\n")
+    os.rename(tmp, path)
+
+
+def _read_json(path: Path) -> Any:
+    with path.open() as file:
+        return json.load(file)
+
+
+class Spool:
+    """Spool is a work queue in a directory that can be shared by many workers."""
+
+    version = "1"
+    subdirs = ["new", "claimed", "done", "failed", "results", "workers", "tmp"]
+
+    def __init__(self, path: Path, max_attempts: int = 3):
+        # Records refer to results by absolute path, since workers run in
+        # other directories.
+        self.path = Path(os.path.abspath(path))
+        self.max_attempts = max_attempts
+
+    def init(self) -> None:
+        """Create the spool directory if it does not exist."""
+        for subdir in self.subdirs:
+            (self.path / subdir).mkdir(parents=True, exist_ok=True)
+
+    def _dir(self, name: str) -> Path:
+        return self.path / name
+
+    def results_dir(self, job_id: str) -> Path:
+        """Return the directory the runs of the job are written to."""
+        return self._dir("results") / job_id
+
+    def submit(self, job: Job) -> str:
+        """Add the job to the queue and return its ID.
+
+        IDs start with the time of submission, so that jobs are claimed in
+        the order they are submitted.
+        """
+        job_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:12]}"
+        job = dict(
+            job, version=self.version, id=job_id, attempts=0, submitted=time.time()
+        )
+        _write_json_atomic(self._dir("new") / f"{job_id}.json", self._dir("tmp"), job)
+        return job_id
+
+    def claim(self) -> Optional[Job]:
+        """Claim the oldest job in the queue, if there is one.
+
+        The job is touched before it is renamed, so that the lease starts
+        at the moment it is claimed.
+        """
+        for name in sorted(os.listdir(self._dir("new"))):
+            if not name.endswith(".json"):
+                continue
+            src = self._dir("new") / name
+            dst = self._dir("claimed") / name
+            try:
+                os.utime(src)
+                os.rename(src, dst)
+            except FileNotFoundError:
+                # Another worker claimed the job first.
+                continue
+            try:
+                return _read_json(dst)
+            except (OSError, ValueError) as err:
+                logging.error(f"Error: cannot read job {dst}: {err}")
+                os.rename(dst, self._dir("failed") / name)
+        return None
+
+    def renew(self, job_id: str) -> bool:
+        """Renew the lease on the job and return whether it was still held."""
+        try:
+            os.utime(self._dir("claimed") / f"{job_id}.json")
+            return True
+        except FileNotFoundError:
+            return False
+
+    def complete(
+        self, job: Job, record: Dict[str, Any], lease_held: bool = True
+    ) -> None:
+        """Record the result of the job and remove it from the claimed jobs.
+
+        If the lease on the job was lost, the claimed file now belongs to
+        another worker and is left alone.
+        """
+        name = f"{job['id']}.json"
+        _write_json_atomic(self._dir("done") / name, self._dir("tmp"), record)
+        if lease_held:
+            try:
+                os.remove(self._dir("claimed") / name)
+            except FileNotFoundError:
+                pass
+
+    def release(self, job: Job) -> None:
+        """Return the claimed job to the queue without counting an attempt."""
+        name = f"{job['id']}.json"
+        try:
+            os.rename(self._dir("claimed") / name, self._dir("new") / name)
+        except FileNotFoundError:
+            pass
+
+    def now(self) -> float:
+        """Return the current time according to the file system.
+
+        Workers on different machines may have clocks that differ, so
+        leases are compared to the modification time of a file that was
+        just touched, instead of the local time.
+        """
+        clock = self._dir("tmp") / f"clock.{socket.gethostname()}.{os.getpid()}"
+        clock.touch()
+        try:
+            return clock.stat().st_mtime
+        finally:
+            clock.unlink()
+
+    def reap(self, lease: float) -> int:
+        """Return jobs whose lease has expired to the queue.
+
+        Each expired job is first renamed to tmp/, so that only one worker
+        returns it, even if several reap at the same time.
+        """
+        now = self.now()
+        count = 0
+        for name in os.listdir(self._dir("claimed")):
+            src = self._dir("claimed") / name
+            try:
+                if now - src.stat().st_mtime <= lease:
+                    continue
+                tmp = (
+                    self._dir("tmp")
+                    / f"{name}.reap.{socket.gethostname()}.{os.getpid()}"
+                )
+                os.rename(src, tmp)
+            except FileNotFoundError:
+                continue
+            try:
+                job = _read_json(tmp)
+                job["attempts"] = job.get("attempts", 0) + 1
+            except (OSError, ValueError) as err:
+                logging.error(f"Error: cannot read job {src}: {err}")
+                os.rename(tmp, self._dir("failed") / name)
+                continue
+            if job["attempts"] >= self.max_attempts:
+                logging.error(
+                    f"Error: lease of job {job['id']} expired {job['attempts']} times"
+                )
+                _write_json_atomic(self._dir("failed") / name, self._dir("tmp"), job)
+            else:
+                logging.warning(
+                    f"Warning: lease of job {job['id']} expired, returning it"
+                )
+                _write_json_atomic(self._dir("new") / name, self._dir("tmp"), job)
+            os.remove(tmp)
+            count += 1
+        return count
+
+    def record(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Return the record of the job if it is done or has failed."""
+        for subdir in ["done", "failed"]:
+            path = self._dir(subdir) / f"{job_id}.json"
+            try:
+                return _read_json(path)
+            except FileNotFoundError:
+                continue
+            except ValueError:
+                return None
+        return None
+
+    def counts(self) -> Dict[str, int]:
+        """Return the number of jobs in each state."""
+        return {
+            subdir: len(
+                [x for x in os.listdir(self._dir(subdir)) if x.endswith(".json")]
+            )
+            for subdir in ["new", "claimed", "done", "failed"]
+        }
+
+
+class Worker:
+    """Worker claims jobs from a spool and runs them until it is stopped.
+
+    The runtime environment of each profile is prepared or reused once per
+    worker, in the local runtime cache.
+    """
+
+    def __init__(
+        self,
+        spool: Spool,
+        workers: int = 1,
+        lease: float = 300.0,
+        poll_interval: float = 2.0,
+        use_cache: bool = True,
+        result_cache: Optional[ResultCache] = None,
+    ):
+        self.spool = spool
+        self.workers = max(1, workers)
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.use_cache = use_cache
+        self.result_cache = result_cache
+        self.id = f"{socket.gethostname()}-{os.getpid()}"
+        self.outcomes: Dict[str, int] = {}
+        self.busy_time = 0.0
+        self.start_time = time.time()
+        self._engines: Dict[
+            Tuple[Optional[str], Optional[str]], Tuple[Engine, Environment]
+        ] = {}
+        self._engine_locks: Dict[
+            Tuple[Optional[str], Optional[str]], threading.Lock
+        ] = {}
+        self._claimed: Dict[str, bool] = {}
+        self._reserved = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._last_reap = 0.0
+
+    def stop(self) -> None:
+        """Stop claiming jobs; jobs that are running are finished."""
+        self._stop.set()
+
+    def _engine(self, job: Job) -> Tuple[Engine, Environment]:
+        """Return the engine and runtime environment of the job's profile."""
+        key = (job.get("profile"), job.get("profile_path"))
+        with self._lock:
+            if key in self._engines:
+                return self._engines[key]
+            key_lock = self._engine_locks.setdefault(key, threading.Lock())
+        # Preparing the runtime environment can take minutes, during which
+        # the leases of other jobs must still be renewed.
+        with key_lock:
+            with self._lock:
+                if key in self._engines:
+                    return self._engines[key]
+            conf = Configuration(key[0])
+            engine = Engine(conf, conanfile=key[1])
+            env = engine.runtime_env(self.use_cache)
+            engine.engine_path = env["CLOE_ENGINE"]
+            with self._lock:
+                self._engines[key] = (engine, env)
+            return engine, env
+
+    def _heartbeat(self) -> None:
+        """Renew the leases of all claimed jobs until the worker is done."""
+        while not self._stop.wait(self.lease / 4):
+            self._renew()
+
+    def _renew(self) -> None:
+        with self._lock:
+            job_ids = [k for k, v in self._claimed.items() if v]
+        for job_id in job_ids:
+            if not self.spool.renew(job_id):
+                logging.warning(f"Warning: lost lease of job {job_id}")
+                with self._lock:
+                    self._claimed[job_id] = False
+
+    def _run_job(self, job: Job) -> Dict[str, Any]:
+        """Run the job and return its record."""
+        start = time.time()
+        record: Dict[str, Any] = {"job": job, "worker": self.id, "started": start}
+        try:
+            engine, env = self._engine(job)
+            batch = Batch(
+                engine,
+                self.spool.results_dir(job["id"]),
+                require_success=job.get("require_success", False),
+                result_cache=self.result_cache,
+            )
+            batch.env = env
+            batch.print_runs = False
+            args = engine.compile_stackfiles(job["stackfiles"])
+            run = BatchRun(0, job.get("name", job["id"]), args)
+            batch.run([run], references=engine.stackfile_references(args))
+            record.update(run.summary())
+        except Exception as err:
+            logging.error(f"Error: cannot run job {job['id']}: {err}")
+            record.update({"outcome": "unknown", "exit_code": None, "error": str(err)})
+        record["finished"] = time.time()
+        return record
+
+    def _reserve(self, max_jobs: Optional[int], count: int = 1) -> bool:
+        """Reserve a job of at most max_jobs, or return a reservation."""
+        with self._lock:
+            if count > 0 and max_jobs is not None and self._reserved >= max_jobs:
+                return False
+            self._reserved += count
+            return True
+
+    def _loop(self, max_jobs: Optional[int], drain: bool) -> None:
+        while not self._stop.is_set() and self._reserve(max_jobs):
+            if time.monotonic() - self._last_reap > self.lease / 4:
+                self._last_reap = time.monotonic()
+                self.spool.reap(self.lease)
+            job = self.spool.claim()
+            if job is None:
+                self._reserve(max_jobs, -1)
+                if drain:
+                    return
+                self._stop.wait(self.poll_interval)
+                continue
+
+            with self._lock:
+                self._claimed[job["id"]] = True
+            start = time.monotonic()
+            record = self._run_job(job)
+            with self._lock:
+                lease_held = self._claimed.pop(job["id"])
+                self.busy_time += time.monotonic() - start
+            if record["outcome"] == "aborted" and self._stop.is_set():
+                # The job was interrupted along with the worker.
+                self._reserve(max_jobs, -1)
+                if lease_held:
+                    self.spool.release(job)
+                continue
+            with self._lock:
+                self.outcomes[record["outcome"]] = (
+                    self.outcomes.get(record["outcome"], 0) + 1
+                )
+            self.spool.complete(job, record, lease_held)
+            self._report(record)
+            self._write_stats()
+
+    def _report(self, record: Dict[str, Any]) -> None:
+        print(
+            f"{record['outcome']:<9} {record.get('duration', 0.0):8.2f}s  "
+            f"{record['job']['id']}  {record['job'].get('name', '')}",
+            flush=True,
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        """Return the throughput statistics of the worker."""
+        with self._lock:
+            elapsed = time.time() - self.start_time
+            done = sum(self.outcomes.values())
+            return {
+                "worker": self.id,
+                "host": socket.gethostname(),
+                "pid": os.getpid(),
+                "workers": self.workers,
+                "started": self.start_time,
+                "updated": time.time(),
+                "jobs": done,
+                "outcomes": dict(self.outcomes),
+                "busy_time": round(self.busy_time, 3),
+                "jobs_per_minute": round(done / elapsed * 60, 3)
+                if elapsed > 0
+                else 0.0,
+                "utilization": round(self.busy_time / (elapsed * self.workers), 3)
+                if elapsed > 0
+                else 0.0,
+            }
+
+    def _write_stats(self) -> None:
+        path = self.spool.path / "workers" / f"{self.id}.json"
+        try:
+            _write_json_atomic(path, self.spool.path / "tmp", self.stats())
+        except OSError as err:
+            logging.warning(f"Warning: cannot write worker statistics: {err}")
+
+    def run(
+        self, max_jobs: Optional[int] = None, drain: bool = False
+    ) -> Dict[str, Any]:
+        """Run jobs until stopped, and return the statistics of the worker.
+
+        If drain is true, the worker stops once the queue is empty.
+        If max_jobs is given, the worker stops after that many jobs.
+        """
+        self.spool.init()
+        self.start_time = time.time()
+        heartbeat = threading.Thread(target=self._heartbeat, daemon=True)
+        heartbeat.start()
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                futures = [
+                    executor.submit(self._loop, max_jobs, drain)
+                    for _ in range(self.workers)
+                ]
+                try:
+                    for future in futures:
+                        future.result()
+                except KeyboardInterrupt:
+                    logging.warning("Warning: interrupted, finishing running jobs")
+                    self.stop()
+                    for future in futures:
+                        future.result()
+        finally:
+            self.stop()
+            heartbeat.join()
+            self._write_stats()
+        return self.stats()
+
+
+def make_job(
+    stackfiles: List[str],
+    name: str,
+    profile: Optional[str] = None,
+    profile_path: Optional[str] = None,
+    require_success: bool = False,
+) -> Job:
+    """Return a job for the spool.
+
+    Paths are made absolute, since they are resolved by the worker, which
+    may run in another directory or on another machine.
+    """
+    return {
+        "name": name,
+        "stackfiles": [os.path.abspath(x) for x in stackfiles],
+        "profile": profile,
+        "profile_path": None if profile_path is None else os.path.abspath(profile_path),
+        "require_success": require_success,
+        "submitter": socket.gethostname(),
+    }
@@ -0,0 +1,270 @@
+# pylint: disable=logging-fstring-interpolation
+
+"""
+This module contains helpers for reading Cloe stackfiles in the launcher.
+
+The launcher does not validate or merge stackfiles, that is the job of
+cloe-engine. It only needs to read them to find out what they refer to,
+and to convert YAML stackfiles to JSON, which is all cloe-engine reads.
+"""
+
+import hashlib
+import json
+import logging
+import os
+
+from pathlib import Path
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Set
+
+# NOTE: The yaml module is only imported when a YAML stackfile is read,
+# since most invocations of cloe-launch do not need it.
+
+yaml_suffixes = [".yaml", ".yml"]
+
+
+class StackfileError(Exception):
+    """StackfileError signifies a stackfile that cannot be read or converted."""
+
+
+def is_yaml(path: Path) -> bool:
+    """Return true if the file is a YAML stackfile, going by its suffix."""
+    return path.suffix in yaml_suffixes
+
+
+def _load_yaml(path: Path, content: bytes) -> Any:
+    """Parse YAML content and report errors with line numbers."""
+    import yaml  # pylint: disable=import-outside-toplevel
+
+    try:
+        return yaml.safe_load(content)
+    except yaml.MarkedYAMLError as err:
+        mark = err.problem_mark or err.context_mark
+        where = f"{path}:{mark.line + 1}:{mark.column + 1}" if mark else str(path)
+        raise StackfileError(f"{where}: {err.problem or err.context}") from err
+    except yaml.YAMLError as err:
+        raise StackfileError(f"{path}: {err}") from err
+
+
+def strip_comments(text: str) -> str:
+    """Return JSON text without the // and /* */ comments cloe-engine allows."""
+    result = []
+    i = 0
+    n = len(text)
+    while i < n:
+        c = text[i]
+        if c == '"':
+            j = i + 1
+            while j < n and text[j] != '"':
+                j += 2 if text[j] == "\\" else 1
+            result.append(text[i : j + 1])
+            i = j + 1
+        elif text.startswith("//", i):
+            j = text.find("\n", i)
+            i = n if j < 0 else j
+        elif text.startswith("/*", i):
+            j = text.find("*/", i + 2)
+            i = n if j < 0 else j + 2
+        else:
+            result.append(c)
+            i += 1
+    return "".join(result)
+
+
+def read_stackfile(path: Path) -> Any:
+    """Read a JSON or YAML stackfile and return its contents."""
+    if is_yaml(path):
+        return _load_yaml(path, path.read_bytes())
+    return json.loads(strip_comments(path.read_text()))
+
+
+def system_stackfiles() -> List[Path]:
+    """Return the system stackfiles that cloe-engine reads by default.
+
+    These are read by cloe-engine unless it is run with --no-system-confs.
+    """
+    config_home = os.getenv("XDG_CONFIG_HOME", os.path.expanduser("~/.config"))
+    config_dirs = os.getenv("XDG_CONFIG_DIRS", "/etc/xdg").split(os.pathsep)
+    candidates = [Path(x) / "cloe" / "config.json" for x in config_dirs[::-1]]
+    candidates.append(Path(config_home) / "cloe" / "config.json")
+    return [x for x in candidates if x.is_file()]
+
+
+def _collect_strings(data: Any, result: Set[str]) -> None:
+    if isinstance(data, str):
+        result.add(data)
+    elif isinstance(data, dict):
+        for value in data.values():
+            _collect_strings(value, result)
+    elif isinstance(data, list):
+        for value in data:
+            _collect_strings(value, result)
+
+
+def stackfile_strings(paths: List[Path], max_depth: int = 64) -> Optional[Set[str]]:
+    """Return all string values in the stackfiles and the files they include.
+
+    If any of the stackfiles cannot be read, or refers to an include that
+    cannot be resolved without interpolation, None is returned, since it is
+    then unknown what the stackfiles refer to.
+    """
+    result: Set[str] = set()
+    visited: Set[Path] = set()
+    pending = [(Path(x).resolve(), 0) for x in paths]
+    while pending:
+        path, depth = pending.pop()
+        if path in visited:
+            continue
+        visited.add(path)
+        if depth > max_depth:
+            logging.info(f"Stackfile includes are nested too deeply: {path}")
+            return None
+        try:
+            data = read_stackfile(path)
+        except (OSError, ValueError, StackfileError) as err:
+            logging.info(f"Cannot read stackfile {path}: {err}")
+            return None
+        _collect_strings(data, result)
+
+        includes = data.get("include", []) if isinstance(data, dict) else []
+        for include in includes if isinstance(includes, list) else [includes]:
+            if not isinstance(include, str):
+                return None
+            include = include.replace("${THIS_STACKFILE_DIR}", str(path.parent))
+            if "$" in include:
+                logging.info(f"Cannot resolve include without interpolation: {include}")
+                return None
+            pending.append(((path.parent / include).resolve(), depth + 1))
+    return result
+
+
+def relocate_stackfile(data: Dict[str, Any], path: Path) -> Dict[str, Any]:
+    """Return stackfile data read from path so that it can be used elsewhere.
+
+    This replaces ${THIS_STACKFILE_DIR} and ${THIS_STACKFILE_FILE} by the
+    location of path and makes relative include and plugin paths absolute.
+    """
+
+    def substitute(value: Any) -> Any:
+        if isinstance(value, str):
+            return value.replace("${THIS_STACKFILE_DIR}", str(path.parent)).replace(
+                "${THIS_STACKFILE_FILE}", str(path)
+            )
+        if isinstance(value, dict):
+            return {k: substitute(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [substitute(v) for v in value]
+        return value
+
+    def absolute(value: Any) -> Any:
+        if not isinstance(value, str) or value.startswith("$"):
+            return value
+        if value.startswith("builtin://") or os.path.isabs(value):
+            return value
+        return str(path.parent / value)
+
+    data = substitute(data)
+    includes = data.get("include")
+    if isinstance(includes, list):
+        data["include"] = [absolute(x) for x in includes]
+    plugins = data.get("plugins")
+    if isinstance(plugins, list):
+        for plugin in plugins:
+            if isinstance(plugin, dict) and "path" in plugin:
+                plugin["path"] = absolute(plugin["path"])
+    return data
+
+
+class StackfileCompiler:
+    """StackfileCompiler converts YAML stackfiles to JSON for cloe-engine.
+
+    The JSON files are cached in a directory, keyed by a hash of the path
+    and the content of the YAML file, so that unchanged files are not
+    parsed again. Since cloe-engine resolves relative paths relative to the
+    stackfile, and the JSON files are in the cache directory instead:
+
+    - ${THIS_STACKFILE_DIR} and ${THIS_STACKFILE_FILE} are replaced by the
+      location of the YAML file,
+    - relative include and plugin paths are made absolute, and
+    - included YAML files are converted as well.
+
+    Other relative paths in YAML stackfiles should use ${THIS_STACKFILE_DIR}.
+    """
+
+    version = 1
+
+    def __init__(self, cache_dir: Path):
+        self.cache_dir = cache_dir
+        self._compiled: Dict[Path, Path] = {}
+        self._active: Set[Path] = set()
+
+    def compile(self, path: Path) -> Path:
+        """Return the path to the JSON version of the YAML stackfile."""
+        path = path.resolve()
+        if path in self._compiled:
+            return self._compiled[path]
+        if path in self._active:
+            raise StackfileError(f"{path}: stackfile includes itself")
+        self._active.add(path)
+        try:
+            result = self._compile(path)
+        finally:
+            self._active.remove(path)
+        self._compiled[path] = result
+        return result
+
+    def _compile(self, path: Path) -> Path:
+        try:
+            content = path.read_bytes()
+        except OSError as err:
+            raise StackfileError(f"{path}: {err.strerror}") from err
+        digest = hashlib.sha256()
+        digest.update(f"{self.version}:{path}:".encode())
+        digest.update(content)
+        key = digest.hexdigest()[:32]
+        json_path = self.cache_dir / f"{key}.json"
+        deps_path = self.cache_dir / f"{key}.deps.json"
+
+        # The JSON file refers to the JSON files of included YAML files,
+        # which are only still valid if these have not changed either.
+        if json_path.exists() and deps_path.exists():
+            try:
+                with deps_path.open() as file:
+                    deps = json.load(file)
+                if all(str(self.compile(Path(k))) == v for k, v in deps.items()):
+                    logging.debug(f"Use cached stackfile: {json_path}")
+                    return json_path
+            except (OSError, ValueError, StackfileError) as err:
+                logging.debug(f"Cannot use cached stackfile {json_path}: {err}")
+
+        logging.info(f"Convert stackfile {path} into {json_path}")
+        data = _load_yaml(path, content)
+        if not isinstance(data, dict):
+            raise StackfileError(f"{path}: stackfile must contain a mapping")
+        deps: Dict[str, str] = {}
+        data = self._rewrite(data, path, deps)
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        for dst, value in [(json_path, data), (deps_path, deps)]:
+            tmp_path = dst.with_name(f".{dst.name}.{os.getpid()}.tmp")
+            with tmp_path.open("w") as file:
+                json.dump(value, file, indent=2, default=str)
+            os.replace(tmp_path, dst)
+        return json_path
+
+    def _rewrite(self, data: Any, path: Path, deps: Dict[str, str]) -> Any:
+        data = relocate_stackfile(data, path)
+        includes = data.get("include")
+        if isinstance(includes, list):
+            result = []
+            for include in includes:
+                if isinstance(include, str) and is_yaml(Path(include)):
+                    compiled = str(self.compile(Path(include)))
+                    deps[str(Path(include).resolve())] = compiled
+                    include = compiled
+                result.append(include)
+            data["include"] = result
+        return data
@@ -0,0 +1,265 @@
+# pylint: disable=logging-fstring-interpolation
+
+"""
+This module contains the expansion of parameter sweeps into stackfiles.
+
+A sweep definition consists of a base stackfile and a list of axes, each of
+which overrides a value in the base stackfile, addressed by a JSON pointer
+(RFC 6901), with a number of values. For example, in YAML:
+
+    version: "1"
+    base: plugins/minimator/tests/config_minimator_smoketest.json
+    mode: grid
+    axes:
+      - pointer: /simulation/model_step_width
+        values: [5000000, 20000000]
+      - pointer: /controllers/0/args/target_speed
+        linspace: [10, 30, 5]
+
+In grid mode, every combination of values is used. In random mode, samples
+combinations are drawn, where axes can also be given as a uniform range of
+floats or integers:
+
+    mode: random
+    samples: 1000
+    seed: 42
+    axes:
+      - pointer: /simulation/model_step_width
+        values: [5000000, 20000000]
+      - pointer: /vehicles/0/components/noisy_sensor/args/noise/0/distribution/std_deviation
+        uniform: [0.1, 1.0]
+      - pointer: /simulators/0/args/vehicles/count
+        randint: [1, 8]
+
+Stackfiles are expanded lazily and only ever exist in memory, and stackfiles
+that are identical to one expanded before are skipped.
+"""
+
+import copy
+import hashlib
+import itertools
+import json
+import logging
+import random
+
+from pathlib import Path
+from typing import Any
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+
+from cloe_launch.stackfile import StackfileCompiler
+from cloe_launch.stackfile import StackfileError
+from cloe_launch.stackfile import _collect_strings
+from cloe_launch.stackfile import is_yaml
+from cloe_launch.stackfile import read_stackfile
+from cloe_launch.stackfile import relocate_stackfile
+
+
+class SweepError(Exception):
+    """SweepError signifies an invalid sweep definition."""
+
+
+def json_pointer_set(doc: Any, pointer: str, value: Any) -> None:
+    """Set the value at the JSON pointer in doc, creating objects as needed.
+
+    The last token of the pointer may be "-" to append to an array.
+    """
+    if pointer == "" or not pointer.startswith("/"):
+        raise SweepError(f"invalid JSON pointer: {pointer!r}")
+    tokens = [t.replace("~1", "/").replace("~0", "~") for t in pointer[1:].split("/")]
+    node = doc
+    for i, token in enumerate(tokens):
+        last = i == len(tokens) - 1
+        if isinstance(node, dict):
+            if last:
+                node[token] = value
+            else:
+                node = node.setdefault(token, {})
+        elif isinstance(node, list):
+            if token == "-" and last:
+                node.append(value)
+                continue
+            try:
+                index = int(token)
+                if last:
+                    node[index] = value
+                else:
+                    node = node[index]
+            except (ValueError, IndexError) as err:
+                raise SweepError(f"invalid array index {token!r} in {pointer}") from err
+        else:
+            raise SweepError(
+                f"cannot set {pointer}: {token!r} is not in an object or array"
+            )
+
+
+def config_digest(config: Any) -> str:
+    """Return the content hash of a stackfile configuration."""
+    data = json.dumps(config, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def _is_int(value: Any) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+class Axis:
+    """Axis is a value in the base stackfile that is varied in a sweep."""
+
+    def __init__(self, conf: Dict[str, Any]):
+        if not isinstance(conf, dict) or "pointer" not in conf:
+            raise SweepError(f"axis requires a pointer: {conf!r}")
+        self.pointer = conf["pointer"]
+        self.values: Optional[List[Any]] = None
+        self.uniform: Optional[Tuple[float, float]] = None
+        self.randint: Optional[Tuple[int, int]] = None
+        if "values" in conf:
+            self.values = list(conf["values"])
+            if not self.values:
+                raise SweepError(f"axis {self.pointer} has no values")
+        elif "linspace" in conf:
+            start, stop, num = conf["linspace"]
+            if num < 2:
+                self.values = [start]
+            elif _is_int(start) and _is_int(stop) and (stop - start) % (num - 1) == 0:
+                # Integer fields reject floats, so keep integers if possible.
+                step = (stop - start) // (num - 1)
+                self.values = [start + step * i for i in range(num)]
+            else:
+                self.values = [
+                    start + (stop - start) * i / (num - 1) for i in range(num)
+                ]
+        elif "uniform" in conf:
+            low, high = conf["uniform"]
+            self.uniform = (float(low), float(high))
+        elif "randint" in conf:
+            low, high = conf["randint"]
+            self.randint = (int(low), int(high))
+        else:
+            raise SweepError(
+                f"axis {self.pointer} requires one of: "
+                "values, linspace, uniform, randint"
+            )
+
+    def sample(self, rng: random.Random) -> Any:
+        """Return a random value of the axis."""
+        if self.values is not None:
+            return rng.choice(self.values)
+        if self.uniform is not None:
+            return rng.uniform(*self.uniform)
+        assert self.randint is not None
+        return rng.randint(*self.randint)
+
+
+class Sweep:
+    """Sweep expands a sweep definition into stackfile configurations."""
+
+    modes = ["grid", "random"]
+
+    def __init__(self, path: Path, compiler: Optional[StackfileCompiler] = None):
+        self.path = path
+        try:
+            conf = read_stackfile(path)
+        except (OSError, ValueError, StackfileError) as err:
+            raise SweepError(f"{path}: {err}") from err
+        if not isinstance(conf, dict):
+            raise SweepError(f"{path}: sweep definition must contain a mapping")
+        if str(conf.get("version")) != "1":
+            raise SweepError(
+                f"{path}: unsupported sweep version: {conf.get('version')}"
+            )
+
+        self.mode = conf.get("mode", "grid")
+        if self.mode not in self.modes:
+            raise SweepError(f"{path}: mode must be one of: {', '.join(self.modes)}")
+        self.samples = int(conf.get("samples", 1))
+        self.seed = conf.get("seed")
+        self.axes = [Axis(x) for x in conf.get("axes", [])]
+        if self.mode == "grid" and any(x.values is None for x in self.axes):
+            raise SweepError(
+                f"{path}: grid mode requires values or linspace for all axes"
+            )
+
+        if "base" not in conf:
+            raise SweepError(f"{path}: sweep definition requires a base stackfile")
+        self.base_path = (path.parent / conf["base"]).resolve()
+        self.base = self._read_base(compiler)
+
+    def _read_base(self, compiler: Optional[StackfileCompiler]) -> Dict[str, Any]:
+        """Read the base stackfile so that it can be passed via stdin."""
+        path = self.base_path
+        if is_yaml(path):
+            if compiler is None:
+                raise SweepError(f"{path}: YAML base stackfile requires a compiler")
+            path = compiler.compile(path)
+            data = read_stackfile(path)
+        else:
+            try:
+                data = read_stackfile(path)
+            except (OSError, ValueError) as err:
+                raise SweepError(f"{path}: cannot read base stackfile: {err}") from err
+        if not isinstance(data, dict):
+            raise SweepError(f"{path}: base stackfile must contain a mapping")
+        return relocate_stackfile(data, self.base_path)
+
+    def size(self) -> int:
+        """Return the number of points, before deduplication."""
+        if self.mode == "random":
+            return self.samples
+        size = 1
+        for axis in self.axes:
+            assert axis.values is not None
+            size *= len(axis.values)
+        return size
+
+    def points(self) -> Iterator[Dict[str, Any]]:
+        """Return the value of each axis for each point, by pointer."""
+        if self.mode == "grid":
+            values = [axis.values for axis in self.axes]
+            for combination in itertools.product(*values):  # type: ignore
+                yield {a.pointer: v for a, v in zip(self.axes, combination)}
+        else:
+            rng = random.Random(self.seed)
+            for _ in range(self.samples):
+                yield {a.pointer: a.sample(rng) for a in self.axes}
+
+    def configs(self) -> Iterator[Tuple[Dict[str, Any], Dict[str, Any], str]]:
+        """Return the parameters, stackfile, and digest of each unique point."""
+        seen: Set[str] = set()
+        duplicates = 0
+        for params in self.points():
+            config = copy.deepcopy(self.base)
+            for pointer, value in params.items():
+                json_pointer_set(config, pointer, value)
+            digest = config_digest(config)
+            if digest in seen:
+                duplicates += 1
+                continue
+            seen.add(digest)
+            yield params, config, digest
+        if duplicates:
+            logging.info(f"Skipped {duplicates} duplicate sweep configurations")
+
+    def includes(self) -> List[str]:
+        """Return the stackfiles that the base stackfile includes."""
+        includes = self.base.get("include", [])
+        return (
+            [x for x in includes if isinstance(x, str)]
+            if isinstance(includes, list)
+            else []
+        )
+
+    def references(self) -> Set[str]:
+        """Return all strings in the base stackfile and the axis values.
+
+        This does not include the strings in the included stackfiles.
+        """
+        strings: Set[str] = set()
+        _collect_strings(self.base, strings)
+        for axis in self.axes:
+            _collect_strings(axis.values, strings)
+        return strings
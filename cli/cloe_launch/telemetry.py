@@ -0,0 +1,258 @@
+# pylint: disable=logging-fstring-interpolation
+
+"""
+This module contains the sampling of resource usage of cloe-engine.
+
+A Sampler periodically reads the resource usage of a process and all of its
+descendants from /proc and writes it as a time series in CSV format, one
+line per sample:
+
+    time,processes,threads,rss,cpu_time,voluntary_ctxt_switches,...
+
+The gauges (processes, threads, rss) describe the process tree at the time
+of the sample, whereas the counters (cpu_time, context switches, I/O bytes)
+are cumulative and include processes that have exited since they were last
+seen. The peak and mean values are aggregated while sampling, so that the
+samples need not be kept in memory for long simulations.
+"""
+
+import os
+import threading
+import time
+
+from pathlib import Path
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+columns = [
+    "time",
+    "processes",
+    "threads",
+    "rss",
+    "cpu_time",
+    "voluntary_ctxt_switches",
+    "nonvoluntary_ctxt_switches",
+    "read_bytes",
+    "write_bytes",
+]
+
+# Counters are read per process: cpu_time, context switches, and I/O bytes.
+_Counters = Tuple[float, int, int, int, int]
+
+_clock_ticks = os.sysconf("SC_CLK_TCK")
+_page_size = os.sysconf("SC_PAGE_SIZE")
+
+
+def _read(path: str) -> Optional[str]:
+    try:
+        with open(path) as file:
+            return file.read()
+    except OSError:
+        # The process has exited, or we are not allowed to read it.
+        return None
+
+
+def _children(pid: int) -> Optional[List[int]]:
+    """Return the children of the process, or None if the kernel can't tell."""
+    result = []
+    try:
+        tids = os.listdir(f"/proc/{pid}/task")
+    except OSError:
+        return []
+    for tid in tids:
+        data = _read(f"/proc/{pid}/task/{tid}/children")
+        if data is None:
+            if not os.path.exists(f"/proc/{pid}/task/{tid}/children"):
+                return None
+            continue
+        result.extend(int(x) for x in data.split())
+    return result
+
+
+def _parents() -> Dict[int, List[int]]:
+    """Return the children of all processes, by scanning /proc."""
+    result: Dict[int, List[int]] = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        data = _read(f"/proc/{entry}/stat")
+        if data is None:
+            continue
+        ppid = int(data[data.rindex(")") + 2 :].split()[1])
+        result.setdefault(ppid, []).append(int(entry))
+    return result
+
+
+def process_tree(root: int) -> List[int]:
+    """Return the process and all its descendants."""
+    parents: Optional[Dict[int, List[int]]] = None
+    result = []
+    stack = [root]
+    while stack:
+        pid = stack.pop()
+        result.append(pid)
+        children = None if parents is not None else _children(pid)
+        if children is None:
+            # Fall back to scanning all processes if children files are not
+            # available (they require CONFIG_PROC_CHILDREN).
+            if parents is None:
+                parents = _parents()
+            children = parents.get(pid, [])
+        stack.extend(children)
+    return result
+
+
+class Sampler:
+    """Sampler records the resource usage of a process tree in a thread."""
+
+    def __init__(self, pid: int, path: Path, interval: float = 1.0):
+        self.pid = pid
+        self.path = path
+        self.interval = interval
+        self.count = 0
+        self.last: Optional[List[float]] = None
+        self.peaks = [0.0] * len(columns)
+        self.sums = [0.0] * len(columns)
+        self.cpu_usage_peak: Optional[float] = None
+        self._seen: Dict[Tuple[int, str], _Counters] = {}
+        self._start = 0.0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def __enter__(self) -> "Sampler":
+        self.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.stop()
+
+    def _read_process(self, pid: int) -> Optional[Tuple[int, int]]:
+        """Update the counters of the process and return its threads and RSS."""
+        stat = _read(f"/proc/{pid}/stat")
+        if stat is None:
+            return None
+        fields = stat[stat.rindex(")") + 2 :].split()
+        cpu_time = (int(fields[11]) + int(fields[12])) / _clock_ticks
+        threads = int(fields[17])
+        rss = int(fields[21]) * _page_size
+
+        ctxt = {}
+        for line in (_read(f"/proc/{pid}/status") or "").splitlines():
+            if "ctxt_switches:" in line:
+                key, value = line.split(":", 1)
+                ctxt[key] = int(value)
+        io = {}
+        for line in (_read(f"/proc/{pid}/io") or "").splitlines():
+            key, value = line.split(":", 1)
+            io[key] = int(value)
+
+        # The start time distinguishes processes with recycled PIDs.
+        self._seen[(pid, fields[19])] = (
+            cpu_time,
+            ctxt.get("voluntary_ctxt_switches", 0),
+            ctxt.get("nonvoluntary_ctxt_switches", 0),
+            io.get("read_bytes", 0),
+            io.get("write_bytes", 0),
+        )
+        return threads, rss
+
+    def sample(self) -> List[float]:
+        """Take a sample of the process tree and return it."""
+        processes = threads = rss = 0
+        for pid in process_tree(self.pid):
+            usage = self._read_process(pid)
+            if usage is None:
+                continue
+            processes += 1
+            threads += usage[0]
+            rss += usage[1]
+        counters = [sum(x) for x in zip(*self._seen.values())] or [0] * 5
+        sample = [
+            round(time.monotonic() - self._start, 3),
+            processes,
+            threads,
+            rss,
+            round(counters[0], 2),
+        ] + counters[1:]
+        if processes != 0:
+            self._aggregate(sample)
+        return sample
+
+    def _aggregate(self, sample: List[float]) -> None:
+        if self.last is not None and sample[0] > self.last[0]:
+            usage = (sample[4] - self.last[4]) / (sample[0] - self.last[0])
+            self.cpu_usage_peak = max(usage, self.cpu_usage_peak or 0.0)
+        self.count += 1
+        self.last = sample
+        self.peaks = [max(a, b) for a, b in zip(self.peaks, sample)]
+        self.sums = [a + b for a, b in zip(self.sums, sample)]
+
+    def _run(self) -> None:
+        with self.path.open("w") as file:
+            file.write(",".join(columns) + "\n")
+            while True:
+                sample = self.sample()
+                if sample[1] != 0:
+                    file.write(",".join(str(x) for x in sample) + "\n")
+                    file.flush()
+                if self._stop.wait(self.interval):
+                    break
+
+    def start(self) -> None:
+        """Start sampling in a background thread."""
+        self._start = time.monotonic()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop sampling and wait for the thread to finish."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def summary(self) -> Dict[str, Any]:
+        """Return the peak and mean values of the time series."""
+        last = self.last
+        if last is None:
+            return {"interval": self.interval, "samples": 0}
+        cpu_usage_peak = self.cpu_usage_peak
+
+        def mean(index: int) -> float:
+            return self.sums[index] / self.count
+
+        return {
+            "interval": self.interval,
+            "samples": self.count,
+            "duration": last[0],
+            "rss_peak": self.peaks[3],
+            "rss_mean": round(mean(3)),
+            "threads_peak": self.peaks[2],
+            "threads_mean": round(mean(2), 2),
+            "processes_peak": self.peaks[1],
+            "cpu_time": last[4],
+            "cpu_usage_peak": None
+            if cpu_usage_peak is None
+            else round(cpu_usage_peak, 3),
+            "cpu_usage_mean": round(last[4] / last[0], 3) if last[0] > 0 else None,
+            "voluntary_ctxt_switches": last[5],
+            "nonvoluntary_ctxt_switches": last[6],
+            "read_bytes": last[7],
+            "write_bytes": last[8],
+        }
+
+
+def format_summary(summary: Dict[str, Any]) -> str:
+    """Return the summary in a single human-readable line."""
+    if not summary.get("samples"):
+        return "no samples"
+    return (
+        f"peak RSS {summary['rss_peak'] / (1 << 20):.1f} MiB, "
+        f"mean RSS {summary['rss_mean'] / (1 << 20):.1f} MiB, "
+        f"peak threads {summary['threads_peak']}, "
+        f"CPU time {summary['cpu_time']:.2f}s, "
+        f"mean CPU usage {(summary['cpu_usage_mean'] or 0) * 100:.0f}%"
+    )
@@ -1,9 +1,16 @@
+import fcntl
+import hashlib
 import logging
+import os
 import subprocess
 
+from pathlib import Path
 from typing import Dict
+from typing import Iterable
 from typing import List
 from typing import Optional
+from typing import TextIO
+from typing import Union
 
 
 def run_cmd(
@@ -11,15 +18,24 @@ def run_cmd(
     env: Optional[Dict[str, str]] = None,
     must_succeed: bool = True,
     capture_output: bool = True,
+    log_file: Optional[TextIO] = None,
 ) -> subprocess.CompletedProcess:
-    """Run a command quietly, only printing stderr if the command fails."""
+    """Run a command quietly, only printing stderr if the command fails.
+
+    If log_file is given, all output of the command is written to it instead.
+    """
 
     logging.info(f"Exec: {' '.join(cmd)}")
+    if log_file is not None:
+        print(f"Exec: {' '.join(cmd)}", file=log_file, flush=True)
+        output = log_file
+    else:
+        output = subprocess.PIPE if capture_output else None
     result = subprocess.run(
         cmd,
         check=False,
-        stdout=subprocess.PIPE if capture_output else None,
-        stderr=subprocess.STDOUT if capture_output else None,
+        stdout=output,
+        stderr=subprocess.STDOUT if output is not None else None,
         universal_newlines=True,
         env=env,
     )
@@ -27,6 +43,115 @@ def run_cmd(
         logging.error(f"Error running: {' '.join(cmd)}")
         if result.stdout is not None:
             logging.error(result.stdout)
+        elif log_file is not None:
+            logging.error(f"See log file for output: {log_file.name}")
         if must_succeed:
             raise ChildProcessError()
     return result
+
+
+def file_digest(path: Union[Path, str], chunk_size: int = 1 << 16) -> str:
+    """Return the SHA-256 hex digest of a file, read in chunks."""
+    hasher = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def fingerprint_files(
+    paths: Iterable[Union[Path, str]]
+) -> Dict[str, Dict[str, Union[int, str]]]:
+    """Return the modification time, size, and digest of each file."""
+    result = {}
+    for path in paths:
+        stat = os.stat(path)
+        result[str(path)] = {
+            "mtime_ns": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "sha256": file_digest(path),
+        }
+    return result
+
+
+def fingerprints_match(recorded: Dict[str, Dict[str, Union[int, str]]]) -> bool:
+    """Return true if all files still match their recorded fingerprints.
+
+    The modification time and size are compared first; only if these differ
+    is the file hashed, so that touching a file without changing it does not
+    invalidate the fingerprint. In that case the recorded modification time
+    is updated in-place.
+    """
+    for path, fingerprint in recorded.items():
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            logging.debug(f"Fingerprinted file was removed: {path}")
+            return False
+        if stat.st_size != fingerprint["size"]:
+            logging.debug(f"Fingerprinted file changed size: {path}")
+            return False
+        if stat.st_mtime_ns == fingerprint["mtime_ns"]:
+            continue
+        if file_digest(path) != fingerprint["sha256"]:
+            logging.debug(f"Fingerprinted file changed: {path}")
+            return False
+        fingerprint["mtime_ns"] = stat.st_mtime_ns
+    return True
+
+
+def lock_file(path: Path, shared: bool = False, blocking: bool = True) -> Optional[int]:
+    """Lock the file, creating it if necessary, and return its descriptor.
+
+    The lock is released when the descriptor is closed. If blocking is false
+    and the file is locked by another process, None is returned.
+
+    A file that is removed by the holder of an exclusive lock while another
+    process waits for the lock is no longer found at the path; in that case
+    the new file at the path is locked instead.
+    """
+    operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+    if not blocking:
+        operation |= fcntl.LOCK_NB
+    while True:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, operation)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        except BaseException:
+            os.close(fd)
+            raise
+        try:
+            if os.stat(path).st_ino == os.fstat(fd).st_ino:
+                return fd
+        except FileNotFoundError:
+            pass
+        os.close(fd)
+
+
+def relocate_files(root: Path, old: str, new: str) -> List[Path]:
+    """Replace the path old by new in all files and symlinks in root, recursively.
+
+    Files that do not contain old are not modified. Return the modified files.
+    """
+    old_bytes = old.encode()
+    new_bytes = new.encode()
+    result = []
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            path = Path(dirpath) / filename
+            if path.is_symlink():
+                target = os.readlink(path)
+                if old in target:
+                    path.unlink()
+                    path.symlink_to(target.replace(old, new))
+                    result.append(path)
+                continue
+            data = path.read_bytes()
+            if old_bytes not in data:
+                continue
+            path.write_bytes(data.replace(old_bytes, new_bytes))
+            result.append(path)
+    return result
@@ -22,8 +22,12 @@ setup(
     entry_points={
         "console_scripts": ["cloe-launch = cloe_launch.__main__:entry_point"]
     },
-    packages=["cloe_launch"],
+    packages=["cloe_gndtruth", "cloe_launch"],
     package_dir={"": "."},
     package_data={},
-    install_requires=["click==7.*,>=7.1.2", "toml==0.*,>=0.10.1"],
+    install_requires=["click==7.*,>=7.1.2", "pyyaml>=5.1", "toml==0.*,>=0.10.1"],
+    extras_require={
+        "gndtruth": ["msgpack>=1.0", "numpy>=1.19"],
+        "report": ["numpy>=1.19"],
+    },
 )
@@ -0,0 +1,66 @@
+import hashlib
+import json
+
+from cloe_launch.check import include_closure
+from cloe_launch.check import interpolate
+
+
+def _write(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(data) if not isinstance(data, str) else data)
+    return hashlib.sha256(path.read_bytes()).hexdigest()
+
+
+def test_interpolate():
+    used = set()
+    env = {"HOME": "/home/user"}
+    assert interpolate("${HOME}/x", env, used) == "/home/user/x"
+    assert interpolate("${DIR-/tmp}/x", env, used) == "/tmp/x"
+    assert interpolate("${DIR:-/tmp}/x", env, used) == "/tmp/x"
+    assert interpolate("${DIR}/x", env, used) is None
+    assert used == {"HOME", "DIR"}
+
+
+def test_include_closure(tmp_path):
+    tmp_path = tmp_path.resolve()
+    root = tmp_path / "root.json"
+    root_digest = _write(
+        root,
+        {
+            "version": "4",
+            "include": ["sub/a.json", "${THIS_STACKFILE_DIR}/b.json", "${DIR}/c.json"],
+            "simulators": [{"binding": "${SIM-minimator}"}],
+        },
+    )
+    a_digest = _write(
+        tmp_path / "sub" / "a.json",
+        '// comment\n{"version": "4", "include": ["../b.json", "missing.json"]}',
+    )
+    b_digest = _write(tmp_path / "b.json", {"version": "4", "include": "root.json"})
+    c_digest = _write(tmp_path / "c" / "c.json", "not json")
+
+    digests, used = include_closure(root, {"DIR": str(tmp_path / "c")})
+    assert digests == sorted(
+        [
+            (str(root), root_digest),
+            (str(tmp_path / "sub" / "a.json"), a_digest),
+            (str(tmp_path / "sub" / "missing.json"), "missing"),
+            (str(tmp_path / "b.json"), b_digest),
+            (str(tmp_path / "c" / "c.json"), c_digest),
+        ]
+    )
+    assert {"DIR", "SIM"} <= used
+
+
+def test_include_closure_unresolved(tmp_path):
+    root = tmp_path / "root.json"
+    _write(root, {"version": "4", "include": ["${DIR}/c.json"]})
+    assert include_closure(root, {}) is None
+
+
+def test_include_closure_too_deep(tmp_path):
+    for i in range(4):
+        _write(tmp_path / f"{i}.json", {"version": "4", "include": [f"{i + 1}.json"]})
+    assert include_closure(tmp_path / "0.json", {}, max_depth=2) is None
+    digests, _ = include_closure(tmp_path / "0.json", {}, max_depth=4)
+    assert len(digests) == 5
@@ -0,0 +1,177 @@
+import bz2
+import gzip
+import json
+import struct
+import sys
+
+import pytest
+
+from cloe_gndtruth import GndTruthError
+from cloe_gndtruth import read_frames
+from cloe_gndtruth import reader
+
+
+def _pack(value):
+    """Encode a value as MessagePack, as nlohmann::json does."""
+    if value is None:
+        return b"\xc0"
+    if isinstance(value, bool):
+        return b"\xc3" if value else b"\xc2"
+    if isinstance(value, int):
+        if 0 <= value <= 0x7F:
+            return struct.pack(">B", value)
+        if -32 <= value < 0:
+            return struct.pack(">b", value)
+        return b"\xd3" + struct.pack(">q", value)
+    if isinstance(value, float):
+        return b"\xcb" + struct.pack(">d", value)
+    if isinstance(value, str):
+        data = value.encode()
+        if len(data) <= 31:
+            return struct.pack(">B", 0xA0 | len(data)) + data
+        return b"\xd9" + struct.pack(">B", len(data)) + data
+    if isinstance(value, list):
+        head = b"\xdc" + struct.pack(">H", len(value))
+        return head + b"".join(_pack(x) for x in value)
+    if isinstance(value, dict):
+        head = b"\xde" + struct.pack(">H", len(value))
+        return head + b"".join(_pack(k) + _pack(v) for k, v in value.items())
+    raise TypeError(value)
+
+
+def _frames(count):
+    return [
+        {
+            "sim_time": i * 0.02,
+            "sim_step": i,
+            "components": {
+                "cloe::default_world_sensor": {
+                    "sensed_objects": [{"id": 1, "velocity_norm": -1.5 * i}],
+                    "valid": i % 2 == 0,
+                    "name": "default_world_sensor_with_a_long_name",
+                    "error": None,
+                },
+            },
+        }
+        for i in range(count)
+    ]
+
+
+@pytest.fixture
+def no_msgpack(monkeypatch):
+    monkeypatch.setitem(sys.modules, "msgpack", None)
+
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    monkeypatch.setattr(reader, "chunk_size", 64)
+
+
+@pytest.mark.parametrize("opener", [open, gzip.open, bz2.open])
+def test_read_json(tmp_path, small_chunks, opener):
+    path = tmp_path / "gndtruth.json"
+    with opener(str(path), "wt") as file:
+        file.write(json.dumps(_frames(20), indent=2))
+    assert list(read_frames(path)) == _frames(20)
+
+
+def test_read_json_unterminated(tmp_path, small_chunks):
+    path = tmp_path / "gndtruth.json"
+    path.write_text("[\n" + ",\n".join(json.dumps(x) for x in _frames(5)) + ",\n")
+    assert list(read_frames(path)) == _frames(5)
+
+
+def test_read_json_truncated(tmp_path):
+    path = tmp_path / "gndtruth.json"
+    path.write_text(json.dumps(_frames(5))[:-20])
+    with pytest.raises(GndTruthError):
+        list(read_frames(path))
+
+
+def test_read_time_range(tmp_path):
+    path = tmp_path / "gndtruth.json"
+    path.write_text(json.dumps(_frames(20)))
+    steps = [x["sim_step"] for x in read_frames(path, start=0.1, stop=0.2)]
+    assert steps == [5, 6, 7, 8, 9, 10]
+
+
+def test_read_msgpack(tmp_path, small_chunks, no_msgpack):
+    path = tmp_path / "gndtruth.msgpack"
+    path.write_bytes(_pack(_frames(20)))
+    assert list(read_frames(path)) == _frames(20)
+
+
+def test_read_msgpack_gzip(tmp_path, no_msgpack):
+    path = tmp_path / "gndtruth.msgpack.zip"
+    with gzip.open(str(path), "wb") as file:
+        file.write(_pack(_frames(3)))
+    assert list(read_frames(path)) == _frames(3)
+
+
+def test_read_msgpack_package(tmp_path, small_chunks):
+    pytest.importorskip("msgpack")
+    path = tmp_path / "gndtruth.msgpack"
+    path.write_bytes(_pack(_frames(20)))
+    assert list(read_frames(path)) == _frames(20)
+
+
+def test_read_msgpack_truncated(tmp_path, no_msgpack):
+    path = tmp_path / "gndtruth.msgpack"
+    path.write_bytes(_pack(_frames(3))[:-10])
+    with pytest.raises(GndTruthError):
+        list(read_frames(path))
+
+
+def test_read_invalid(tmp_path):
+    path = tmp_path / "gndtruth.json"
+    path.write_text('{"sim_time": 0}')
+    with pytest.raises(GndTruthError):
+        list(read_frames(path))
+    path.write_text('[{"sim_step": 0}]')
+    with pytest.raises(GndTruthError):
+        list(read_frames(path))
+
+
+def _object(oid, x):
+    vector = {"x": x, "y": 0.0, "z": 0.0}
+    return {
+        "id": oid,
+        "exist_prob": 1.0,
+        "type": "dynamic",
+        "class": "car",
+        "pose": {"translation": vector, "rotation": {"w": 1.0, **vector}},
+        "dimensions": vector,
+        "velocity": vector,
+        "acceleration": vector,
+        "angular_velocity": vector,
+        "velocity_norm": x,
+    }
+
+
+def test_read_arrays(tmp_path):
+    pytest.importorskip("numpy")
+    from cloe_gndtruth import read_arrays
+
+    frames = [
+        {
+            "sim_time": i * 0.02,
+            "sim_step": i,
+            "components": {
+                "cloe::default_ego_sensor": {"sensed_state": _object(0, i)},
+                "cloe::default_world_sensor": {
+                    "sensed_objects": [_object(j, i) for j in range(1, 1 + i % 3)]
+                },
+            },
+        }
+        for i in range(10)
+    ]
+    path = tmp_path / "gndtruth.json.gz"
+    with gzip.open(str(path), "wt") as file:
+        json.dump(frames, file)
+    gt = read_arrays(path, start=0.04)
+    assert list(gt.frames["step"]) == list(range(2, 10))
+    assert list(gt.ego["speed"]) == list(range(2, 10))
+    assert list(gt.tracks) == [1, 2]
+    assert list(gt.tracks[1]["step"]) == [2, 4, 5, 7, 8]
+    assert list(gt.tracks[2]["x"]) == [2, 5, 8]
+    assert gt.tracks[2]["class"][0] == "car"
@@ -0,0 +1,96 @@
+import json
+
+import pytest
+
+from cloe_launch.registry import parse_duration
+from cloe_launch.registry import read_run
+from cloe_launch.registry import stack_hash
+
+
+@pytest.mark.parametrize(
+    "value,expected",
+    [
+        ("1.5s", 1.5),
+        ("250ms", 0.25),
+        ("20us", 20e-6),
+        ("3ns", 3e-9),
+        (2, 2.0),
+        (0.5, 0.5),
+        ("1.5 s", None),
+        ("1h", None),
+        (None, None),
+    ],
+)
+def test_parse_duration(value, expected):
+    assert parse_duration(value) == pytest.approx(expected)
+
+
+def _result():
+    return {
+        "uuid": "run-1",
+        "outcome": "success",
+        "elapsed": "2s",
+        "simulation": {
+            "step": 100,
+            "time": {"ms": 2000},
+            "realtime_factor": 1.0,
+            "achievable_realtime_factor": 4.5,
+        },
+        "statistics": {
+            "engine_time_ms": {"min": 0.1, "max": 3.0, "mean": 0.5},
+        },
+    }
+
+
+def test_read_run(tmp_path):
+    (tmp_path / "result.json").write_text(json.dumps(_result()))
+    (tmp_path / "triggers.json").write_text("[]")
+    row = read_run(tmp_path)
+    assert row["uuid"] == "run-1"
+    assert row["output_dir"] == str(tmp_path)
+    assert row["outcome"] == "success"
+    assert row["elapsed_s"] == 2.0
+    assert row["steps"] == 100
+    assert row["sim_time_ms"] == 2000
+    assert row["achievable_realtime_factor"] == 4.5
+    assert row["engine_time_ms_max"] == 3.0
+    assert row["engine_time_ms_std"] is None
+    assert row["controller_time_ms_mean"] is None
+    assert row["stack_hash"] is None
+    assert row["result_file"] == str(tmp_path / "result.json")
+    assert row["triggers_file"] == str(tmp_path / "triggers.json")
+    assert row["config_file"] is None
+    assert read_run(tmp_path, "other")["uuid"] == "other"
+
+
+def test_read_run_configured_files(tmp_path):
+    config = {
+        "engine": {
+            "output": {
+                "path": str(tmp_path),
+                "files": {"result": "out/res.json", "api_recording": "api.json"},
+            }
+        }
+    }
+    (tmp_path / "config.json").write_text(json.dumps(config))
+    (tmp_path / "out").mkdir()
+    (tmp_path / "out" / "res.json").write_text(json.dumps(_result()))
+    (tmp_path / "api.json").write_text("{}")
+    row = read_run(tmp_path)
+    assert row["result_file"] == str(tmp_path / "out" / "res.json")
+    assert row["api_recording_file"] == str(tmp_path / "api.json")
+    assert row["config_file"] == str(tmp_path / "config.json")
+    assert row["stack_hash"] == stack_hash(config)
+
+
+def test_read_run_without_result(tmp_path):
+    assert read_run(tmp_path) is None
+    (tmp_path / "result.json").write_text("{")
+    assert read_run(tmp_path) is None
+
+
+def test_stack_hash_ignores_output_path():
+    first = {"engine": {"output": {"path": "/tmp/a"}, "registry_path": "/tmp/a"}}
+    second = {"engine": {"output": {"path": "/tmp/b"}, "registry_path": "/tmp/b"}}
+    assert stack_hash(first) == stack_hash(second)
+    assert first["engine"]["output"]["path"] == "/tmp/a"
@@ -0,0 +1,71 @@
+import math
+
+import pytest
+
+from cloe_launch.report import compare_metric
+
+
+def _stats(mean, std=0.0, n=1):
+    return {"mean": mean, "std": std, "n": n}
+
+
+def test_compare_metric_threshold_only():
+    result = compare_metric("engine_time_ms.mean", _stats(1.2), _stats(1.0), 0.05, 3.0)
+    assert result["status"] == "regression"
+    assert result["change"] == pytest.approx(0.2)
+    assert result["t"] is None
+    assert result["baseline"] == 1.0
+    assert result["current"] == 1.2
+
+    result = compare_metric("engine_time_ms.mean", _stats(1.02), _stats(1.0), 0.05, 3.0)
+    assert result["status"] == "ok"
+
+    result = compare_metric("engine_time_ms.mean", _stats(0.8), _stats(1.0), 0.05, 3.0)
+    assert result["status"] == "improvement"
+
+
+def test_compare_metric_higher_is_better():
+    result = compare_metric(
+        "achievable_realtime_factor", _stats(4.0), _stats(5.0), 0.05, 3.0
+    )
+    assert result["status"] == "regression"
+    assert result["change"] == pytest.approx(0.2)
+
+    result = compare_metric(
+        "achievable_realtime_factor", _stats(6.0), _stats(5.0), 0.05, 3.0
+    )
+    assert result["status"] == "improvement"
+
+
+def test_compare_metric_significance():
+    current = _stats(1.2, std=1.0, n=10)
+    baseline = _stats(1.0, std=1.0, n=10)
+    result = compare_metric("engine_time_ms.mean", current, baseline, 0.05, 3.0)
+    assert result["t"] == pytest.approx(0.2 / math.sqrt(0.2))
+    assert result["status"] == "ok"
+
+    current = _stats(1.2, std=0.01, n=10)
+    baseline = _stats(1.0, std=0.01, n=10)
+    result = compare_metric("engine_time_ms.mean", current, baseline, 0.05, 3.0)
+    assert result["t"] > 3.0
+    assert result["status"] == "regression"
+
+
+def test_compare_metric_without_variance():
+    current = _stats(1.2, n=5)
+    baseline = _stats(1.0, n=5)
+    result = compare_metric("engine_time_ms.mean", current, baseline, 0.05, 3.0)
+    assert result["t"] == math.inf
+    assert result["status"] == "regression"
+
+    result = compare_metric("engine_time_ms.mean", baseline, baseline, 0.05, 3.0)
+    assert result["t"] == 0.0
+    assert result["status"] == "ok"
+
+
+def test_compare_metric_zero_baseline():
+    result = compare_metric(
+        "controller_retries.max", _stats(2.0), _stats(0.0), 0.05, 3.0
+    )
+    assert result["change"] == 0.0
+    assert result["status"] == "ok"
@@ -0,0 +1,99 @@
+import json
+
+import pytest
+
+from cloe_launch.sweep import Axis
+from cloe_launch.sweep import Sweep
+from cloe_launch.sweep import SweepError
+from cloe_launch.sweep import json_pointer_set
+
+
+def test_json_pointer_set_creates_objects():
+    doc = {}
+    json_pointer_set(doc, "/simulators/0~1x/speed", 10)
+    assert doc == {"simulators": {"0/x": {"speed": 10}}}
+
+
+def test_json_pointer_set_arrays():
+    doc = {"list": [{"a": 1}, {"a": 2}]}
+    json_pointer_set(doc, "/list/1/a", 3)
+    json_pointer_set(doc, "/list/-", 4)
+    assert doc == {"list": [{"a": 1}, {"a": 3}, 4]}
+
+
+@pytest.mark.parametrize("pointer", ["", "list", "/list/2", "/list/x", "/value/x"])
+def test_json_pointer_set_invalid(pointer):
+    with pytest.raises(SweepError):
+        json_pointer_set({"list": [1, 2], "value": 1}, pointer, 0)
+
+
+def test_axis_linspace():
+    assert Axis({"pointer": "/x", "linspace": [0, 10, 3]}).values == [0, 5, 10]
+    assert Axis({"pointer": "/x", "linspace": [0, 1, 3]}).values == [0, 0.5, 1.0]
+    assert Axis({"pointer": "/x", "linspace": [2, 3, 1]}).values == [2]
+    values = Axis({"pointer": "/x", "linspace": [0, 10, 3]}).values
+    assert all(isinstance(x, int) for x in values)
+
+
+def _write_sweep(tmp_path, sweep):
+    (tmp_path / "base.json").write_text(
+        json.dumps({"version": "4", "include": ["x.json"], "value": 0})
+    )
+    path = tmp_path / "sweep.json"
+    path.write_text(json.dumps(dict(version="1", base="base.json", **sweep)))
+    return Sweep(path)
+
+
+def test_sweep_grid(tmp_path):
+    sweep = _write_sweep(
+        tmp_path,
+        {
+            "axes": [
+                {"pointer": "/value", "values": [1, 2]},
+                {"pointer": "/extra/speed", "values": [10, 20, 30]},
+            ]
+        },
+    )
+    assert sweep.size() == 6
+    configs = list(sweep.configs())
+    assert len(configs) == 6
+    params, config, _ = configs[-1]
+    assert params == {"/value": 2, "/extra/speed": 30}
+    assert config["value"] == 2
+    assert config["extra"] == {"speed": 30}
+    assert config["include"] == [str(tmp_path / "x.json")]
+    assert sweep.base["value"] == 0
+
+
+def test_sweep_deduplicates(tmp_path):
+    sweep = _write_sweep(
+        tmp_path,
+        {
+            "axes": [
+                {"pointer": "/value", "values": [1, 1, 2]},
+                {"pointer": "/other", "values": ["a"]},
+            ]
+        },
+    )
+    assert sweep.size() == 3
+    digests = [digest for _, _, digest in sweep.configs()]
+    assert len(digests) == 2
+    assert len(set(digests)) == 2
+
+
+def test_sweep_random_is_seeded(tmp_path):
+    conf = {
+        "mode": "random",
+        "samples": 5,
+        "seed": 42,
+        "axes": [{"pointer": "/value", "uniform": [0, 1]}],
+    }
+    first = list(_write_sweep(tmp_path, conf).points())
+    second = list(_write_sweep(tmp_path, conf).points())
+    assert len(first) == 5
+    assert first == second
+
+
+def test_sweep_grid_requires_values(tmp_path):
+    with pytest.raises(SweepError):
+        _write_sweep(tmp_path, {"axes": [{"pointer": "/value", "uniform": [0, 1]}]})
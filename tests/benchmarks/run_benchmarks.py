@@ -0,0 +1,413 @@
+#!/usr/bin/env python3
+
+"""
+Run the Cloe benchmark suite and keep a history of the results per commit.
+
+The suite measures:
+
+  engine.<config>.<variant>   steps per second of cloe-engine
+  launcher.exec_warm          overhead of cloe-launch exec with a warm cache
+  launcher.exec_cold          overhead of cloe-launch exec with a cold cache
+  launcher.startup_full       time to start cloe-engine and load all plugins
+  launcher.startup_compact    the same, with the library path compacted
+
+where config is one of the bench_*.json stackfiles in this directory (nop,
+minimator, basic, virtue, gndtruth), and variant is one of:
+
+  plain           without the server
+  server          with the server listening
+  api_recording   with the server and the api_recording output
+
+Each simulation runs as fast as possible for the same simulation time, and
+its steps per second are computed from the result that cloe-engine prints.
+The launcher overhead is the time of `cloe-launch exec -- version` minus the
+time of `cloe-engine version`; the cold cache is cleared before each sample.
+The startup time is the time of `cloe-launch exec -- check` with the full
+library path, with one directory per package, and with all libraries linked
+into one directory (see --compact-library-path).
+
+The results of a run are written to RESULTS_DIR/MACHINE/COMMIT.json, which
+is merged with the results of earlier runs for the same commit, so that the
+history of each benchmark can be plotted (this requires matplotlib).
+
+Usage:
+
+    python3 run_benchmarks.py list
+    python3 run_benchmarks.py run [-P CONANFILE] [--repeat N] [--filter REGEX]
+    python3 run_benchmarks.py plot [--output DIR]
+"""
+
+import argparse
+import json
+import os
+import platform
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+from pathlib import Path
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+
+
+BENCH_DIR = Path(__file__).resolve().parent
+ROOT_DIR = BENCH_DIR.parent.parent
+
+CONFIGS = ["nop", "minimator", "basic", "virtue", "gndtruth"]
+
+VARIANTS = {
+    "plain": [],
+    "server": ["option_server.json"],
+    "api_recording": ["option_api_recording.json"],
+}
+
+DURATION_UNITS = {"ns": 1e-9, "us": 1e-6, "ms": 1e-3, "s": 1.0}
+
+
+class Benchmark:
+    """Benchmark is a named measurement that is repeated to get samples."""
+
+    unit = ""
+    higher_is_better = False
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def sample(self, ctx: "Context") -> float:
+        raise NotImplementedError()
+
+
+class EngineBenchmark(Benchmark):
+    """EngineBenchmark measures the steps per second of a simulation."""
+
+    unit = "steps/s"
+    higher_is_better = True
+
+    def __init__(self, config: str, variant: str):
+        super().__init__(f"engine.{config}.{variant}")
+        self.stackfiles = [f"bench_{config}.json"] + VARIANTS[variant]
+
+    def sample(self, ctx: "Context") -> float:
+        # The overlay makes cloe-engine write its output, which includes the
+        # api_recording, into a temporary directory.
+        overlay = ctx.tmpdir / "overlay.json"
+        with overlay.open("w") as file:
+            json.dump(
+                {
+                    "version": "4",
+                    "engine": {
+                        "registry_path": str(ctx.tmpdir / "registry"),
+                        "output": {"path": "${CLOE_SIMULATION_UUID}"},
+                    },
+                },
+                file,
+            )
+        args = ["run", "--write-output", "--uuid", str(uuid.uuid4())]
+        args += [str(BENCH_DIR / x) for x in self.stackfiles] + [str(overlay)]
+        proc = ctx.cloe_launch(["exec"], args, stdout=subprocess.PIPE)
+        result = json.loads(proc.stdout.decode())
+        if result.get("outcome") != "success":
+            raise RuntimeError(f"{self.name}: simulation outcome is {result.get('outcome')}")
+        steps = result["simulation"]["step"]
+        match = re.match(r"^([0-9.]+)(ns|us|ms|s)$", result["elapsed"])
+        if match is None:
+            raise RuntimeError(f"{self.name}: cannot parse elapsed time: {result['elapsed']}")
+        elapsed = float(match.group(1)) * DURATION_UNITS[match.group(2)]
+        return steps / elapsed
+
+
+class LauncherBenchmark(Benchmark):
+    """LauncherBenchmark measures the overhead of cloe-launch exec."""
+
+    unit = "ms"
+
+    def __init__(self, cache: str):
+        super().__init__(f"launcher.exec_{cache}")
+        self.cold = cache == "cold"
+
+    def sample(self, ctx: "Context") -> float:
+        if self.cold:
+            ctx.cloe_launch(["clean"], None)
+        start = time.perf_counter()
+        ctx.cloe_launch(["exec"], ["version"])
+        launcher = time.perf_counter() - start
+        return (launcher - ctx.engine_time()) * 1000
+
+
+class StartupBenchmark(Benchmark):
+    """StartupBenchmark measures the time until cloe-engine has loaded all plugins."""
+
+    unit = "ms"
+
+    def __init__(self, library_path: str):
+        super().__init__(f"launcher.startup_{library_path}")
+        self.option = f"--{library_path}-library-path"
+        self.prepared = False
+
+    def sample(self, ctx: "Context") -> float:
+        args = ["check", str(BENCH_DIR / "bench_nop.json")]
+        if not self.prepared:
+            # Each library path has its own runtime directory.
+            ctx.cloe_launch(["exec", self.option], args)
+            self.prepared = True
+        start = time.perf_counter()
+        ctx.cloe_launch(["exec", self.option], args)
+        return (time.perf_counter() - start) * 1000
+
+
+def all_benchmarks() -> List[Benchmark]:
+    result: List[Benchmark] = []
+    for config in CONFIGS:
+        for variant in VARIANTS:
+            result.append(EngineBenchmark(config, variant))
+    result.append(LauncherBenchmark("warm"))
+    result.append(LauncherBenchmark("cold"))
+    result.append(StartupBenchmark("full"))
+    result.append(StartupBenchmark("compact"))
+    return result
+
+
+class Context:
+    """Context runs cloe-launch with the profile of the benchmarks."""
+
+    def __init__(self, conanfile: Path, tmpdir: Path):
+        self.conanfile = conanfile
+        self.tmpdir = tmpdir
+        self._engine_time: Optional[float] = None
+
+    def cloe_launch(
+        self, command: List[str], args: Optional[List[str]], stdout=subprocess.DEVNULL
+    ) -> subprocess.CompletedProcess:
+        cmd = ["cloe-launch"] + command + ["-P", str(self.conanfile)]
+        if command[0] == "exec":
+            cmd += ["-e", f"CLOE_BENCH_TMPDIR={self.tmpdir}"]
+        if args is not None:
+            cmd += ["--"] + args
+        return subprocess.run(cmd, check=True, stdout=stdout, stderr=subprocess.DEVNULL)
+
+    def engine_time(self) -> float:
+        """Return the time of cloe-engine version, without cloe-launch."""
+        if self._engine_time is None:
+            activate = subprocess.run(
+                ["cloe-launch", "activate", "-P", str(self.conanfile)],
+                check=True,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+            ).stdout.decode()
+            engine = subprocess.run(
+                ["bash", "-c", f"{activate}\ncommand -v cloe-engine"],
+                check=True,
+                stdout=subprocess.PIPE,
+            ).stdout.decode().strip()
+            samples = []
+            for _ in range(5):
+                start = time.perf_counter()
+                subprocess.run(
+                    [engine, "version"],
+                    check=True,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                )
+                samples.append(time.perf_counter() - start)
+            self._engine_time = statistics.median(samples)
+        return self._engine_time
+
+
+def git(*args: str) -> str:
+    return subprocess.run(
+        ["git", "-C", str(ROOT_DIR)] + list(args),
+        check=True,
+        stdout=subprocess.PIPE,
+    ).stdout.decode().strip()
+
+
+def machine_info() -> Dict[str, Any]:
+    cpu = platform.processor()
+    try:
+        with open("/proc/cpuinfo") as file:
+            for line in file:
+                if line.startswith("model name"):
+                    cpu = line.split(":", 1)[1].strip()
+                    break
+    except OSError:
+        pass
+    return {
+        "name": platform.node(),
+        "cpu": cpu,
+        "cpu_count": os.cpu_count(),
+        "system": f"{platform.system()} {platform.release()}",
+    }
+
+
+def results_path(results_dir: Path, machine: str, commit: str) -> Path:
+    return results_dir / machine / f"{commit}.json"
+
+
+def cmd_list(args) -> int:
+    for bench in all_benchmarks():
+        print(f"{bench.name:<36} {bench.unit}")
+    return 0
+
+
+def cmd_run(args) -> int:
+    benchmarks = [b for b in all_benchmarks() if re.search(args.filter, b.name)]
+    if not benchmarks:
+        print(f"error: no benchmarks match: {args.filter}", file=sys.stderr)
+        return 1
+    if shutil.which("cloe-launch") is None:
+        print("error: cloe-launch is not installed", file=sys.stderr)
+        return 1
+
+    commit = git("rev-parse", args.commit)
+    path = results_path(Path(args.results_dir), args.machine, commit)
+    data: Dict[str, Any] = {"benchmarks": {}}
+    if path.exists():
+        with path.open() as file:
+            data = json.load(file)
+    data.update(
+        {
+            "commit": commit,
+            "date": int(git("show", "-s", "--format=%ct", commit)),
+            "dirty": args.commit == "HEAD" and git("status", "--porcelain", "-uno") != "",
+            "machine": machine_info(),
+            "profile": str(args.profile_path),
+        }
+    )
+
+    failed = False
+    with tempfile.TemporaryDirectory() as tmp:
+        ctx = Context(Path(args.profile_path).resolve(), Path(tmp))
+        # Prepare the profile, so that the first sample is not cold.
+        ctx.cloe_launch(["prepare"], None)
+        for bench in benchmarks:
+            repeat = args.repeat
+            if isinstance(bench, LauncherBenchmark) and bench.cold:
+                # Preparing the runtime environment takes long.
+                repeat = min(repeat, 3)
+            samples = []
+            try:
+                for _ in range(repeat):
+                    samples.append(bench.sample(ctx))
+            except (subprocess.CalledProcessError, RuntimeError, ValueError, KeyError) as err:
+                print(f"{bench.name:<36} error: {err}", file=sys.stderr)
+                failed = True
+                continue
+            data["benchmarks"][bench.name] = {
+                "unit": bench.unit,
+                "higher_is_better": bench.higher_is_better,
+                "samples": samples,
+                "median": statistics.median(samples),
+                "min": min(samples),
+                "max": max(samples),
+            }
+            print(f"{bench.name:<36} {statistics.median(samples):12.1f} {bench.unit}", flush=True)
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open("w") as file:
+        json.dump(data, file, indent=2)
+        file.write("\n")
+    print(f"Results: {path}")
+    return 1 if failed else 0
+
+
+def load_history(results_dir: Path, machine: str) -> List[Dict[str, Any]]:
+    """Return the results of all commits on the machine, oldest first."""
+    history = []
+    for path in sorted((results_dir / machine).glob("*.json")):
+        with path.open() as file:
+            history.append(json.load(file))
+    history.sort(key=lambda x: x["date"])
+    return history
+
+
+def cmd_plot(args) -> int:
+    try:
+        import matplotlib  # pylint: disable=import-outside-toplevel
+
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        print("error: plotting requires matplotlib", file=sys.stderr)
+        return 1
+
+    history = load_history(Path(args.results_dir), args.machine)
+    if not history:
+        print(f"error: no results for machine {args.machine}", file=sys.stderr)
+        return 1
+    names = sorted({name for data in history for name in data["benchmarks"]})
+    output = Path(args.output)
+    output.mkdir(parents=True, exist_ok=True)
+    index = ["<html><body>", f"<h1>Cloe benchmarks on {args.machine}</h1>"]
+    for name in names:
+        points = [(d, d["benchmarks"][name]) for d in history if name in d["benchmarks"]]
+        labels = [d["commit"][:8] + ("+" if d.get("dirty") else "") for d, _ in points]
+        medians = [b["median"] for _, b in points]
+        lower = [b["median"] - b["min"] for _, b in points]
+        upper = [b["max"] - b["median"] for _, b in points]
+
+        fig, ax = plt.subplots(figsize=(max(6, len(points) * 0.4), 4))
+        ax.errorbar(range(len(points)), medians, yerr=[lower, upper], marker="o", capsize=3)
+        ax.set_xticks(range(len(points)))
+        ax.set_xticklabels(labels, rotation=90, fontsize="small")
+        better = "higher" if points[-1][1].get("higher_is_better") else "lower"
+        ax.set_title(f"{name} ({better} is better)")
+        ax.set_ylabel(points[-1][1]["unit"])
+        ax.set_ylim(bottom=0)
+        fig.tight_layout()
+        fig.savefig(output / f"{name}.png")
+        plt.close(fig)
+        index.append(f'<img src="{name}.png" alt="{name}">')
+    index.append("</body></html>")
+    (output / "index.html").write_text("\n".join(index) + "\n")
+    print(f"Plots: {output / 'index.html'}")
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument(
+        "--results-dir",
+        default=str(ROOT_DIR / "build" / "benchmarks"),
+        help="directory with the results of each machine and commit",
+    )
+    parser.add_argument(
+        "--machine", default=platform.node(), help="name of the machine to store results for"
+    )
+    sub = parser.add_subparsers(dest="command")
+    sub.required = True
+
+    sub.add_parser("list", help="list all benchmarks").set_defaults(func=cmd_list)
+
+    run = sub.add_parser("run", help="run benchmarks and store the results")
+    run.add_argument(
+        "-P",
+        "--profile-path",
+        default=str(ROOT_DIR / "tests" / "conanfile_default.py"),
+        help="conanfile to run cloe-engine with",
+    )
+    run.add_argument("--repeat", type=int, default=5, help="samples per benchmark")
+    run.add_argument("--filter", default="", help="only run benchmarks matching this regex")
+    run.add_argument("--commit", default="HEAD", help="commit to store results for")
+    run.set_defaults(func=cmd_run)
+
+    plot = sub.add_parser("plot", help="plot the history of each benchmark")
+    plot.add_argument(
+        "--output",
+        default=str(ROOT_DIR / "build" / "benchmarks" / "html"),
+        help="directory to write plots to",
+    )
+    plot.set_defaults(func=cmd_plot)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,41 @@
+#!/usr/bin/env bats
+
+load setup_bats
+load setup_testname
+
+setup() {
+    if [[ -z "${CLOE_SHELL}" ]]; then
+        skip "not running in a cloe-launch shell"
+    fi
+    runtime_dir="$(dirname "${CLOE_SHELL}")"
+    if [[ ! -f "${runtime_dir}/activate_flat.sh" ]]; then
+        skip "runtime directory does not contain activate_flat.sh"
+    fi
+}
+
+# Print the environment that results from sourcing the file given as the
+# first argument in an empty environment, extended by the remaining arguments.
+activated_env() {
+    local file="$1"
+    shift
+    env -i HOME="${HOME}" PATH="/usr/bin:/bin" "$@" \
+        bash -c "source '${file}' &>/dev/null; env -u _ -u SHLVL -u PWD -u OLDPWD" \
+        | sort
+}
+
+@test "$(testname 'Expect equivalence' 'activate_flat.sh == activate_all.sh' '62255409-4027-4f02-bf1b-8316567e986b')" {
+    diff \
+        <(activated_env "${runtime_dir}/activate_all.sh") \
+        <(activated_env "${runtime_dir}/activate_flat.sh")
+}
+
+@test "$(testname 'Expect equivalence' 'activate_flat.sh == activate_all.sh [env]' 'ff93537a-896f-4f70-bf5e-97af2c886b7a')" {
+    local extra=(
+        LD_LIBRARY_PATH="/opt/cloe-test/lib"
+        PYTHONPATH="/opt/cloe-test/python"
+        CLOE_TEST_VAR="with spaces and \$dollars"
+    )
+    diff \
+        <(activated_env "${runtime_dir}/activate_all.sh" "${extra[@]}") \
+        <(activated_env "${runtime_dir}/activate_flat.sh" "${extra[@]}")
+}